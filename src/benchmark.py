@@ -0,0 +1,314 @@
+import csv
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from climate_cache import climate_file_name
+from locations import open_location_registry
+from maxima import MaximaIndex
+from metrics import MetricEngine
+from migration_ingest import load_flow_table
+from raster_store import open_raster_store
+from rollup import Rollup
+from time_series import load_covid_data
+from zonal_stats import compute_zonal_stats
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+ENTRY_POINTS = ("combined_viz", "infection_spread", "migration", "covid19-heatmap")
+# Bumped when generate_dataset changes, so kept data is generated again
+DATA_VERSION = 3
+# Values below this are nodata in the SEDAC rasters, see raster_pyramid
+NODATA = -3.4e38
+REGIONS = [("Africa", "Eastern Africa", "Developing regions"),
+           ("Asia", "Southern Asia", "Developing regions"),
+           ("Europe", "Western Europe", "Developed regions"),
+           ("Latin America and the Caribbean", "South America", "Developing regions"),
+           ("Northern America", "Northern America", "Developed regions"),
+           ("Oceania", "Australia and New Zealand", "Developed regions")]
+
+
+def write_tiff(path, values):
+    # Single band float32 GeoTIFF-like raster, row 0 at the bottom like the
+    # vtkTIFFReader output
+    height, width = values.shape
+    image = vtk.vtkImageData()
+    image.SetDimensions(width, height, 1)
+    image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(values.astype(np.float32).ravel(), deep=1))
+    writer = vtk.vtkTIFFWriter()
+    writer.SetInputData(image)
+    writer.SetFileName(path)
+    writer.Write()
+
+
+def write_jpeg(path, pixels):
+    height, width, components = pixels.shape
+    image = vtk.vtkImageData()
+    image.SetDimensions(width, height, 1)
+    image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(pixels.reshape(-1, components), deep=1))
+    writer = vtk.vtkJPEGWriter()
+    writer.SetInputData(image)
+    writer.SetFileName(path)
+    writer.Write()
+
+
+def write_series(path, names, coordinates, dates, counts):
+    # JHU global time series layout: province, country, lat, long, then one
+    # cumulative count column per date
+    with open(path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["Province/State", "Country/Region", "Lat", "Long"] +
+                        ["{}/{}/{}".format(value.month, value.day, value.strftime("%y")) for value in dates])
+        for index, (name, (lat, long)) in enumerate(zip(names, coordinates)):
+            writer.writerow(["P{}".format(index), name, lat, long] + counts[index].tolist())
+
+
+def generate_dataset(directory, locations=300, dates=120, raster_size=(864, 432), migration_files=40,
+                     sat_size=(1440, 720), seed=0):
+    # Synthetic inputs shaped like the real ones: JHU time series, a
+    # countries table, UN migration tables, the density raster, a country
+    # code raster, twelve climate months per variable and a satellite
+    # image. Returns the paths by input name
+    random = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = {name: os.path.join(directory, name) for name in
+             ("infections.csv", "recovered.csv", "deaths.csv", "countries.csv", "density.tif", "zones.tif", "sat.jpg")}
+    paths["migration"] = os.path.join(directory, "migration")
+    paths["climate_max"] = os.path.join(directory, "climate-max", "climate")
+    paths["climate_min"] = os.path.join(directory, "climate-min", "climate")
+
+    names = ["Country {:04d}".format(index) for index in range(locations)]
+    coordinates = np.column_stack([random.uniform(-60, 70, locations), random.uniform(-170, 170, locations)]).round(4)
+    with open(paths["countries.csv"], "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["Country", "Alpha-2 code", "Alpha-3 code", "Numeric code",
+                         "Latitude (average)", "Longitude (average)"])
+        for index, (name, (lat, long)) in enumerate(zip(names, coordinates)):
+            writer.writerow([name, "", "X{:04d}".format(index), index + 1, lat, long])
+
+    date_list = [datetime.date(2020, 1, 22) + datetime.timedelta(days) for days in range(dates)]
+    infections = np.cumsum(random.poisson(random.uniform(0, 200, (locations, 1)), (locations, dates)), axis=1)
+    write_series(paths["infections.csv"], names, coordinates, date_list, infections)
+    write_series(paths["recovered.csv"], names, coordinates, date_list, (infections * 0.6).astype(np.int64))
+    write_series(paths["deaths.csv"], names, coordinates, date_list, (infections * 0.03).astype(np.int64))
+
+    # UN tables: one file per destination with a row per origin
+    os.makedirs(paths["migration"], exist_ok=True)
+    for destination in names[:migration_files]:
+        with open(os.path.join(paths["migration"], destination + ".csv"), "w", newline="", encoding="latin-1") as csv_file:
+            writer = csv.writer(csv_file)
+            for origin_index, origin in enumerate(names):
+                continent, subregion, development = REGIONS[origin_index % len(REGIONS)]
+                count = int(random.pareto(1.2) * 100) if origin != destination else ".."
+                writer.writerow(["Immigrants", "Both", origin, origin_index, continent, 0, subregion, 0,
+                                 development, count, "..", "..", "..", "..", ".."])
+
+    width, height = raster_size
+    y, x = np.mgrid[0:height, 0:width]
+    density = np.abs(np.sin(x / 40.0) * np.cos(y / 30.0)) * 5000
+    write_tiff(paths["density.tif"], np.where((x // 50 + y // 40) % 3 == 0, NODATA, density))
+    # Countries are tiles of the grid, numbered like the numeric codes, the
+    # fifth row of tiles left to no country
+    tiles = (y // 24) * (width // 24 + 1) + x // 24
+    write_tiff(paths["zones.tif"], np.where((y // 24) % 5 == 4, 0, 1 + tiles % locations))
+    for variable, offset in (("climate_max", 10.0), ("climate_min", -5.0)):
+        os.makedirs(os.path.dirname(paths[variable]), exist_ok=True)
+        for month in range(1, 13):
+            climate = offset + 20 * np.cos((y / height - 0.5) * np.pi) + 5 * np.sin(x / 60.0 + month)
+            write_tiff(climate_file_name(paths[variable], month), np.where((x + y) % 97 == 0, NODATA, climate))
+
+    sat_width, sat_height = sat_size
+    pixels = random.integers(0, 256, (sat_height, sat_width, 3), dtype=np.uint8)
+    write_jpeg(paths["sat.jpg"], pixels)
+    return paths
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, 1000 * (time.perf_counter() - start)
+
+
+def pipeline_stages(paths):
+    # The shared ingest steps timed in this process: the time series, the
+    # maxima index and a lookup per date, the migration tables, which also
+    # give the continents, the country and continent rollup, every derived
+    # metric, a cold raster store and the zonal statistics of the locations
+    results = {}
+    covid_data, results["ingest time series"] = timed(load_covid_data, paths["infections.csv"],
+                                                      paths["recovered.csv"], paths["deaths.csv"])
+    maxima, results["maxima index"] = timed(MaximaIndex, covid_data, (7,))
+    _, results["maxima lookups"] = timed(lambda: [maxima.max_for_date(date, 7) for date in range(maxima.num_dates)])
+    registry = open_location_registry(paths["countries.csv"])
+    _, results["ingest migration"] = timed(load_flow_table, paths["migration"], registry)
+    _, results["rollup"] = timed(Rollup, covid_data, registry)
+    engine = MetricEngine(covid_data)
+    _, results["metrics"] = timed(lambda: [engine.get(metric) for metric in engine.metrics])
+    with tempfile.TemporaryDirectory() as cache:
+        _, results["ingest rasters"] = timed(open_raster_store, cache, paths["density.tif"],
+                                             [paths["climate_max"], paths["climate_min"]], lambda message: None)
+    _, results["zonal statistics"] = timed(compute_zonal_stats, registry.names.tolist(), registry.numeric,
+                                           paths["zones.tif"], paths["density.tif"], paths["climate_max"],
+                                           paths["climate_min"], None, lambda message: None)
+    return results
+
+
+def entry_point_command(name, paths, export, trace, frames, size):
+    inputs = {"combined_viz": [paths["infections.csv"], paths["recovered.csv"], paths["deaths.csv"], paths["density.tif"],
+                               paths["climate_max"], paths["climate_min"], paths["countries.csv"], paths["migration"],
+                               paths["sat.jpg"]],
+              "infection_spread": [paths["sat.jpg"], paths["infections.csv"], paths["deaths.csv"], paths["recovered.csv"]],
+              "migration": [paths["migration"], paths["countries.csv"], paths["sat.jpg"]],
+              "covid19-heatmap": [paths["density.tif"], paths["climate_max"], paths["sat.jpg"]]}[name]
+    command = [sys.executable, os.path.join(SCRIPT_DIRECTORY, name + ".py")] + inputs
+    command += ["--export", export, "--trace", trace, "--size", str(size[0]), str(size[1])]
+    if name != "migration":
+        command += ["--end", str(frames - 1)]
+    return command
+
+
+def read_trace(path):
+    with open(path) as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip()]
+
+
+def summarize_trace(records, wall_ms):
+    # Startup is everything before the first frame (ingest and scene
+    # setup), frame stages are medians over the exported frames and
+    # "update" is the part of a frame that is neither render nor write
+    frames = [record for record in records if record["event"] == "export"]
+    result = {"wall": wall_ms}
+    if frames:
+        result["startup"] = 1000 * frames[0]["time"] - frames[0]["ms"]["total"]
+    for record in records:
+        if record["event"] != "export":
+            result[record["event"]] = record["ms"]["total"]
+    stages = {}
+    for record in frames:
+        stage_ms = dict(record["ms"])
+        stage_ms["update"] = stage_ms["total"] - stage_ms.get("render", 0.0) - stage_ms.get("write", 0.0)
+        for stage, ms in stage_ms.items():
+            stages.setdefault("frame " + stage, []).append(ms)
+    result.update({stage: float(np.median(values)) for stage, values in stages.items()})
+    return result
+
+
+def run_entry_point(name, paths, frames, size):
+    with tempfile.TemporaryDirectory() as scratch:
+        trace = os.path.join(scratch, "trace.jsonl")
+        command = entry_point_command(name, paths, os.path.join(scratch, "frames"), trace, frames, size)
+        start = time.perf_counter()
+        process = subprocess.run(command, cwd=SCRIPT_DIRECTORY, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+        wall_ms = 1000 * (time.perf_counter() - start)
+        if process.returncode != 0:
+            raise RuntimeError("{} failed:\n{}".format(name, process.stderr[-2000:]))
+        return summarize_trace(read_trace(trace), wall_ms)
+
+
+def median_results(runs):
+    # Per metric median over the repeats
+    merged = {}
+    for run in runs:
+        for group, metrics in run.items():
+            for metric, value in metrics.items():
+                merged.setdefault(group, {}).setdefault(metric, []).append(value)
+    return {group: {metric: round(float(np.median(values)), 3) for metric, values in metrics.items()}
+            for group, metrics in merged.items()}
+
+
+def run_benchmark(config, paths, entry_points, repeat=1, log=print):
+    runs = []
+    for iteration in range(repeat):
+        log("Run {}/{}".format(iteration + 1, repeat))
+        run = {"pipeline": pipeline_stages(paths)}
+        for name in entry_points:
+            log("  {}".format(name))
+            run[name] = run_entry_point(name, paths, config["frames"], config["size"])
+        runs.append(run)
+    return {"created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "config": config,
+            "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                            "vtk": vtk.vtkVersion.GetVTKVersion(), "platform": platform.platform(),
+                            "cpus": os.cpu_count()},
+            "results": median_results(runs)}
+
+
+def print_report(report, baseline=None):
+    # Milliseconds per metric, with the change against a baseline report
+    # when given. Baselines of another configuration are not comparable
+    if baseline and baseline["config"] != report["config"]:
+        print("The baseline was run with another configuration: {}".format(baseline["config"]))
+    old = baseline["results"] if baseline else {}
+    for group, metrics in report["results"].items():
+        print(group)
+        for metric, value in metrics.items():
+            line = "  {:32} {:10.2f} ms".format(metric, value)
+            previous = old.get(group, {}).get(metric)
+            if previous:
+                line += "  {:10.2f} ms  {:+7.1f}%".format(previous, 100 * (value - previous) / previous)
+            print(line)
+
+
+def main():
+    parser = ArgumentParser("Time the visualization pipeline on synthetic data")
+    parser.add_argument("--output", type = str, default = "benchmark.json", help = "Write the report to this JSON file")
+    parser.add_argument("--compare", type = str, help = "Earlier report to compare against")
+    parser.add_argument("--data", type = str, help = "Keep the generated data in this directory, reused if it has the same scale")
+    parser.add_argument("--locations", type = int, default = 300, help = "Rows of the time series and countries of the migration tables")
+    parser.add_argument("--dates", type = int, default = 120, help = "Date columns of the time series")
+    parser.add_argument("--raster-size", type = int, nargs = 2, default = [864, 432], metavar = ("WIDTH", "HEIGHT"), help = "Size of the density and climate rasters")
+    parser.add_argument("--sat-size", type = int, nargs = 2, default = [1440, 720], metavar = ("WIDTH", "HEIGHT"), help = "Size of the satellite image")
+    parser.add_argument("--migration-files", type = int, default = 40, help = "Number of migration destination tables")
+    parser.add_argument("--frames", type = int, default = 10, help = "Number of frames each viewer exports")
+    parser.add_argument("--size", type = int, nargs = 2, default = [640, 360], metavar = ("WIDTH", "HEIGHT"), help = "Size of the rendered frames")
+    parser.add_argument("--repeat", type = int, default = 1, help = "Run everything this many times and report the medians")
+    parser.add_argument("--seed", type = int, default = 0, help = "Seed of the synthetic data")
+    parser.add_argument("--entry-points", type = str, nargs = "+", default = list(ENTRY_POINTS), choices = ENTRY_POINTS, help = "Viewers to time")
+    args = parser.parse_args()
+
+    config = {"locations": args.locations, "dates": args.dates, "raster_size": args.raster_size,
+              "sat_size": args.sat_size, "migration_files": min(args.migration_files, args.locations),
+              "frames": min(args.frames, args.dates), "size": args.size, "seed": args.seed}
+    baseline = None
+    if args.compare:
+        with open(args.compare) as report_file:
+            baseline = json.load(report_file)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        directory = args.data or scratch
+        config_path = os.path.join(directory, "benchmark-data.json")
+        data_config = {key: config[key] for key in ("locations", "dates", "raster_size", "sat_size", "migration_files", "seed")}
+        data_config["version"] = DATA_VERSION
+        if os.path.isfile(config_path):
+            with open(config_path) as config_file:
+                stored = json.load(config_file)
+        else:
+            stored = None
+        if stored and stored["config"] == data_config:
+            paths = stored["paths"]
+        else:
+            print("Generating data in {}".format(directory))
+            paths = generate_dataset(directory, args.locations, args.dates, args.raster_size, config["migration_files"],
+                                     args.sat_size, args.seed)
+            with open(config_path, "w") as config_file:
+                json.dump({"config": data_config, "paths": paths}, config_file)
+        report = run_benchmark(config, paths, args.entry_points, args.repeat)
+
+    with open(args.output, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    print_report(report, baseline)
+    print("Wrote {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+import datetime
+import json
+import os
+import struct
+import tempfile
+from argparse import ArgumentParser
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from climate_cache import climate_file_name, climate_layer_name
+from locations import LocationRegistry, open_location_registry
+from migration_index import FlowTable, GROUP_COLUMNS
+from migration_ingest import load_flow_table, migration_files
+from raster_store import layer_code_values, layer_image, open_raster_store
+from time_series import SERIES, CovidData, TimeSeries, load_covid_data
+
+# A bundle is the magic, the format version and the header length, then a
+# JSON header and the arrays it describes, each aligned to ALIGNMENT bytes
+BUNDLE_MAGIC = b"CVTKBNDL"
+BUNDLE_VERSION = 3
+PREFIX = struct.Struct("<8sIQ")
+ALIGNMENT = 64
+
+
+def aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_bundle(path, arrays, meta):
+    # Arrays are written in C order at aligned offsets from the end of the
+    # header, the file only replaces `path` once it is complete
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = aligned(offset + array.nbytes)
+    header = json.dumps({"arrays": layout, "meta": meta}).encode("utf-8")
+    data_start = aligned(PREFIX.size + len(header))
+
+    with open(path + ".tmp", "wb") as bundle_file:
+        bundle_file.write(PREFIX.pack(BUNDLE_MAGIC, BUNDLE_VERSION, len(header)))
+        bundle_file.write(header)
+        for name, array in arrays.items():
+            bundle_file.seek(data_start + layout[name]["offset"])
+            bundle_file.write(np.ascontiguousarray(array).tobytes())
+        bundle_file.truncate(data_start + offset)
+    os.replace(path + ".tmp", path)
+
+
+class Bundle(object):
+    # Read side of a bundle: every array is a read-only view of one memory
+    # map of the file, nothing is parsed but the header. Stored rasters are
+    # served like a RasterStore, so the viewers can use either
+    def __init__(self, path):
+        with open(path, "rb") as bundle_file:
+            magic, version, header_length = PREFIX.unpack(bundle_file.read(PREFIX.size))
+            if magic != BUNDLE_MAGIC:
+                raise ValueError("{} is not a dataset bundle".format(path))
+            if version != BUNDLE_VERSION:
+                raise ValueError("{} has bundle version {}, expected {}, rebuild it with bundle.py build"
+                                 .format(path, version, BUNDLE_VERSION))
+            header = json.loads(bundle_file.read(header_length).decode("utf-8"))
+
+        self.path = path
+        self.layout = header["arrays"]
+        self.meta = header["meta"]
+        self.data_start = aligned(PREFIX.size + header_length)
+        self.map = np.memmap(path, dtype=np.uint8, mode="r")
+
+    def array(self, name):
+        layout = self.layout[name]
+        dtype = np.dtype(layout["dtype"])
+        start = self.data_start + layout["offset"]
+        count = int(np.prod(layout["shape"], dtype=np.int64))
+        return self.map[start:start + count * dtype.itemsize].view(dtype).reshape(layout["shape"])
+
+    def covid_data(self):
+        series = []
+        for name in SERIES:
+            meta = self.meta["series"][name]
+            series.append(TimeSeries(meta["provinces"], meta["countries"],
+                                     self.array("series/" + name + "/lat"),
+                                     self.array("series/" + name + "/long"),
+                                     self.array("series/" + name + "/counts"),
+                                     [datetime.date.fromisoformat(value) for value in meta["dates"]]))
+        return CovidData(*series)
+
+    def location_registry(self):
+        return LocationRegistry.from_json(self.meta["locations"])
+
+    def flow_table(self):
+        meta = self.meta["flows"]
+        group_names = {level: np.array(meta["groups"][level], dtype=str) for level in GROUP_COLUMNS}
+        groups = {level: self.array("flows/groups/" + level) for level in GROUP_COLUMNS}
+        return FlowTable(np.array(meta["countries"], dtype=str),
+                         self.array("flows/destination"), self.array("flows/origin"), self.array("flows/weight"),
+                         self.array("flows/lat"), self.array("flows/long"), group_names, groups)
+
+    def satellite_image(self):
+        meta = self.meta["satellite"]
+        pixels = self.array("satellite")
+        image = vtk.vtkImageData()
+        image.SetDimensions(meta["dimensions"])
+        image.SetSpacing(meta["spacing"])
+        image.SetOrigin(meta["origin"])
+        image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(pixels.reshape(-1, pixels.shape[-1]), deep=0))
+        return image
+
+    def climate_path(self, variable):
+        # Source path the climate layers of a variable are named after
+        return self.meta["climate"][variable]
+
+    # Raster store interface, see raster_store.RasterStore
+    def codes(self, name):
+        return self.array("rasters/" + name)
+
+    def image(self, name):
+        return layer_image(self.meta["rasters"][name], self.codes(name))
+
+    def code_values(self, name):
+        return layer_code_values(self.meta["rasters"][name])
+
+    def scalar_range(self, name):
+        return self.meta["rasters"][name]["scalar_range"]
+
+
+def open_bundle(path):
+    return Bundle(path) if path else None
+
+
+def read_satellite(path):
+    reader = vtk.vtkJPEGReader()
+    reader.SetFileName(path)
+    reader.Update()
+    image = reader.GetOutput()
+    width, height, _ = image.GetDimensions()
+    scalars = image.GetPointData().GetScalars()
+    if scalars is None or width * height == 0:
+        raise ValueError("Could not decode the satellite image {}".format(path))
+    pixels = numpy_support.vtk_to_numpy(scalars).reshape(height, width, -1)
+    return pixels, {"dimensions": list(image.GetDimensions()),
+                    "spacing": list(image.GetSpacing()),
+                    "origin": list(image.GetOrigin())}
+
+
+def check_sources(infections, recovered, deaths, density, climate, location, migration, sat):
+    # Fail before any conversion when an input is missing
+    missing = [path for path in (infections, recovered, deaths, density, location, sat) if not os.path.isfile(path)]
+    for path in climate:
+        missing += [climate_file_name(path, month) for month in range(1, 13)
+                    if not os.path.isfile(climate_file_name(path, month))]
+    if not os.path.isdir(migration):
+        missing.append(migration)
+    if missing:
+        raise ValueError("Missing inputs: " + ", ".join(missing))
+
+
+def check_covid_data(covid_data):
+    # The series are drawn by a shared date index, so their dates must agree
+    dates = covid_data.infections.dates
+    for name, series in covid_data.series():
+        if not series.num_dates or not series.num_locations:
+            raise ValueError("The {} series has no data".format(name))
+        count = min(len(dates), series.num_dates)
+        if series.dates[:count] != dates[:count]:
+            raise ValueError("The dates of the {} series do not match the infections series".format(name))
+
+
+def build_bundle(path, infections, recovered, deaths, density, climate_max, climate_min, location, migration, sat,
+                 raster_cache=None, log=print):
+    # Parse and check every input of combined_viz.py once and store them in
+    # one bundle at `path`. Rasters go through a raster store, `raster_cache`
+    # reuses one that is already filled
+    climate = {"max": os.path.abspath(climate_max), "min": os.path.abspath(climate_min)}
+    check_sources(infections, recovered, deaths, density, climate.values(), location, migration, sat)
+    arrays = {}
+    meta = {"created": datetime.datetime.now().isoformat(timespec="seconds")}
+
+    log("Reading the time series")
+    covid_data = load_covid_data(infections, recovered, deaths)
+    check_covid_data(covid_data)
+    meta["series"] = {}
+    for name, series in covid_data.series():
+        arrays["series/" + name + "/counts"] = series.counts
+        arrays["series/" + name + "/lat"] = series.lat
+        arrays["series/" + name + "/long"] = series.long
+        meta["series"][name] = {"provinces": series.provinces,
+                                "countries": series.countries,
+                                "dates": [value.isoformat() for value in series.dates]}
+
+    log("Reading the locations and migration flows")
+    registry = open_location_registry(location)
+    if not len(registry):
+        raise ValueError("{} has no locations".format(location))
+
+    unplaced = [name for name, file_path in migration_files(migration) if name not in registry]
+    if unplaced:
+        log("No location for the migration destinations: " + ", ".join(unplaced))
+    # Reading the flows also fills the continents of the registry
+    flow_table = load_flow_table(migration, registry)
+    if not flow_table.num_flows:
+        raise ValueError("{} has no migration flows between known locations".format(migration))
+    meta["locations"] = registry.to_json()
+    for name in ("destination", "origin", "weight", "lat", "long"):
+        arrays["flows/" + name] = getattr(flow_table, name)
+    for level in GROUP_COLUMNS:
+        arrays["flows/groups/" + level] = flow_table.groups[level]
+    meta["flows"] = {"countries": flow_table.countries.tolist(),
+                     "groups": {level: flow_table.group_names[level].tolist() for level in GROUP_COLUMNS}}
+
+    log("Reading the rasters")
+    with tempfile.TemporaryDirectory() as scratch:
+        store = open_raster_store(raster_cache or scratch, density, list(climate.values()), log)
+        layers = ["density"] + [climate_layer_name(path, month) for path in climate.values() for month in range(1, 13)]
+        for name in layers:
+            arrays["rasters/" + name] = store.codes(name)
+        meta["rasters"] = {name: store.meta[name] for name in layers}
+        meta["climate"] = climate
+        arrays["satellite"], meta["satellite"] = read_satellite(sat)
+
+        log("Writing {}".format(path))
+        write_bundle(path, arrays, meta)
+
+
+def print_bundle(path):
+    bundle = Bundle(path)
+    print("{}: bundle version {}, created {}".format(path, BUNDLE_VERSION, bundle.meta["created"]))
+    for name, layout in bundle.layout.items():
+        print("  {:32} {:8} {}".format(name, np.dtype(layout["dtype"]).name, tuple(layout["shape"])))
+
+
+def main():
+    parser = ArgumentParser("Convert the inputs of the viewers into a single preprocessed bundle")
+    commands = parser.add_subparsers(dest = "command", required = True)
+    build = commands.add_parser("build", help = "Parse, check and store every input of combined_viz.py")
+    build.add_argument("bundle")
+    build.add_argument("infections")
+    build.add_argument("recovered")
+    build.add_argument("deaths")
+    build.add_argument("density")
+    build.add_argument("climate_max")
+    build.add_argument("climate_min")
+    build.add_argument("location")
+    build.add_argument("migration")
+    build.add_argument("sat")
+    build.add_argument("--raster-cache", type = str, help = "Raster cache to take the preprocessed rasters from")
+    info = commands.add_parser("info", help = "List the arrays of a bundle")
+    info.add_argument("bundle")
+
+    args = parser.parse_args()
+    if args.command == "info":
+        print_bundle(args.bundle)
+        return
+    try:
+        build_bundle(args.bundle, args.infections, args.recovered, args.deaths, args.density, args.climate_max,
+                     args.climate_min, args.location, args.migration, args.sat, args.raster_cache)
+    except ValueError as error:
+        parser.error(str(error))
+
+
+if __name__ == '__main__':
+    main()
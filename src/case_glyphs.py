@@ -0,0 +1,157 @@
+import math
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from projection import Projection
+from time_series import SERIES
+
+
+class CaseGlyphLayer(object):
+    # Draws the case circles of every series as glyphs of a single point set,
+    # so a frame costs one actor and one draw call whatever the number of
+    # locations. `key` names the layer's points in the projection cache
+    def __init__(self, covid_data, styles, sat_x, sat_y, max_radius, sides=50, projection=None, key="cases"):
+        self.covid_data = covid_data
+        self.key = key
+        self.styles = styles
+        self.max_radius = max_radius
+        self.sat_size = (sat_x, sat_y)
+
+        # Points of every series are stored back to back in SERIES order
+        self.ranges = {}
+        start = 0
+        for name, series in covid_data.series():
+            self.ranges[name] = (start, start + series.num_locations)
+            start += series.num_locations
+        self.num_points = start
+
+        lat = np.concatenate([series.lat for name, series in covid_data.series()])
+        long = np.concatenate([series.long for name, series in covid_data.series()])
+        self.has_location = (lat != 0) | (long != 0)
+
+        self.colors = np.zeros((self.num_points, 4), dtype=np.uint8)
+        for name in SERIES:
+            start, end = self.ranges[name]
+            color, opacity = styles[name]
+            self.colors[start:end, :3] = np.round(np.array(color) * 255)
+            self.colors[start:end, 3] = round(opacity * 255)
+
+        # Cases of every point for every date, one contiguous row per date,
+        # for the cumulative counts and every metric drawn, see set_metric
+        self.metric = "cumulative"
+        self.scale = "log"
+        self.metric_counts = {"cumulative": self.date_rows(covid_data)}
+        self.counts = self.metric_counts["cumulative"]
+
+        # The geometry and its arrays are allocated once, a date change only
+        # rewrites the radius and visibility values in place
+        self.points = vtk.vtkPoints()
+        self.points.SetData(numpy_support.numpy_to_vtk(np.zeros((self.num_points, 3), dtype=np.float32), deep=1))
+        self.positions = numpy_support.vtk_to_numpy(self.points.GetData())
+        self.set_projection(projection or Projection())
+
+        self.radius_array = vtk.vtkFloatArray()
+        self.radius_array.SetName("radius")
+        self.radius_array.SetNumberOfTuples(self.num_points)
+        self.radius = numpy_support.vtk_to_numpy(self.radius_array)
+        self.radius.fill(0)
+
+        # Hidden points get a zero radius, vtkGlyph3DMapper only masks with
+        # a vtkBitArray
+        self.shown = np.zeros(self.num_points, dtype=np.bool_)
+
+        colors_array = numpy_support.numpy_to_vtk(self.colors, deep=1)
+        colors_array.SetName("colors")
+
+        self.polydata = vtk.vtkPolyData()
+        self.polydata.SetPoints(self.points)
+        self.polydata.GetPointData().AddArray(self.radius_array)
+        self.polydata.GetPointData().AddArray(colors_array)
+
+        self.circle = vtk.vtkRegularPolygonSource()
+        self.circle.SetNumberOfSides(sides)
+        self.circle.SetRadius(1)
+        self.circle.SetCenter(0, 0, 0)
+
+        self.mapper = vtk.vtkGlyph3DMapper()
+        self.mapper.SetInputData(self.polydata)
+        self.mapper.SetSourceConnection(self.circle.GetOutputPort())
+        self.mapper.OrientOff()
+        self.mapper.ScalingOn()
+        self.mapper.SetScaleModeToScaleByMagnitude()
+        self.mapper.SetScaleArray("radius")
+        self.mapper.SetScalarModeToUsePointFieldData()
+        self.mapper.SelectColorArray("colors")
+        self.mapper.SetColorModeToDirectScalars()
+
+        self.actor = vtk.vtkActor()
+        self.actor.SetMapper(self.mapper)
+
+    def date_rows(self, covid_data):
+        num_dates = covid_data.num_dates
+        return np.ascontiguousarray(np.concatenate(
+            [series.counts[:, :num_dates] for name, series in covid_data.series()]).T)
+
+    def set_metric(self, metric, metric_data, scale="log"):
+        # Draw the values of `metric_data`, a CovidData of the same rows,
+        # e.g. from a MetricEngine. Radii grow with the log or the value
+        if metric not in self.metric_counts:
+            self.metric_counts[metric] = self.date_rows(metric_data)
+        self.metric = metric
+        self.scale = scale
+        self.counts = self.metric_counts[metric]
+
+    def set_projection(self, projection):
+        # Move the points in place, the next update hides the ones on the far
+        # side of the map
+        sat_x, sat_y = self.sat_size
+        x, y, visible = [np.concatenate(parts) for parts in zip(*[
+            projection.project(series.lat, series.long, sat_x, sat_y, key=(self.key, name))
+            for name, series in self.covid_data.series()])]
+        self.positions[:, 0] = x
+        self.positions[:, 1] = y
+        self.on_map = self.has_location & visible
+        self.points.Modified()
+
+    def extend(self):
+        # Add the rows of the dates the series gained since the layer was
+        # built. The metrics are dropped, set_metric computes them again
+        cumulative = self.metric_counts["cumulative"]
+        known = len(cumulative)
+        num_dates = self.covid_data.num_dates
+        if num_dates > known:
+            new = np.concatenate([series.counts[:, known:num_dates] for name, series in self.covid_data.series()]).T
+            cumulative = np.ascontiguousarray(np.concatenate([cumulative, new]))
+        self.metric_counts = {"cumulative": cumulative}
+        self.metric = "cumulative"
+        self.scale = "log"
+        self.counts = cumulative
+
+    def cases(self, date):
+        return self.counts[date]
+
+    def update(self, date, max_cases, visible):
+        cases = self.counts[date]
+
+        np.greater(cases, 0, out=self.shown)
+        np.logical_and(self.shown, self.on_map, out=self.shown)
+        for name in SERIES:
+            if not visible[name]:
+                start, end = self.ranges[name]
+                self.shown[start:end] = False
+
+        self.radius.fill(0)
+        if self.scale == "log":
+            scale = math.log2(max_cases) if max_cases > 1 else 1.0
+            np.log2(cases, out=self.radius, where=self.shown, casting="unsafe")
+            # Values below 1 would get a negative radius
+            np.maximum(self.radius, 0, out=self.radius)
+        else:
+            scale = max_cases if max_cases > 0 else 1.0
+            np.copyto(self.radius, cases, where=self.shown, casting="unsafe")
+        self.radius *= self.max_radius / scale
+
+        self.radius_array.Modified()
+        self.polydata.Modified()
@@ -0,0 +1,79 @@
+from case_glyphs import CaseGlyphLayer
+from maxima import MaximaIndex
+from metrics import METRICS, MetricEngine
+from rollup import Rollup
+
+
+class CaseViews(object):
+    # The case circles both viewers draw: the rollup of the JHU series, a
+    # metric engine per granularity, a maxima index per (granularity,
+    # metric) and a glyph layer per granularity. Each is built the first
+    # time it is shown and reused after, so switching back to a view costs
+    # nothing. `layer_args` are the CaseGlyphLayer arguments after the data
+    # (styles, map width and height, largest radius) and `windows` the
+    # maxima index windows
+    def __init__(self, rollup, population, layer_args, projection, windows=()):
+        self.rollup = rollup
+        self.population = population
+        self.layer_args = layer_args
+        self.projection = projection
+        self.windows = list(windows)
+        self.metric_engines = {}
+        self.case_maxima = {}
+        self.case_layers = {}
+
+    def metrics(self, granularity):
+        return self.engine(granularity).metrics
+
+    def engine(self, granularity):
+        if granularity not in self.metric_engines:
+            self.metric_engines[granularity] = MetricEngine(self.rollup.covid_data(granularity), self.population)
+        return self.metric_engines[granularity]
+
+    def add(self, granularity, metric, engine, maxima):
+        # A view whose metric and maxima were computed elsewhere, e.g. on a
+        # loader thread
+        self.metric_engines[granularity] = engine
+        self.case_maxima[granularity, metric] = maxima
+
+    def view(self, granularity, metric):
+        # (series, maxima index, glyph layer) of `metric` at `granularity`,
+        # the layer switched to the metric and the current projection
+        covid_data = self.rollup.covid_data(granularity)
+        values = self.engine(granularity).get(metric)
+        if (granularity, metric) not in self.case_maxima:
+            self.case_maxima[granularity, metric] = MaximaIndex(values, self.windows)
+        layer = self.case_layers.get(granularity)
+        if layer is None:
+            layer = CaseGlyphLayer(covid_data, *self.layer_args, projection=self.projection, key=("cases", granularity))
+            self.case_layers[granularity] = layer
+        else:
+            layer.set_projection(self.projection)
+        layer.set_metric(metric, values, METRICS[metric][1])
+        return covid_data, self.case_maxima[granularity, metric], layer
+
+    def refresh(self, watcher):
+        # Take in what the JHU files gained since the last poll, True when
+        # anything did. A series that gained or lost rows rebuilds the rollup
+        # and every view. New dates extend the rollup, the cumulative maxima
+        # and the glyph layers, the other metrics are computed again when
+        # drawn
+        source = self.rollup.source
+        num_dates = source.num_dates
+        if watcher.poll(source):
+            self.rollup = Rollup(source, self.rollup.registry)
+            self.metric_engines = {}
+            self.case_maxima = {}
+            self.case_layers = {}
+        elif source.num_dates != num_dates:
+            self.rollup.extend()
+            for engine in self.metric_engines.values():
+                engine.clear()
+            self.case_maxima = {key: maxima for key, maxima in self.case_maxima.items() if key[1] == "cumulative"}
+            for (granularity, metric), maxima in self.case_maxima.items():
+                maxima.extend(self.rollup.covid_data(granularity))
+            for layer in self.case_layers.values():
+                layer.extend()
+        else:
+            return False
+        return True
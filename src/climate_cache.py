@@ -0,0 +1,110 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import vtk
+
+
+def climate_file_name(path, month):
+    # Climate paths stop before the "-XX.tif" month suffix, see README
+    return path + "-" + str(month).zfill(2) + ".tif"
+
+
+def climate_layer_name(path, month):
+    # Name of a climate month inside a raster store, the hash keeps apart
+    # variables whose files share a name in different directories
+    digest = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:8]
+    return os.path.basename(path) + "-" + digest + "-" + str(month).zfill(2)
+
+
+def adjacent_months(month):
+    return [(month - 2) % 12 + 1, month % 12 + 1]
+
+
+class ClimateCache(object):
+    # Bounded LRU cache of decoded climate rasters keyed by (variable, month),
+    # so that crossing a month boundary only swaps a mapper input. Adjacent
+    # months can be decoded ahead of time on a background thread. With a
+    # raster store the months are mapped from it instead of decoding TIFFs.
+    # `build` turns a decoded image into the cached value, e.g. a pyramid
+    def __init__(self, paths, capacity=6, prefetch=True, raster_store=None, build=None):
+        self.paths = paths
+        self.raster_store = raster_store
+        self.build = build
+        self.capacity = max(capacity, 1)
+        self.images = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+    def load(self, variable, month):
+        if self.raster_store is not None:
+            image = self.raster_store.image(climate_layer_name(self.paths[variable], month))
+        else:
+            reader = vtk.vtkTIFFReader()
+            reader.SetFileName(climate_file_name(self.paths[variable], month))
+            reader.Update()
+            image = vtk.vtkImageData()
+            image.ShallowCopy(reader.GetOutput())
+        return self.build(image) if self.build else image
+
+    def store(self, key, image):
+        with self.lock:
+            self.images[key] = image
+            self.images.move_to_end(key)
+            while len(self.images) > self.capacity:
+                self.images.popitem(last=False)
+            self.pending.pop(key, None)
+
+    def get(self, variable, month):
+        key = (variable, month)
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+            future = self.pending.get(key)
+
+        if image is None and future is not None:
+            # A failed prefetch is loaded again here, where the error shows
+            try:
+                image = future.result()
+            except Exception:
+                image = None
+        if image is None:
+            image = self.load(variable, month)
+            self.store(key, image)
+
+        # Keep the neighbours of the current month ahead of older months,
+        # and the current month ahead of everything
+        self.prefetch(month)
+        with self.lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+        return image
+
+    def prefetch(self, month):
+        if self.executor is None:
+            return
+        for variable in self.paths:
+            for adjacent in adjacent_months(month):
+                key = (variable, adjacent)
+                with self.lock:
+                    if key in self.images:
+                        self.images.move_to_end(key)
+                        continue
+                    if key in self.pending:
+                        continue
+                    self.pending[key] = self.executor.submit(self.prefetch_image, key)
+
+    def prefetch_image(self, key):
+        # A failed load leaves `pending`, so the month is not stuck on it
+        try:
+            image = self.load(*key)
+        except Exception:
+            with self.lock:
+                self.pending.pop(key, None)
+            raise
+        self.store(key, image)
+        return image
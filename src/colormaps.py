@@ -0,0 +1,56 @@
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+# Palettes as control points (position, red, green, blue) over 0..100,
+# interpolated linearly in RGB and clamped past the ends like a
+# vtkColorTransferFunction
+PALETTES = {
+    "density": np.array([[0, 0, 0, 0],
+                         [10, 0, 0, 1],
+                         [30, 0, 1, 1],
+                         [50, 1, 1, 0],
+                         [65, 1, 0.5, 0],
+                         [80, 1, 0, 0]]),
+    "climate": np.array([[5, 0, 0, 1],
+                         [35, 0, 1, 1],
+                         [65, 1, 1, 0],
+                         [95, 1, 0, 0]]),
+    "viridis": np.array([[0, 0.267, 0.005, 0.329],
+                         [25, 0.231, 0.322, 0.545],
+                         [50, 0.129, 0.569, 0.549],
+                         [75, 0.369, 0.788, 0.384],
+                         [100, 0.993, 0.906, 0.144]]),
+    "grayscale": np.array([[0, 0, 0, 0],
+                           [100, 1, 1, 1]]),
+}
+PALETTE_RANGE = 100
+
+
+def palette_colors(name, count=1000, transparent_first=False):
+    # (count, 4) RGBA of a palette, entry i sits at PALETTE_RANGE * i / count
+    points = PALETTES[name]
+    positions = PALETTE_RANGE * np.arange(count, dtype=np.float64) / count
+    colors = np.ones((count, 4))
+    for channel in range(3):
+        colors[:, channel] = np.interp(positions, points[:, 0], points[:, channel + 1])
+    if transparent_first:
+        colors[0, 3] = 0
+    return colors
+
+
+def set_palette(lut, name, transparent_first=False):
+    # Replace the colors of a lookup table in place, its mappers pick them up
+    # on the next render
+    colors = palette_colors(name, lut.GetNumberOfTableValues(), transparent_first)
+    table = np.floor(colors * 255 + 0.5).astype(np.uint8)
+    lut.SetTable(numpy_support.numpy_to_vtk(table, deep=1, array_type=vtk.VTK_UNSIGNED_CHAR))
+    lut.Modified()
+    return lut
+
+
+def palette_lookup_table(name, count=1000, transparent_first=False):
+    lut = vtk.vtkLookupTable()
+    lut.SetNumberOfTableValues(count)
+    lut.Build()
+    return set_palette(lut, name, transparent_first)
@@ -1,16 +1,40 @@
 import datetime
 from datetime import timedelta
 
-from PyQt5.QtWidgets import QApplication, QWidget, QMainWindow, QSlider, QGridLayout, QLabel, QPushButton, QTextEdit, QCheckBox
-import PyQt5.QtCore as QtCore
-from PyQt5.QtCore import Qt
 import vtk
-from vtk.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 from argparse import ArgumentParser
 import sys
-import math
-import csv
-import os
+import tempfile
+import threading
+
+from bundle import open_bundle
+from case_views import CaseViews
+from climate_cache import ClimateCache, climate_layer_name
+from colormaps import PALETTES, palette_lookup_table, set_palette
+from instrumentation import Profiler, add_profiler_arguments
+from locations import open_location_registry
+from maxima import MaximaIndex
+from metrics import METRICS, MetricEngine, add_metric_arguments, legend_text, legend_values, read_population_table
+from migration_flows import MigrationLevels
+from migration_index import LEVELS
+from migration_ingest import load_flow_table
+from projection import PROJECTIONS, Projection, add_projection_arguments, set_map_surface
+from offscreen import add_export_arguments, export_dates, export_frames, export_frames_parallel, load_camera_settings
+from raster_layers import RasterLayer, watch_raster_layers
+from raster_pyramid import RasterPyramid, valid_mask
+from raster_store import image_values, open_raster_store, raster_lookup_table
+from rollup import Rollup, add_granularity_arguments
+from scene_loader import SceneLoader
+from time_series import CovidDataWatcher, load_covid_arrays, load_covid_data, save_covid_arrays
+
+# Qt is only needed for the interactive window, --export renders without it
+try:
+    from PyQt5.QtWidgets import QApplication, QWidget, QMainWindow, QSlider, QGridLayout, QLabel, QPushButton, QTextEdit, QCheckBox, QComboBox, QSpinBox
+    import PyQt5.QtCore as QtCore
+    from PyQt5.QtCore import Qt
+    from vtk.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
+except ImportError:
+    QApplication = None
 
 frame_counter = 3
 initial_date = datetime.date(2020, 1, 22)
@@ -28,76 +52,34 @@ infections_opacity = 0.6
 recovered_opacity = 0.6
 deaths_opacity = 0.6
 
-infections_data = []
-recovered_data = []
-deaths_data = []
+covid_data = None
+maxima = None
+scale_window = None
+case_layer = None
 
+legend_circle_sources = []
 legend_circle_actors = []
 legend_text_actors = []
 
-max_weight = 0
-
 ren = None
 
+# Draw order of the actor groups of the scene
+SCENE_ORDER = ("rasters", "legend", "cases", "migration", "satellite", "overlay")
+
 def compute_max(date):
-    maximum = 0
-    for i in range(len(infections_data)):
-        if(int(infections_data[i][date+2]) > maximum):
-            maximum = int(infections_data[i][date+2])
-
-    for i in range(len(recovered_data)):
-        if(int(recovered_data[i][date+2]) > maximum):
-            maximum = int(recovered_data[i][date+2])
-
-    for i in range(len(deaths_data)):
-        if(int(deaths_data[i][date+2]) > maximum):
-            maximum = int(deaths_data[i][date+2])
-    
-    return maximum
-
-def add_case_actors(date, data, actors, color, opacity):
-    for i in range(len(data)):
-
-        x = (sat_x / 360.0) * (180 + float(data[i][1]))
-        y = (sat_y / 180.0) * (90 + float(data[i][0]))
-        cases = int(data[i][date+2])
-
-        if(cases > 0 and (float(data[i][1]) != 0 or float(data[i][0]) != 0)):
-            radius = (math.log2(cases)/math.log2(max_cases)) * max_radius 
-            polygon_source = vtk.vtkRegularPolygonSource()
-            polygon_source.SetNumberOfSides(50)
-            polygon_source.SetRadius(radius)
-            polygon_source.SetCenter(x, y, 0)
-
-            cases_mapper = vtk.vtkPolyDataMapper()
-            cases_mapper.SetInputConnection(polygon_source.GetOutputPort())
-
-            cases_actor = vtk.vtkActor()
-            cases_actor.SetMapper(cases_mapper)
-            cases_actor.GetProperty().SetColor(color[0], color[1], color[2])
-            cases_actor.GetProperty().SetOpacity(opacity)
-
-            ren.AddActor(cases_actor)
-            actors.append(cases_actor)
-
-def remove_case_actors(actors):
-    for i in range(len(actors)):
-        ren.RemoveActor(actors[i])
-    actors = []
-
-def remove_legend_actors():
-    for i in range(len(legend_circle_actors)):
-        ren.RemoveActor(legend_circle_actors[i])
-        ren.RemoveActor(legend_text_actors[i])
-
-def add_legend_actors():
+    return maxima.max_for_date(date, scale_window)
+
+def update_legend_actors(metric="cumulative"):
   # TODO: Potentially change scale to use hardcoded values (e.g., 5, 10, 50, 100, 500, 1000....) and pick 4 evenly spaced values from this list (all parts of this list smaller than the max_cases)
+  for i, (cases, fraction) in enumerate(legend_values(max_cases, metric, len(legend_circle_sources))):
+      radius = fraction * max_radius/3.8
+      legend_circle_sources[i].SetRadius(radius)
+      legend_text_actors[i].SetInput(legend_text(cases, metric))
+
+def add_legend_actors(metric="cumulative"):
   for i in range(4):
-      cases = math.pow(2, (math.log2(max_cases) / (i+1)))
-      radius = (math.log2(cases)/math.log2(max_cases)) * max_radius/3.8
       legend_polygon_source = vtk.vtkRegularPolygonSource()
       legend_polygon_source.SetNumberOfSides(50)
-      legend_polygon_source.SetRadius(radius)
       legend_polygon_source.SetCenter(0, 0, 0)
 
       circle_mapper = vtk.vtkPolyDataMapper2D()
@@ -110,352 +92,502 @@ def add_legend_actors():
       circle_actor.GetPositionCoordinate().SetValue(.05, .1 + .075 * i)
 
       text_actor = vtk.vtkTextActor()
-      text_actor.SetInput(str(int(cases)) + " cases")
 
       text_actor.GetPositionCoordinate().SetCoordinateSystemToNormalizedViewport()
       text_actor.GetPositionCoordinate().SetValue(.075, .1 + .075 * i)
       text_actor.GetTextProperty().SetFontSize(25)
 
       ren.AddActor(circle_actor)
+      legend_circle_sources.append(legend_polygon_source)
       legend_circle_actors.append(circle_actor)
       ren.AddActor(text_actor)
       legend_text_actors.append(text_actor)
 
-def create_long_lat(file):
-    table = {}
-    with open(file) as csvDataFile:
-        csv_reader = csv.reader(csvDataFile)
-        for row in csv_reader:
-            try:
-                table[row[0]] = [float(row[4]), float(row[5])]
-            except ValueError:
-                continue
-    return table
-
-
-def add_migration_info(loc_src, loc_dst, weight):
-    global max_weight
-
-    x1 = (sat_x / 360.0) * (180 + float(loc_src[1]))
-    y1 = (sat_y / 180.0) * (90 + float(loc_src[0]))
-
-    x2 = (sat_x / 360.0) * (180 + float(loc_dst[1]))
-    y2 = (sat_y / 180.0) * (90 + float(loc_dst[0]))
-
-    if weight > max_weight:
-        max_weight = weight
-
-    return {"x1": x1, "x2": x2, "y1": y1, "y2": y2, "weight": weight}
-
-def process_migration_actors(migrations):
-    line_actors = []
-
-    for migration in migrations:
-        x1 = migration.get("x1")
-        y1 = migration.get("y1")
-        x2 = migration.get("x2")
-        y2 = migration.get("y2")
-        weight = migration.get("weight")
-
-        if weight < 0.05 * max_weight:
-            continue
-
-        line_source = vtk.vtkLineSource()
-        line_source.SetPoint1(x1, y1, 0)
-        line_source.SetPoint2(x2, y2, 0)
+  update_legend_actors(metric)
+
+class Scene(object):
+    # Every VTK object of the visualization, kept apart from the Qt window so
+    # that the same scene can be shown interactively or rendered offscreen.
+    # The satellite map is built right away, the case glyphs, migration
+    # flows and rasters are stages whose data can be loaded on worker
+    # threads and attached later, see SceneLoader. `load=False` leaves the
+    # stages to the caller
+    def __init__(self, args, load=True):
+        global sat_x
+        global sat_y
+        global scale_window
+        global ren
+
+        self.args = args
+        self.curr_month = initial_date.month.real
+        self.case_visible = {"infections": True, "recovered": True, "deaths": True}
+        self.numDates = 0
+        self.watcher = None
+        self.locations = None
+        self.locations_lock = threading.Lock()
+
+        # Case circles per JHU row, country or continent and of a metric of
+        # the counts, see set_view
+        self.granularity = getattr(args, "granularity", "province")
+        self.metric = getattr(args, "metric", "cumulative")
+        self.views = None
+
+        # Stage timings go to the trace file and the overlay when requested
+        self.profiler = Profiler(getattr(args, "trace", None), getattr(args, "stats_overlay", False))
+
+        # Every layer is drawn through the same projection, see set_projection
+        self.projection = Projection(getattr(args, "projection", "equirectangular"), getattr(args, "projection_center", None))
+
+        # A bundle holds every input already parsed, the arrays are mapped from it
+        self.bundle = open_bundle(args.bundle)
+        scale_window = args.scale_window
+
+        # Layers of the stages, None until attached
+        self.migration_layer = None
+        self.density_layer = None
+        self.climate_max_layer = None
+        self.climate_min_layer = None
+        self.density_actor = None
+        self.climate_max_actor = None
+        self.climate_min_actor = None
+        self.scene_actors = {}
+
+        with self.profiler.stage("load satellite"):
+            if self.bundle:
+                sat_image = self.bundle.satellite_image()
+            else:
+                sat_reader = vtk.vtkJPEGReader()
+                sat_reader.SetFileName(args.sat)
+                sat_reader.Update()
+                sat_image = sat_reader.GetOutput()
+        sat_dimensions = sat_image.GetDimensions()
+        sat_x = sat_dimensions[0]
+        sat_y = sat_dimensions[1]
+
+        # Create a plane to map the satellite image onto
+        plane = vtk.vtkPlaneSource()
+        plane.SetCenter(0.0, 0.0, 0.0)
+        plane.SetNormal(0.0, 0.0, 1.0)
+        plane.SetPoint1(sat_x, 0, 0)
+        plane.SetPoint2(0, sat_y, 0)
+
+        # Create satellite image texture
+        texture = vtk.vtkTexture()
+        texture.SetInputData(sat_image)
+
+        # Map satellite texture to plane
+        texturePlane = vtk.vtkTextureMapToPlane()
+        texturePlane.SetInputConnection(plane.GetOutputPort())
+
+        # Palettes are filled into the tables in one go and can be swapped later, see set_palette
+        self.color_count = 1000
+        self.density_lut = palette_lookup_table(args.density_palette, self.color_count, transparent_first=True)
+        self.climate_lut = palette_lookup_table(args.climate_palette, self.color_count)
+
+        # Value ranges of the climate layers, the climate scalar bar shows the
+        # one of the visible layer, see set_climate_bar
+        self.climate_ranges = {"max": [-40, 45], "min": [-50, 30]}
+        self.climate_bar = "max"
+
+        # Create mappers
+        self.sat_plane = texturePlane
+        self.sat_mapper = vtk.vtkPolyDataMapper()
+        set_map_surface(self.sat_mapper, self.projection, [0, sat_x, 0, sat_y], texturePlane.GetOutputPort())
+
+        sat_actor = vtk.vtkActor()
+        sat_actor.SetMapper(self.sat_mapper)
+        sat_actor.SetTexture(texture)
+        sat_actor.GetProperty().SetOpacity(0.6)
+
+        # Initialize renderer and place actors
+        ren = vtk.vtkRenderer()
+        self.profiler.watch(ren)
+        self.add_scene_actors("overlay", self.profiler.actors())
+        self.add_scene_actors("satellite", [sat_actor])
+        ren.SetBackground(0, 0, 0)
+
+        # Initialize camera settings, framed on the satellite map so that
+        # attaching the stages does not move it
+        ren.ResetCamera(sat_actor.GetBounds())
+        cam1 = ren.GetActiveCamera()
+        cam1.Azimuth(0)
+        cam1.Elevation(0)
+        cam1.Roll(360)
+        cam1.Zoom(1.5)
+
+        ren.ResetCameraClippingRange()
+
+        if args.camera:
+            load_camera_settings(cam1, args.camera)
+
+        if load:
+            SceneLoader(self.stages(), log=lambda message: None).wait()
+
+    def stages(self):
+        stages = [("case glyphs", self.load_cases, self.attach_cases),
+                  ("migration flows", self.load_migration, self.attach_migration),
+                  ("rasters", self.load_rasters, self.attach_rasters)]
+        return [(name, self.profiler.timed("load " + name, load), self.profiler.timed("attach " + name, attach))
+                for name, load, attach in stages]
+
+    def add_scene_actors(self, name, actors):
+        # Actors are drawn in SCENE_ORDER whichever stage is attached first,
+        # the map layers all lie in the same plane
+        self.scene_actors[name] = actors
+        ren.RemoveAllViewProps()
+        for stage in SCENE_ORDER:
+            for actor in self.scene_actors.get(stage, []):
+                ren.AddActor(actor)
+
+    def load_cases(self):
+        # Read in the confirmed, recovered and deaths time series, export
+        # workers map the arrays already parsed by the parent process
+        if self.bundle:
+            data = self.bundle.covid_data()
+        elif getattr(self.args, "shared_data", None):
+            data = load_covid_arrays(self.args.shared_data)
+        else:
+            # The files are stamped before they are read, so a change during the read is not missed
+            paths = {"infections": self.args.infections, "recovered": self.args.recovered, "deaths": self.args.deaths}
+            self.watcher = CovidDataWatcher(paths) if getattr(self.args, "refresh", None) else None
+            data = load_covid_data(paths["infections"], paths["recovered"], paths["deaths"])
+
+        # Sum the rows per country and continent once, and compute the first
+        # metric and index its per-date maxima so that the slider only does lookups
+        if self.bundle:
+            registry = self.bundle.location_registry()
+        else:
+            registry = self.load_locations()[0]
+        rollup = Rollup(data, registry)
+        population = None
+        if getattr(self.args, "population", None):
+            population = read_population_table(self.args.population, registry)
+        engine = MetricEngine(rollup.covid_data(self.granularity), population)
+        return rollup, population, engine, MaximaIndex(engine.get(self.metric), [scale_window] if scale_window else [])
+
+    def attach_cases(self, cases):
+        rollup, population, engine, view_maxima = cases
+        self.numDates = rollup.source.num_dates - 1
+
+        # Add infections, recovered, and deaths circles as a single glyph layer
+        case_styles = {"infections": (infections_color, infections_opacity),
+                       "recovered": (recovered_color, recovered_opacity),
+                       "deaths": (deaths_color, deaths_opacity)}
+        self.views = CaseViews(rollup, population, (case_styles, sat_x, sat_y, max_radius), self.projection,
+                               [scale_window] if scale_window else [])
+        self.views.add(self.granularity, self.metric, engine, view_maxima)
+        self.use_view(self.granularity, self.metric)
+
+        # Add legend actors
+        add_legend_actors(self.metric)
+        self.add_scene_actors("legend", [actor for pair in zip(legend_circle_actors, legend_text_actors) for actor in pair])
+        self.add_scene_actors("cases", [case_layer.actor])
+
+    def use_view(self, granularity, metric):
+        # Draw `metric` of the rollup at `granularity`. The glyph layer of a
+        # granularity and the metrics and maxima shown before are reused
+        global covid_data
+        global maxima
+        global max_cases
+        global case_layer
 
-        line_mapper = vtk.vtkPolyDataMapper()
-        line_mapper.SetInputConnection(line_source.GetOutputPort())
+        covid_data, maxima, case_layer = self.views.view(granularity, metric)
+        self.granularity = granularity
+        self.metric = metric
+        max_cases = compute_max(date)
+        self.update_cases()
+
+    def set_view(self, granularity, metric):
+        with self.profiler.stage("view"):
+            self.use_view(granularity, metric)
+            self.add_scene_actors("cases", [case_layer.actor])
+        with self.profiler.stage("legend"):
+            update_legend_actors(metric)
+
+    def set_granularity(self, granularity):
+        self.set_view(granularity, self.metric)
+
+    def set_metric(self, metric):
+        self.set_view(self.granularity, metric)
+
+    def next_granularity(self):
+        granularities = self.views.rollup.granularities
+        return granularities[(granularities.index(self.granularity) + 1) % len(granularities)]
+
+    def load_locations(self):
+        # The location registry and the migration flow table, read once by
+        # whichever of the case and migration stages asks first: the UN
+        # tables give both the flows and the continents of the case rollup
+        with self.locations_lock:
+            if self.locations is None:
+                registry = open_location_registry(self.args.location)
+                self.locations = (registry, load_flow_table(self.args.migration, registry))
+            return self.locations
+
+    def load_migration(self):
+        # Read in data for migration
+        if self.bundle:
+            return self.bundle.flow_table()
+        return self.load_locations()[1]
+
+    def attach_migration(self, migration_table):
+        args = self.args
+
+        # Country flows are drawn zoomed in and flows summed per origin region zoomed out
+        self.migration_layer = MigrationLevels(migration_table, args.migration_level, args.migration_overview, sat_x, sat_y,
+                                               lambda weight: 0.2 + 0.79 * weight, args.migration_threshold, args.migration_top, 2,
+                                               self.projection)
+        self.add_scene_actors("migration", self.migration_layer.actors())
+        self.migration_layer.watch(ren)
+
+    def load_rasters(self):
+        args = self.args
+
+        # Preprocessed rasters are mapped from the raster cache instead of decoding the GeoTIFFs
+        raster_store = None
+        if self.bundle:
+            raster_store = self.bundle
+        elif args.raster_cache:
+            raster_store = open_raster_store(args.raster_cache, args.density, [args.climate_max, args.climate_min])
+        if raster_store:
+            density_image = raster_store.image("density")
+            density_range = raster_store.scalar_range("density")
+            density_valid = None
+        else:
+            # Create reader for density file
+            density_reader = vtk.vtkTIFFReader()
+            density_reader.SetFileName(args.density)
+            density_reader.Update()
+
+            density_log = vtk.vtkImageLogarithmicScale()
+            density_log.SetInputConnection(density_reader.GetOutputPort())
+            density_log.SetConstant(0.435)
+            density_log.Update()
+            density_image = density_log.GetOutput()
+            density_range = density_image.GetScalarRange()
+            # The log scale turns the nodata cells into ordinary negative values
+            density_valid = valid_mask(image_values(density_reader.GetOutput()))
+
+        # Rasters are drawn from a pyramid of downsampled levels picked by the zoom
+        density_pyramid = RasterPyramid(density_image, density_valid)
+
+        # Decoded climate months are cached, so changing month only swaps the mapper inputs
+        climate_cache = ClimateCache({"max": args.climate_max, "min": args.climate_min},
+                                     args.climate_cache, not args.no_prefetch, raster_store, RasterPyramid)
+        climate_cache.get("max", self.curr_month)
+        climate_cache.get("min", self.curr_month)
+        return raster_store, density_pyramid, density_range, climate_cache
+
+    def attach_rasters(self, rasters):
+        self.raster_store, density_pyramid, self.density_range, self.climate_cache = rasters
+        density_lut, climate_max_lut, climate_min_lut = self.raster_tables()
+
+        # Density and climate are textures on planes covering the satellite image
+        self.density_layer = RasterLayer(density_pyramid, density_lut, [0, sat_x, 0, sat_y], 0.99, self.projection)
+        self.density_actor = self.density_layer.actor
+        self.density_actor.VisibilityOn()
+
+        self.climate_max_layer = RasterLayer(self.climate_cache.get("max", self.curr_month), climate_max_lut,
+                                             [0, sat_x, 0, sat_y], 0.6, self.projection)
+        self.climate_max_actor = self.climate_max_layer.actor
+        self.climate_max_actor.VisibilityOff()
+
+        self.climate_min_layer = RasterLayer(self.climate_cache.get("min", self.curr_month), climate_min_lut,
+                                             [0, sat_x, 0, sat_y], 0.6, self.projection)
+        self.climate_min_actor = self.climate_min_layer.actor
+        self.climate_min_actor.VisibilityOff()
+
+        self.add_scene_actors("rasters", [self.density_actor, self.climate_max_actor, self.climate_min_actor])
+
+        # Swap the raster levels before every render
+        watch_raster_layers(ren, [self.density_layer, self.climate_max_layer, self.climate_min_layer])
+
+    def raster_tables(self):
+        # Tables of the density, climate max and climate min layers derived
+        # from the palette tables, which keep the value ranges for the scalar bars
+        self.density_lut.SetTableRange(0, self.density_range[1])
+        self.set_climate_bar(self.climate_bar)
+        return (raster_lookup_table(self.density_lut, [0, self.density_range[1]], self.raster_store, "density"),
+                raster_lookup_table(self.climate_lut, self.climate_ranges["max"], self.raster_store,
+                                    climate_layer_name(self.args.climate_max, self.curr_month)),
+                raster_lookup_table(self.climate_lut, self.climate_ranges["min"], self.raster_store,
+                                    climate_layer_name(self.args.climate_min, self.curr_month)))
+
+    def set_climate_bar(self, name):
+        # Give the climate scalar bar the range of the "max" or "min" layer
+        self.climate_bar = name
+        self.climate_lut.SetTableRange(self.climate_ranges[name])
+
+    def set_palette(self, raster, name):
+        # Swap the palette of the "density" or "climate" rasters, the layers
+        # only get new tables
+        with self.profiler.stage("palette"):
+            if raster == "density":
+                set_palette(self.density_lut, name, transparent_first=True)
+            else:
+                set_palette(self.climate_lut, name)
+            if self.density_layer is not None:
+                for layer, lut in zip([self.density_layer, self.climate_max_layer, self.climate_min_layer], self.raster_tables()):
+                    layer.set_lookup_table(lut)
+
+    def set_projection(self, name, center=None):
+        # Re-project the satellite map, the rasters and every attached layer
+        # in place, positions of projections seen before come from the cache
+        with self.profiler.stage("projection"):
+            self.projection.set_projection(name, center)
+            set_map_surface(self.sat_mapper, self.projection, [0, sat_x, 0, sat_y], self.sat_plane.GetOutputPort())
+            if self.density_layer is not None:
+                for layer in (self.density_layer, self.climate_max_layer, self.climate_min_layer):
+                    layer.set_projection(self.projection)
+            if self.migration_layer is not None:
+                self.migration_layer.set_projection(self.projection)
+            if case_layer is not None:
+                case_layer.set_projection(self.projection)
+                self.update_cases()
+
+    def refresh(self):
+        # Append the dates the JHU files gained, True when there were any
+        if self.watcher is None or self.views is None or not self.views.refresh(self.watcher):
+            return False
+        # The layer is a new one when the series gained or lost rows
+        self.use_view(self.granularity, self.metric)
+        self.add_scene_actors("cases", [case_layer.actor])
+        self.numDates = covid_data.num_dates - 1
+        self.set_date(min(date, self.numDates))
+        return True
+
+    def update_cases(self):
+        if case_layer is not None:
+            case_layer.update(date, max_cases, self.case_visible)
+
+    def set_case_visible(self, name, visible):
+        self.case_visible[name] = visible
+        with self.profiler.stage("cases"):
+            self.update_cases()
+
+    def set_migration_visible(self, visible):
+        self.migration_layer.set_visible(visible)
+
+    def set_migration_threshold(self, fraction):
+        with self.profiler.stage("migration"):
+            self.migration_layer.set_threshold(fraction)
+
+    def set_migration_top(self, count):
+        with self.profiler.stage("migration"):
+            self.migration_layer.set_top(count)
+
+    def set_date(self, val):
+        global max_cases
+        global date
+        date = val
+        new_date = initial_date + timedelta(val)
+        if new_date.month.real != self.curr_month:
+            self.curr_month = new_date.month.real
+            if self.climate_max_layer is not None:
+                with self.profiler.stage("climate"):
+                    self.climate_max_layer.set_pyramid(self.climate_cache.get("max", self.curr_month))
+                    self.climate_min_layer.set_pyramid(self.climate_cache.get("min", self.curr_month))
 
-        line_actor = vtk.vtkActor()
-        line_actor.SetMapper(line_mapper)
-        line_actor.GetProperty().SetColor(1, 1, 1)
-        line_actor.GetProperty().SetOpacity(0.2 + 0.79 * (weight / max_weight))
-        line_actor.GetProperty().SetLineWidth(2)
+        # Recompute max cases
+        if case_layer is None:
+            return
+        with self.profiler.stage("maxima"):
+            max_cases = compute_max(date)
 
-        line_actors.append(line_actor)
+        # Update infections, recovered, and deaths circles and the legend in place
+        with self.profiler.stage("cases"):
+            self.update_cases()
+        with self.profiler.stage("legend"):
+            update_legend_actors(self.metric)
 
-    return line_actors
+def build_export_scene(args):
+    scene = Scene(args)
+    return ren, scene.set_date
 
 def main():
     # Initialize argument and constant variables
     parser = ArgumentParser("Create isosurfacing of object")
-    parser.add_argument("infections")
-    parser.add_argument("recovered")
-    parser.add_argument("deaths")
-    parser.add_argument("density")
-    parser.add_argument("climate_max")
-    parser.add_argument("climate_min")
-    parser.add_argument("location")
-    parser.add_argument("migration")
-    parser.add_argument("sat")
+    parser.add_argument("infections", nargs = "?")
+    parser.add_argument("recovered", nargs = "?")
+    parser.add_argument("deaths", nargs = "?")
+    parser.add_argument("density", nargs = "?")
+    parser.add_argument("climate_max", nargs = "?")
+    parser.add_argument("climate_min", nargs = "?")
+    parser.add_argument("location", nargs = "?")
+    parser.add_argument("migration", nargs = "?")
+    parser.add_argument("sat", nargs = "?")
+    parser.add_argument("--bundle", type = str, help = "Dataset bundle written by bundle.py build, replaces the nine inputs")
+    parser.add_argument("--refresh", type = float, help = "Check the time series files every this many seconds and append new dates")
     parser.add_argument("--camera", type = str, help = "Optional camera settings file")
+    parser.add_argument("--scale-window", type = int, help = "Optional number of days over which the circle scale uses the largest count")
+    parser.add_argument("--climate-cache", type = int, default = 6, help = "Number of decoded climate months kept in memory")
+    parser.add_argument("--no-prefetch", action = "store_true", help = "Do not decode the adjacent climate months in the background")
+    parser.add_argument("--raster-cache", type = str, help = "Directory of preprocessed rasters, filled on first use")
+    parser.add_argument("--density-palette", type = str, default = "density", choices = sorted(PALETTES), help = "Color palette of the density raster")
+    parser.add_argument("--climate-palette", type = str, default = "climate", choices = sorted(PALETTES), help = "Color palette of the climate rasters")
+    parser.add_argument("--migration-threshold", type = float, default = 0.05, help = "Hide migration flows below this fraction of the largest flow")
+    parser.add_argument("--migration-top", type = int, help = "Only draw this many of the largest migration flows, instead of a threshold")
+    parser.add_argument("--migration-level", type = str, default = "auto", choices = ("auto",) + LEVELS, help = "Draw migration flows per country, summed per origin region, or pick by zoom")
+    parser.add_argument("--migration-overview", type = str, default = "subregion", choices = LEVELS[1:], help = "Origin regions of the zoomed out migration flows")
+    add_export_arguments(parser)
+    add_profiler_arguments(parser)
+    add_projection_arguments(parser)
+    add_granularity_arguments(parser)
+    add_metric_arguments(parser)
 
     args = parser.parse_args()
-
-    global sat_x
-    global sat_y
-    global max_cases
-    global max_radius
-
-    global infections_color
-    global recovered_color
-    global deaths_color
-
-    global infections_opacity
-    global recovered_opacity
-    global deaths_opacity
-
-    global infections_data
-    global recovered_data
-    global deaths_data
-
-    global legend_circle_actors
-    global legend_text_actors
-
-    global max_weight
-
-    global ren
+    inputs = [args.infections, args.recovered, args.deaths, args.density, args.climate_max, args.climate_min,
+              args.location, args.migration, args.sat]
+
+    # Climate layers in a bundle are named after the paths it was built from
+    bundle = open_bundle(args.bundle)
+    if bundle:
+        args.climate_max = bundle.climate_path("max")
+        args.climate_min = bundle.climate_path("min")
+    elif None in inputs:
+        parser.error("the nine inputs are required without --bundle")
+    if bundle and args.refresh:
+        parser.error("--refresh watches the time series files, it cannot be used with --bundle")
+    if args.trace and args.export and args.workers > 1:
+        parser.error("--trace times a single process, export with --workers 1")
+    if args.metric == "per-capita" and not args.population:
+        parser.error("--metric per-capita needs --population")
+
+    # Fill the raster cache once here so that export workers only map it
+    if args.raster_cache and not bundle:
+        open_raster_store(args.raster_cache, args.density, [args.climate_max, args.climate_min])
+
+    # Render the requested dates offscreen and exit without opening a window,
+    # workers map the bundle themselves
+    if args.export and args.workers > 1 and bundle:
+        dates = export_dates(bundle.covid_data().num_dates, args.start, args.end, args.stride)
+        export_frames_parallel(build_export_scene, args, dates)
+        return
+    if args.export and args.workers > 1:
+        data = load_covid_data(args.infections, args.recovered, args.deaths)
+        dates = export_dates(data.num_dates, args.start, args.end, args.stride)
+        with tempfile.TemporaryDirectory() as shared_data:
+            save_covid_arrays(data, shared_data)
+            args.shared_data = shared_data
+            export_frames_parallel(build_export_scene, args, dates)
+        return
+    if args.export:
+        scene = Scene(args)
+        export_frames(ren, scene.set_date, export_dates(scene.numDates + 1, args.start, args.end, args.stride), args,
+                      profiler=scene.profiler)
+        scene.profiler.close()
+        return
+
+    if QApplication is None:
+        raise ImportError("PyQt5 is required for the interactive window, use --export to render offscreen")
 
     app = QApplication([])
     window = QMainWindow()
     ui = Ui_MainWindow()
     ui.setupUi(window)
 
-    # Read in data for global confirmed cases
-    with open(args.infections) as csvDataFile:
-        csv_reader = csv.reader(csvDataFile)
-        for row in csv_reader:
-            # We do not need country/province name, so we remove the first two columns
-            if(row[2] != 0 or row[3] != 0):
-                infections_data.append(row[2:])
-    infections_data = infections_data[1:]
-
-    # Read in data for global deaths
-    with open(args.deaths) as csvDataFile:
-        csv_reader = csv.reader(csvDataFile)
-        for row in csv_reader:
-            if(row[2] != 0 or row[3] != 0):
-                deaths_data.append(row[2:])
-    deaths_data = deaths_data[1:]
-
-    # Read in data for global recovered cases
-    with open(args.recovered) as csvDataFile:
-        csv_reader = csv.reader(csvDataFile)
-        for row in csv_reader:
-            if(row[2] != 0 or row[3] != 0):    
-                recovered_data.append(row[2:])
-    recovered_data = recovered_data[1:]
-
-    numDates = len(infections_data[0]) - 3
-    max_cases = compute_max(date)
-
-    # Create reader for density file
-    density_reader = vtk.vtkTIFFReader()
-    density_reader.SetFileName(args.density)
-    density_reader.Update()
-
-    density_log = vtk.vtkImageLogarithmicScale()
-    density_log.SetInputConnection(density_reader.GetOutputPort())
-    density_log.SetConstant(0.435)
-    density_log.Update()
-    density_range = density_log.GetOutput().GetScalarRange()
-
-    climate_max_reader = vtk.vtkTIFFReader()
-    climate_max_reader.SetFileName(args.climate_max + "-" + str(initial_date.month.real).zfill(2) + ".tif")
-    climate_max_reader.Update()
-    climate_max_range = [-40, 45]
-
-    climate_min_reader = vtk.vtkTIFFReader()
-    climate_min_reader.SetFileName(args.climate_min + "-" + str(initial_date.month.real).zfill(2) + ".tif")
-    climate_min_reader.Update()
-    climate_min_range = [-50, 30]
-
-    sat_reader = vtk.vtkJPEGReader()
-    sat_reader.SetFileName(args.sat)
-    sat_reader.Update()
-    sat_dimensions = sat_reader.GetOutput().GetDimensions()
-    sat_x = sat_dimensions[0]
-    sat_y = sat_dimensions[1]
-
-    # Read in data for migration
-    location_map = create_long_lat(args.location)
-    migrations = []
-    for filename in os.listdir(args.migration):
-        if filename.endswith(".csv"):
-            with open(args.migration + "\\" + filename) as csvDataFile:
-                country = filename.split(".")[0]
-                if country not in location_map:
-                    continue
-                loc_dst = location_map[country]
-                csv_reader = csv.reader(csvDataFile)
-                for row in csv_reader:
-                    if row[2] not in location_map:
-                        continue
-                    loc_src = location_map[row[2]]
-                    try:
-                        migrations.append(add_migration_info(loc_src, loc_dst, int(row[9])))
-                    except ValueError:
-                        continue
-
-    line_actors = process_migration_actors(migrations)
-
-    # Create a plane to map the satellite image onto
-    plane = vtk.vtkPlaneSource()
-    plane.SetCenter(0.0, 0.0, 0.0)
-    plane.SetNormal(0.0, 0.0, 1.0)
-    plane.SetPoint1(sat_x, 0, 0)
-    plane.SetPoint2(0, sat_y, 0)
-
-    # Create satellite image texture
-    texture = vtk.vtkTexture()
-    texture.SetInputConnection(sat_reader.GetOutputPort())
-
-    # Map satellite texture to plane
-    texturePlane = vtk.vtkTextureMapToPlane()
-    texturePlane.SetInputConnection(plane.GetOutputPort())
-
-    max_val = 100
-    color_count = 1000
-
-    density_ctf = vtk.vtkColorTransferFunction()
-    density_ctf.AddRGBPoint(0, 0, 0, 0)
-    density_ctf.AddRGBPoint(10, 0, 0, 1)
-    density_ctf.AddRGBPoint(30, 0, 1, 1)
-    density_ctf.AddRGBPoint(50, 1, 1, 0)
-    density_ctf.AddRGBPoint(65, 1, 0.5, 0)
-    density_ctf.AddRGBPoint(80, 1, 0, 0)
-
-    density_lut = vtk.vtkLookupTable()
-    density_lut.SetNumberOfTableValues(color_count)
-    density_lut.Build()
-
-    rgb = list(density_ctf.GetColor(0))+[0]
-    density_lut.SetTableValue(0, rgb)
-    for i in range(1, color_count):
-        rgb = list(density_ctf.GetColor(max_val * float(i)/color_count))+[1]
-        density_lut.SetTableValue(i, rgb)
-
-    climate_ctf = vtk.vtkColorTransferFunction()
-    climate_ctf.AddRGBPoint(5, 0, 0, 1)
-    climate_ctf.AddRGBPoint(35, 0, 1, 1)
-    climate_ctf.AddRGBPoint(65, 1, 1, 0)
-    climate_ctf.AddRGBPoint(95, 1, 0, 0)
-
-    climate_lut = vtk.vtkLookupTable()
-    climate_lut.SetNumberOfTableValues(color_count)
-    climate_lut.Build()
-
-    for i in range(0, color_count):
-        rgb = list(climate_ctf.GetColor(max_val * float(i)/color_count))+[1]
-        climate_lut.SetTableValue(i, rgb)
-    
-    # Create mappers
-    density_mapper = vtk.vtkDataSetMapper()
-    density_mapper.SetInputConnection(density_log.GetOutputPort())
-    density_mapper.SetLookupTable(density_lut)
-    density_mapper.SetScalarRange([0, density_range[1]])
-    density_mapper.Update()
-
-    climate_max_mapper = vtk.vtkDataSetMapper()
-    climate_max_mapper.SetInputConnection(climate_max_reader.GetOutputPort())
-    climate_max_mapper.SetLookupTable(climate_lut)
-    climate_max_mapper.SetScalarRange(climate_max_range)
-    climate_max_mapper.Update()
-
-    climate_min_mapper = vtk.vtkDataSetMapper()
-    climate_min_mapper.SetInputConnection(climate_min_reader.GetOutputPort())
-    climate_min_mapper.SetLookupTable(climate_lut)
-    climate_min_mapper.SetScalarRange(climate_min_range)
-    climate_min_mapper.Update()
-
-    sat_mapper = vtk.vtkPolyDataMapper()
-    sat_mapper.SetInputConnection(texturePlane.GetOutputPort())
-
-    density_actor = vtk.vtkActor()
-    density_actor.SetMapper(density_mapper)
-    density_actor.GetProperty().SetOpacity(0.99)
-    density_actor.VisibilityOn()
-
-    climate_max_actor = vtk.vtkActor()
-    climate_max_actor.SetMapper(climate_max_mapper)
-    climate_max_actor.GetProperty().SetOpacity(0.6)
-    climate_max_actor.VisibilityOff()
-
-    climate_min_actor = vtk.vtkActor()
-    climate_min_actor.SetMapper(climate_min_mapper)
-    climate_min_actor.GetProperty().SetOpacity(0.6)
-    climate_min_actor.VisibilityOff()
-
-    sat_actor = vtk.vtkActor()
-    sat_actor.SetMapper(sat_mapper)
-    sat_actor.SetTexture(texture)
-    sat_actor.GetProperty().SetOpacity(0.6)
-
-    # Make satellite image same size as contour map
-    crange = sat_actor.GetXRange()[0] - sat_actor.GetXRange()[1]
-    mrange = density_actor.GetXRange()[0] - density_actor.GetXRange()[1]
-    density_actor.SetScale(crange/mrange)
-
-    crange = sat_actor.GetXRange()[0] - sat_actor.GetXRange()[1]
-    mrange = climate_max_actor.GetXRange()[0] - climate_max_actor.GetXRange()[1]
-    climate_max_actor.SetScale(crange/mrange)
-    climate_min_actor.SetScale(crange/mrange)
-
-    # Initialize renderer and place actors
-    ren = vtk.vtkRenderer()
-
-    ren.AddActor(density_actor)
-    ren.AddActor(climate_max_actor)
-    ren.AddActor(climate_min_actor)
-
-    # Add legend actors
-    add_legend_actors()
-
-    # Add infections, recovered, and deaths actors
-    infections_actors = []
-    if(ui.infections_check.isChecked()):
-        add_case_actors(date, infections_data, infections_actors, infections_color, infections_opacity)
-
-    recovered_actors = []
-    if(ui.recovered_check.isChecked()):
-        add_case_actors(date, recovered_data, recovered_actors, recovered_color, recovered_opacity)
-
-    deaths_actors = []
-    if(ui.deaths_check.isChecked()):
-        add_case_actors(date, deaths_data, deaths_actors, deaths_color, deaths_opacity)
-
-    for line_actor in line_actors:
-        line_actor.VisibilityOn()
-        ren.AddActor(line_actor)
-
-    ren.AddActor(sat_actor)
-    ren.ResetCamera()
-    ren.SetBackground(0, 0, 0)
-
-    # Initialize camera settings
-    cam1 = ren.GetActiveCamera()
-    cam1.Azimuth(0)
-    cam1.Elevation(0)
-    cam1.Roll(360)
-    cam1.Zoom(1.5)
-
-    ren.ResetCameraClippingRange()
-
-    if args.camera:
-        reader = open(args.camera, "r")
-        line = reader.readline().split(",")
-        cam1.SetPosition(float(line[0]), float(line[1]), float(line[2]))
-        line = reader.readline().split(",")
-        cam1.SetFocalPoint(float(line[0]), float(line[1]), float(line[2]))
-        line = reader.readline().split(",")
-        cam1.SetViewUp(float(line[0]), float(line[1]), float(line[2]))
-        line = reader.readline().split(",")
-        cam1.SetClippingRange(float(line[0]), float(line[1]))
-        line = reader.readline().split(",")
-        cam1.SetViewAngle(float(line[0]))
-        line = reader.readline().split(",")
-        cam1.SetParallelScale(float(line[0]))
+    # Only the satellite map is built here, the stages load once the window shows
+    scene = Scene(args, load=False)
 
     # Initialize PyQT5 UI and link to renderer
     ui.vtkWidget.GetRenderWindow().AddRenderer(ren)
@@ -469,8 +601,8 @@ def main():
     # create the scalar_bar
     density_scalar_bar = vtk.vtkScalarBarActor()
     density_scalar_bar.SetOrientationToHorizontal()
-    density_scalar_bar.SetMaximumNumberOfColors(color_count)
-    density_scalar_bar.SetLookupTable(density_lut)
+    density_scalar_bar.SetMaximumNumberOfColors(scene.color_count)
+    density_scalar_bar.SetLookupTable(scene.density_lut)
     density_scalar_bar.SetTitle("Density (Log 10)")
 
     # create the scalar_bar_widget
@@ -482,8 +614,8 @@ def main():
     # create the scalar_bar
     climate_scalar_bar = vtk.vtkScalarBarActor()
     climate_scalar_bar.SetOrientationToHorizontal()
-    climate_scalar_bar.SetMaximumNumberOfColors(color_count)
-    climate_scalar_bar.SetLookupTable(climate_lut)
+    climate_scalar_bar.SetMaximumNumberOfColors(scene.color_count)
+    climate_scalar_bar.SetLookupTable(scene.climate_lut)
     climate_scalar_bar.SetTitle("Temparature (Celsius)")
 
     # create the scalar_bar_widget
@@ -497,71 +629,39 @@ def main():
         slider.setOrientation(QtCore.Qt.Horizontal)
         slider.setValue(float(val))
         slider.setSliderPosition(val)
-        slider.setTracking(False)
+        slider.setTracking(True)
         slider.setTickInterval(interv)
         slider.setTickPosition(QSlider.TicksAbove)
         slider.setRange(bounds[0], bounds[1])
 
-    slider_setup(ui.time_slider, 0, [0, numDates], 1)
+    slider_setup(ui.time_slider, 0, [0, scene.numDates], 1)
+    slider_setup(ui.migration_slider, round(args.migration_threshold * 1000), [0, 1000], 50)
+    ui.migration_threshold_label.setText(migration_threshold_text(args.migration_threshold))
+    ui.migration_top_spin.setValue(args.migration_top or 0)
 
     window.show()
     window.setWindowState(Qt.WindowMaximized)
     iren.Initialize()
 
     def time_slider_callback(val):
-        global max_cases
-        global date
-        date = val
+        scene.set_date(val)
         new_date = initial_date + timedelta(val)
-        if new_date.month.real != ui.curr_month:
-            ui.curr_month = new_date.month.real
-            climate_max_reader.SetFileName(args.climate_max + "-" + str(ui.curr_month).zfill(2) + ".tif")
-            climate_max_reader.Update()
-            climate_min_reader.SetFileName(args.climate_min + "-" + str(ui.curr_month).zfill(2) + ".tif")
-            climate_min_reader.Update()
         ui.date_label.setText("Date (" + new_date.strftime('%m/%d/%Y') + "):")
 
-        # Remove old infections, recovered, and deaths actors
-        remove_case_actors(infections_actors)
-        remove_case_actors(recovered_actors)
-        remove_case_actors(deaths_actors)
-        remove_legend_actors()
-
-        # Recompute max cases
-        max_cases = compute_max(date)
-
-        # Add infections, recovered, and deaths actors
-        if(ui.infections_check.isChecked()):
-            add_case_actors(date, infections_data, infections_actors, infections_color, infections_opacity)
-        if(ui.recovered_check.isChecked()):
-            add_case_actors(date, recovered_data, recovered_actors, recovered_color, recovered_opacity)
-        if(ui.deaths_check.isChecked()):
-            add_case_actors(date, deaths_data, deaths_actors, deaths_color, deaths_opacity)
-        add_legend_actors()
-
         ui.vtkWidget.GetRenderWindow().Render()
 
     def infections_callback():
-        if(ui.infections_check.isChecked()):
-            add_case_actors(date, infections_data, infections_actors, infections_color, infections_opacity)
-        else:
-            remove_case_actors(infections_actors)
+        scene.set_case_visible("infections", ui.infections_check.isChecked())
 
         ui.vtkWidget.GetRenderWindow().Render()
 
     def recovered_callback():
-        if(ui.recovered_check.isChecked()):
-            add_case_actors(date, recovered_data, recovered_actors, recovered_color, recovered_opacity)
-        else:
-            remove_case_actors(recovered_actors)
+        scene.set_case_visible("recovered", ui.recovered_check.isChecked())
 
         ui.vtkWidget.GetRenderWindow().Render()
 
     def deaths_callback():
-        if(ui.deaths_check.isChecked()):
-            add_case_actors(date, deaths_data, deaths_actors, deaths_color, deaths_opacity)
-        else:
-            remove_case_actors(deaths_actors)
+        scene.set_case_visible("deaths", ui.deaths_check.isChecked())
 
         ui.vtkWidget.GetRenderWindow().Render()
 
@@ -569,11 +669,11 @@ def main():
         if ui.density_check.isChecked():
             ui.climate_max_check.setChecked(False)
             ui.climate_min_check.setChecked(False)
-            density_actor.VisibilityOn()
+            scene.density_actor.VisibilityOn()
             density_scalar_bar_widget.On()
             ui.vtkWidget.GetRenderWindow().Render()
         else:
-            density_actor.VisibilityOff()
+            scene.density_actor.VisibilityOff()
             density_scalar_bar_widget.Off()
             ui.vtkWidget.GetRenderWindow().Render()
 
@@ -582,11 +682,12 @@ def main():
         if ui.climate_max_check.isChecked():
             ui.density_check.setChecked(False)
             ui.climate_min_check.setChecked(False)
-            climate_max_actor.VisibilityOn()
+            scene.climate_max_actor.VisibilityOn()
+            scene.set_climate_bar("max")
             climate_scalar_bar_widget.On()
             ui.vtkWidget.GetRenderWindow().Render()
         else:
-            climate_max_actor.VisibilityOff()
+            scene.climate_max_actor.VisibilityOff()
             climate_scalar_bar_widget.Off()
             ui.vtkWidget.GetRenderWindow().Render()
 
@@ -594,23 +695,53 @@ def main():
         if ui.climate_min_check.isChecked():
             ui.density_check.setChecked(False)
             ui.climate_max_check.setChecked(False)
-            climate_min_actor.VisibilityOn()
+            scene.climate_min_actor.VisibilityOn()
+            scene.set_climate_bar("min")
             climate_scalar_bar_widget.On()
             ui.vtkWidget.GetRenderWindow().Render()
         else:
-            climate_min_actor.VisibilityOff()
+            scene.climate_min_actor.VisibilityOff()
             climate_scalar_bar_widget.Off()
             ui.vtkWidget.GetRenderWindow().Render()
 
+    def granularity_callback():
+        scene.set_granularity(scene.next_granularity())
+        ui.push_granularity.setText(granularity_text(scene.granularity))
+        ui.vtkWidget.GetRenderWindow().Render()
+
+    def metric_callback(metric):
+        scene.set_metric(metric)
+        ui.vtkWidget.GetRenderWindow().Render()
+
+    def projection_callback(name):
+        scene.set_projection(name)
+        ui.vtkWidget.GetRenderWindow().Render()
+
+    def density_palette_callback(name):
+        scene.set_palette("density", name)
+        ui.vtkWidget.GetRenderWindow().Render()
+
+    def climate_palette_callback(name):
+        scene.set_palette("climate", name)
+        ui.vtkWidget.GetRenderWindow().Render()
+
     def migration_callback():
-        if ui.migration_check.isChecked():
-            for line_actor in line_actors:
-                line_actor.VisibilityOn()
-            ui.vtkWidget.GetRenderWindow().Render()
+        scene.set_migration_visible(ui.migration_check.isChecked())
+        ui.vtkWidget.GetRenderWindow().Render()
+
+    def migration_slider_callback(val):
+        scene.set_migration_threshold(val / 1000.0)
+        ui.migration_threshold_label.setText(migration_threshold_text(val / 1000.0))
+        ui.migration_top_spin.setValue(0)
+        ui.vtkWidget.GetRenderWindow().Render()
+
+    def migration_top_callback(count):
+        # 0 goes back to the threshold of the slider
+        if count:
+            scene.set_migration_top(count)
         else:
-            for line_actor in line_actors:
-                line_actor.VisibilityOff()
-            ui.vtkWidget.GetRenderWindow().Render()
+            scene.set_migration_threshold(ui.migration_slider.value() / 1000.0)
+        ui.vtkWidget.GetRenderWindow().Render()
 
     # Handle screenshot button event
     def screenshot_callback():
@@ -624,23 +755,93 @@ def main():
     def quit_callback():
         sys.exit()
 
-    # Register callbacks to UI
-    ui.time_slider.valueChanged.connect(time_slider_callback)
+    # Register callbacks to UI, the scene updates are timed as one event per callback
+    profiler = scene.profiler
+    ui.time_slider.valueChanged.connect(profiler.wrap("date", time_slider_callback))
     ui.push_screenshot.clicked.connect(screenshot_callback)
     ui.push_camera.clicked.connect(camera_callback)
     ui.push_quit.clicked.connect(quit_callback)
+    ui.push_granularity.clicked.connect(profiler.wrap("granularity", granularity_callback))
+    ui.push_granularity.setText(granularity_text(scene.granularity))
+    ui.metric_combo.addItems([metric for metric in METRICS if metric != "per-capita" or args.population])
+    ui.metric_combo.setCurrentText(scene.metric)
+    ui.metric_combo.currentTextChanged.connect(profiler.wrap("metric", metric_callback))
+    ui.projection_combo.addItems(list(PROJECTIONS))
+    ui.projection_combo.setCurrentText(scene.projection.name)
+    ui.projection_combo.currentTextChanged.connect(profiler.wrap("projection", projection_callback))
+    for combo, palette, callback in ((ui.density_palette_combo, args.density_palette, density_palette_callback),
+                                     (ui.climate_palette_combo, args.climate_palette, climate_palette_callback)):
+        combo.addItems(sorted(PALETTES))
+        combo.setCurrentText(palette)
+        combo.currentTextChanged.connect(profiler.wrap("palette", callback))
+
+    ui.infections_check.stateChanged.connect(profiler.wrap("toggle infections", infections_callback))
+    ui.recovered_check.stateChanged.connect(profiler.wrap("toggle recovered", recovered_callback))
+    ui.deaths_check.stateChanged.connect(profiler.wrap("toggle deaths", deaths_callback))
+    ui.density_check.stateChanged.connect(profiler.wrap("toggle density", density_callback))
+    ui.climate_max_check.stateChanged.connect(profiler.wrap("toggle climate max", climate_max_callback))
+    ui.climate_min_check.stateChanged.connect(profiler.wrap("toggle climate min", climate_min_callback))
+    ui.migration_check.stateChanged.connect(profiler.wrap("toggle migration", migration_callback))
+    ui.migration_slider.valueChanged.connect(profiler.wrap("migration threshold", migration_slider_callback))
+    ui.migration_top_spin.valueChanged.connect(profiler.wrap("migration top", migration_top_callback))
+
+    # Load the stages on worker threads, each one is attached by a timer on
+    # the UI thread as soon as its data is ready and its controls unlocked
+    stage_widgets = {"case glyphs": [ui.time_slider, ui.infections_check, ui.recovered_check, ui.deaths_check, ui.push_granularity,
+                                     ui.metric_combo],
+                     "migration flows": [ui.migration_check, ui.migration_slider, ui.migration_top_spin],
+                     "rasters": [ui.density_check, ui.climate_max_check, ui.climate_min_check]}
+    for widgets in stage_widgets.values():
+        for widget in widgets:
+            widget.setEnabled(False)
+
+    def log_callback(message):
+        ui.log.insertPlainText(message + "\n")
+
+    def stage_callback(name):
+        if name == "case glyphs":
+            ui.time_slider.setRange(0, scene.numDates)
+            scene.set_date(ui.time_slider.value())
+        for widget in stage_widgets[name]:
+            widget.setEnabled(True)
+        ui.vtkWidget.GetRenderWindow().Render()
+
+    loader = SceneLoader(scene.stages(), log_callback, stage_callback)
+    load_timer = QtCore.QTimer()
 
-    ui.infections_check.stateChanged.connect(infections_callback)
-    ui.recovered_check.stateChanged.connect(recovered_callback)
-    ui.deaths_check.stateChanged.connect(deaths_callback)
-    ui.density_check.stateChanged.connect(density_callback)
-    ui.climate_max_check.stateChanged.connect(climate_max_callback)
-    ui.climate_min_check.stateChanged.connect(climate_min_callback)
-    ui.migration_check.stateChanged.connect(migration_callback)
+    def load_timer_callback():
+        if loader.poll():
+            load_timer.stop()
+
+    load_timer.timeout.connect(load_timer_callback)
+    load_timer.start(50)
+
+    # Append the dates the time series gain while the window is open, a
+    # slider left on the last date follows the new last date
+    refresh_timer = QtCore.QTimer()
+
+    def refresh_callback():
+        following = ui.time_slider.value() == ui.time_slider.maximum()
+        if scene.refresh():
+            ui.time_slider.setRange(0, scene.numDates)
+            if following:
+                ui.time_slider.setValue(scene.numDates)
+            log_callback("Refreshed the time series to {}".format((initial_date + timedelta(scene.numDates)).strftime('%m/%d/%Y')))
+            ui.vtkWidget.GetRenderWindow().Render()
+
+    if args.refresh:
+        refresh_timer.timeout.connect(profiler.wrap("refresh", refresh_callback))
+        refresh_timer.start(int(args.refresh * 1000))
 
     # Terminate setup for PyQT5 interface
     sys.exit(app.exec_())
 
+def migration_threshold_text(fraction):
+    return "Migration Threshold ({:.1f}%):".format(fraction * 100)
+
+def granularity_text(granularity):
+    return "Cases per " + granularity.capitalize()
+
 class Ui_MainWindow(object):
     def setupUi(self, MainWindow):
         MainWindow.setObjectName('The Main Window')
@@ -658,6 +859,10 @@ class Ui_MainWindow(object):
         self.gridlayout = QGridLayout(self.centralWidget)
         self.vtkWidget = QVTKRenderWindowInteractor(self.centralWidget)
         self.time_slider = QSlider()
+        self.migration_slider = QSlider()
+        self.migration_top_spin = QSpinBox()
+        self.migration_top_spin.setRange(0, 100000)
+        self.migration_top_spin.setSpecialValueText("Threshold")
 
         self.push_screenshot = QPushButton()
         self.push_screenshot.setText('Save Screenshot')
@@ -665,6 +870,11 @@ class Ui_MainWindow(object):
         self.push_camera.setText('Update Camera Info')
         self.push_quit = QPushButton()
         self.push_quit.setText('Quit')
+        self.push_granularity = QPushButton()
+        self.metric_combo = QComboBox()
+        self.projection_combo = QComboBox()
+        self.density_palette_combo = QComboBox()
+        self.climate_palette_combo = QComboBox()
 
         self.push_density = QPushButton()
         self.push_density.setText('Disable Density')
@@ -708,7 +918,11 @@ class Ui_MainWindow(object):
         self.migration_label = QLabel("Toggle Migration:")
         self.date_label = QLabel("Date: " + initial_date.strftime('%m/%d/%Y'))
         self.time_label = QLabel("Adjust Date:")
-        self.curr_month = initial_date.month.real
+        self.migration_threshold_label = QLabel(migration_threshold_text(0.05))
+        self.migration_top_label = QLabel("Migration Top Flows:")
+        self.projection_label = QLabel("Projection:")
+        self.density_palette_label = QLabel("Density Palette:")
+        self.climate_palette_label = QLabel("Climate Palette:")
 
         self.gridlayout.addWidget(self.vtkWidget, 0, 0, 4, 5)
         
@@ -727,14 +941,26 @@ class Ui_MainWindow(object):
         self.gridlayout.addWidget(self.climate_max_check, 6, 3, 1, 1)
         self.gridlayout.addWidget(self.climate_min_label, 7, 2, 1, 1)
         self.gridlayout.addWidget(self.climate_min_check, 7, 3, 1, 1)
+        self.gridlayout.addWidget(self.migration_threshold_label, 8, 2, 1, 1)
+        self.gridlayout.addWidget(self.migration_slider, 8, 3, 1, 1)
 
         self.gridlayout.addWidget(self.date_label, 4, 0, 1, 1)
         self.gridlayout.addWidget(self.time_label, 4, 2, 1, 1)
         self.gridlayout.addWidget(self.time_slider, 4, 3, 1, 1)
         self.gridlayout.addWidget(self.push_screenshot, 0, 5, 1, 1)
         self.gridlayout.addWidget(self.push_camera, 0, 6, 1, 1)
+        self.gridlayout.addWidget(self.push_granularity, 1, 5, 1, 1)
+        self.gridlayout.addWidget(self.metric_combo, 1, 6, 1, 1)
         self.gridlayout.addWidget(self.camera_info, 2, 5, 1, 2)
         self.gridlayout.addWidget(self.log, 3, 5, 1, 2)
+        self.gridlayout.addWidget(self.projection_label, 4, 5, 1, 1)
+        self.gridlayout.addWidget(self.projection_combo, 4, 6, 1, 1)
+        self.gridlayout.addWidget(self.density_palette_label, 5, 5, 1, 1)
+        self.gridlayout.addWidget(self.density_palette_combo, 5, 6, 1, 1)
+        self.gridlayout.addWidget(self.climate_palette_label, 6, 5, 1, 1)
+        self.gridlayout.addWidget(self.climate_palette_combo, 6, 6, 1, 1)
+        self.gridlayout.addWidget(self.migration_top_label, 7, 5, 1, 1)
+        self.gridlayout.addWidget(self.migration_top_spin, 7, 6, 1, 1)
         MainWindow.setCentralWidget(self.centralWidget)
 
 def save_frame(camera, window, log):
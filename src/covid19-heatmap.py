@@ -5,14 +5,28 @@
 import datetime
 from datetime import timedelta
 
-from PyQt5.QtWidgets import QApplication, QWidget, QMainWindow, QSlider, QGridLayout, QLabel, QPushButton, QTextEdit
-import PyQt5.QtCore as QtCore
-from PyQt5.QtCore import Qt
 import vtk
-from vtk.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 from argparse import ArgumentParser
 import sys
 
+from bundle import open_bundle
+from climate_cache import ClimateCache, climate_layer_name
+from colormaps import PALETTES, palette_lookup_table
+from instrumentation import Profiler, add_profiler_arguments
+from offscreen import add_export_arguments, export_dates, export_frames, load_camera_settings
+from raster_layers import RasterLayer, watch_raster_layers
+from raster_pyramid import RasterPyramid, valid_mask
+from raster_store import image_values, open_raster_store, raster_lookup_table
+
+# Qt is only needed for the interactive window, --export renders without it
+try:
+    from PyQt5.QtWidgets import QApplication, QWidget, QMainWindow, QSlider, QGridLayout, QLabel, QPushButton, QTextEdit
+    import PyQt5.QtCore as QtCore
+    from PyQt5.QtCore import Qt
+    from vtk.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
+except ImportError:
+    QApplication = None
+
 frame_counter = 0
 initial_date = datetime.date(2020, 1, 22)
 curr_date = datetime.datetime.now().date()
@@ -20,105 +34,103 @@ curr_date = datetime.datetime.now().date()
 def main():
     # Initialize argument and constant variables
     parser = ArgumentParser("Create isosurfacing of object")
-    parser.add_argument("density")
-    parser.add_argument("climate")
-    parser.add_argument("sat")
+    parser.add_argument("density", nargs = "?")
+    parser.add_argument("climate", nargs = "?")
+    parser.add_argument("sat", nargs = "?")
+    parser.add_argument("--bundle", type = str, help = "Dataset bundle written by bundle.py build, replaces the three inputs")
+    parser.add_argument("--bundle-climate", type = str, default = "max", choices = ("max", "min"), help = "Climate variable of the bundle to draw")
     parser.add_argument("--camera", type = str, help = "Optional camera settings file")
+    parser.add_argument("--climate-cache", type = int, default = 3, help = "Number of decoded climate months kept in memory")
+    parser.add_argument("--no-prefetch", action = "store_true", help = "Do not decode the adjacent climate months in the background")
+    parser.add_argument("--raster-cache", type = str, help = "Directory of preprocessed rasters, filled on first use")
+    parser.add_argument("--density-palette", type = str, default = "density", choices = sorted(PALETTES), help = "Color palette of the density raster")
+    parser.add_argument("--climate-palette", type = str, default = "climate", choices = sorted(PALETTES), help = "Color palette of the climate raster")
+    add_export_arguments(parser)
+    add_profiler_arguments(parser)
 
     args = parser.parse_args()
+    profiler = Profiler(args.trace, args.stats_overlay)
+    bundle = open_bundle(args.bundle)
+    if bundle:
+        args.climate = bundle.climate_path(args.bundle_climate)
+    elif None in (args.density, args.climate, args.sat):
+        parser.error("the three inputs are required without --bundle")
+
+    # Preprocessed rasters are mapped from the raster cache or the bundle instead of decoding the GeoTIFFs
+    raster_store = bundle
+    if args.raster_cache and not bundle:
+        raster_store = open_raster_store(args.raster_cache, args.density, [args.climate])
+    if raster_store:
+        density_image = raster_store.image("density")
+        density_range = raster_store.scalar_range("density")
+        density_valid = None
+    else:
+        # Create reader for ct scan
+        density_reader = vtk.vtkTIFFReader()
+        density_reader.SetFileName(args.density)
+        density_reader.Update()
+        print(density_reader.GetOutput().GetScalarRange()[1])
+
+        density_log = vtk.vtkImageLogarithmicScale()
+        density_log.SetInputConnection(density_reader.GetOutputPort())
+        density_log.SetConstant(0.435)
+        density_log.Update()
+        density_image = density_log.GetOutput()
+        density_range = density_image.GetScalarRange()
+        # The log scale turns the nodata cells into ordinary negative values
+        density_valid = valid_mask(image_values(density_reader.GetOutput()))
+
+    # Rasters are drawn from a pyramid of downsampled levels picked by the zoom
+    density_pyramid = RasterPyramid(density_image, density_valid)
+
+    # Decoded climate months are cached, so changing month only swaps the mapper input
+    climate_cache = ClimateCache({"climate": args.climate}, args.climate_cache, not args.no_prefetch,
+                                 raster_store, RasterPyramid)
+
+    # Value range of a climate month, stored months only know it from the cache header
+    def climate_range(month, pyramid):
+        if raster_store:
+            return raster_store.scalar_range(climate_layer_name(args.climate, month))
+        return pyramid.level(0).GetScalarRange()
+
+    climate_pyramid = climate_cache.get("climate", initial_date.month.real)
+
+    if bundle:
+        sat_image = bundle.satellite_image()
+    else:
+        sat_reader = vtk.vtkJPEGReader()
+        sat_reader.SetFileName(args.sat)
+        sat_reader.Update()
+        sat_image = sat_reader.GetOutput()
 
-    # Create reader for ct scan
-    density_reader = vtk.vtkTIFFReader()
-    density_reader.SetFileName(args.density)
-    density_reader.Update()
-    print(density_reader.GetOutput().GetScalarRange()[1])
-
-    density_log = vtk.vtkImageLogarithmicScale()
-    density_log.SetInputConnection(density_reader.GetOutputPort())
-    density_log.SetConstant(0.435)
-    density_log.Update()
-    density_range = density_log.GetOutput().GetScalarRange()
-
-    climate_reader = vtk.vtkTIFFReader()
-    climate_reader.SetFileName(args.climate + "-" + str(initial_date.month.real).zfill(2) + ".tif")
-    climate_reader.Update()
-    climate_range = climate_reader.GetOutput().GetScalarRange()
-
-    sat_reader = vtk.vtkJPEGReader()
-    sat_reader.SetFileName(args.sat)
-
-    max_val = 100
     color_count = 1000
+    density_lut = palette_lookup_table(args.density_palette, color_count, transparent_first=True)
+    climate_lut = palette_lookup_table(args.climate_palette, color_count)
 
-    density_ctf = vtk.vtkColorTransferFunction()
-    density_ctf.AddRGBPoint(0, 0, 0, 0)
-    density_ctf.AddRGBPoint(10, 0, 0, 1)
-    density_ctf.AddRGBPoint(30, 0, 1, 1)
-    density_ctf.AddRGBPoint(50, 1, 1, 0)
-    density_ctf.AddRGBPoint(65, 1, 0.5, 0)
-    density_ctf.AddRGBPoint(80, 1, 0, 0)
-
-    density_lut = vtk.vtkLookupTable()
-    density_lut.SetNumberOfTableValues(color_count)
-    density_lut.Build()
-
-    rgb = list(density_ctf.GetColor(0))+[0]
-    density_lut.SetTableValue(0, rgb)
-    for i in range(1, color_count):
-        rgb = list(density_ctf.GetColor(max_val * float(i)/color_count))+[1]
-        density_lut.SetTableValue(i, rgb)
-
-    climate_ctf = vtk.vtkColorTransferFunction()
-    climate_ctf.AddRGBPoint(5, 0, 0, 1)
-    climate_ctf.AddRGBPoint(35, 0, 1, 1)
-    climate_ctf.AddRGBPoint(65, 1, 1, 0)
-    climate_ctf.AddRGBPoint(95, 1, 0, 0)
-
-    climate_lut = vtk.vtkLookupTable()
-    climate_lut.SetNumberOfTableValues(color_count)
-    climate_lut.Build()
-
-    for i in range(0, color_count):
-        rgb = list(climate_ctf.GetColor(max_val * float(i)/color_count))+[1]
-        climate_lut.SetTableValue(i, rgb)
-
-    density_mapper = vtk.vtkDataSetMapper()
-    density_mapper.SetInputConnection(density_log.GetOutputPort())
-    density_mapper.SetLookupTable(density_lut)
-    density_mapper.SetScalarRange([0, density_range[1]])
-    density_mapper.Update()
-
-    climate_mapper = vtk.vtkDataSetMapper()
-    climate_mapper.SetInputConnection(climate_reader.GetOutputPort())
-    climate_mapper.SetLookupTable(climate_lut)
-    climate_mapper.SetScalarRange(climate_range)
-    climate_mapper.Update()
+    # The palette tables only feed the scalar bars, the layers get copies
+    density_lut.SetTableRange(0, density_range[1])
+    climate_lut.SetTableRange(climate_range(initial_date.month.real, climate_pyramid))
 
     sat_mapper = vtk.vtkDataSetMapper()
-    sat_mapper.SetInputConnection(sat_reader.GetOutputPort())
-
-    density_actor = vtk.vtkActor()
-    density_actor.SetMapper(density_mapper)
-    density_actor.GetProperty().SetOpacity(0.99)
-    density_actor.VisibilityOn()
-
-    climate_actor = vtk.vtkActor()
-    climate_actor.SetMapper(climate_mapper)
-    climate_actor.GetProperty().SetOpacity(0.6)
-    climate_actor.VisibilityOff()
+    sat_mapper.SetInputData(sat_image)
 
     sat_actor = vtk.vtkActor()
     sat_actor.SetMapper(sat_mapper)
     sat_actor.GetProperty().SetOpacity(0.7)
 
-    # Make satellite image same size as contour map
-    crange = sat_actor.GetXRange()[0] - sat_actor.GetXRange()[1]
-    mrange = density_actor.GetXRange()[0] - density_actor.GetXRange()[1]
-    density_actor.SetScale(crange/mrange)
+    # Density and climate are textures on planes covering the satellite image
+    sat_bounds = sat_actor.GetBounds()[:4]
+    density_layer = RasterLayer(density_pyramid, raster_lookup_table(density_lut, [0, density_range[1]], raster_store, "density"),
+                                sat_bounds, 0.99)
+    density_actor = density_layer.actor
+    density_actor.VisibilityOn()
 
-    crange = sat_actor.GetXRange()[0] - sat_actor.GetXRange()[1]
-    mrange = climate_actor.GetXRange()[0] - climate_actor.GetXRange()[1]
-    climate_actor.SetScale(crange/mrange)
+    climate_layer = RasterLayer(climate_pyramid,
+                                raster_lookup_table(climate_lut, climate_range(initial_date.month.real, climate_pyramid),
+                                                    raster_store, climate_layer_name(args.climate, initial_date.month.real)),
+                                sat_bounds, 0.6)
+    climate_actor = climate_layer.actor
+    climate_actor.VisibilityOff()
 
     # Initialize renderer and place actors
     ren = vtk.vtkRenderer()
@@ -128,6 +140,12 @@ def main():
     ren.ResetCamera()
     ren.SetBackground(0, 0, 0)
 
+    # Swap the raster levels before every render
+    watch_raster_layers(ren, [density_layer, climate_layer])
+    profiler.watch(ren)
+    for overlay_actor in profiler.actors():
+        ren.AddActor(overlay_actor)
+
     # Initialize camera settings
     cam1 = ren.GetActiveCamera()
     cam1.Azimuth(0)
@@ -138,19 +156,30 @@ def main():
     ren.ResetCameraClippingRange()
 
     if args.camera:
-        reader = open(args.camera, "r")
-        line = reader.readline().split(",")
-        cam1.SetPosition(float(line[0]), float(line[1]), float(line[2]))
-        line = reader.readline().split(",")
-        cam1.SetFocalPoint(float(line[0]), float(line[1]), float(line[2]))
-        line = reader.readline().split(",")
-        cam1.SetViewUp(float(line[0]), float(line[1]), float(line[2]))
-        line = reader.readline().split(",")
-        cam1.SetClippingRange(float(line[0]), float(line[1]))
-        line = reader.readline().split(",")
-        cam1.SetViewAngle(float(line[0]))
-        line = reader.readline().split(",")
-        cam1.SetParallelScale(float(line[0]))
+        load_camera_settings(cam1, args.camera)
+
+    # Switch the climate layer to the month of a date index
+    climate_month = [initial_date.month.real]
+    def set_date(val):
+        new_date = initial_date + timedelta(val)
+        if new_date.month.real != climate_month[0]:
+            climate_month[0] = new_date.month.real
+            climate_pyramid = climate_cache.get("climate", climate_month[0])
+            with profiler.stage("climate"):
+                climate_layer.set_pyramid(climate_pyramid)
+            climate_lut.SetTableRange(climate_range(climate_month[0], climate_pyramid))
+            climate_layer.set_lookup_table(raster_lookup_table(climate_lut, climate_range(climate_month[0], climate_pyramid),
+                                                               raster_store, climate_layer_name(args.climate, climate_month[0])))
+
+    # Render the requested dates offscreen and exit without opening a window
+    if args.export:
+        export_frames(ren, set_date, export_dates((curr_date - initial_date).days + 1, args.start, args.end, args.stride), args,
+                      profiler=profiler)
+        profiler.close()
+        return
+
+    if QApplication is None:
+        raise ImportError("PyQt5 is required for the interactive window, use --export to render offscreen")
 
     # Initialize PyQT5 UI and link to renderer
     app = QApplication([])
@@ -208,13 +237,8 @@ def main():
     iren.Initialize()
 
     def time_slider_callback(val):
+        set_date(val)
         new_date = initial_date + timedelta(val)
-        if new_date.month.real != ui.curr_month:
-            ui.curr_month = new_date.month.real
-            climate_reader.SetFileName(args.climate + "-" + str(ui.curr_month).zfill(2) + ".tif")
-            climate_reader.Update()
-            new_range = climate_reader.GetOutput().GetScalarRange()
-            climate_mapper.SetScalarRange(new_range)
         ui.date_label.setText("Date (" + new_date.strftime('%m/%d/%Y') + "):")
 
     def density_callback():
@@ -255,14 +279,14 @@ def main():
     def quit_callback():
         sys.exit()
 
-    # Register callbacks to UI
-    ui.time_slider.valueChanged.connect(time_slider_callback)
+    # Register callbacks to UI, the scene updates are timed as one event per callback
+    ui.time_slider.valueChanged.connect(profiler.wrap("date", time_slider_callback))
     ui.push_screenshot.clicked.connect(screenshot_callback)
     ui.push_camera.clicked.connect(camera_callback)
     ui.push_quit.clicked.connect(quit_callback)
 
-    ui.push_density.clicked.connect(density_callback)
-    ui.push_climate.clicked.connect(climate_callback)
+    ui.push_density.clicked.connect(profiler.wrap("toggle density", density_callback))
+    ui.push_climate.clicked.connect(profiler.wrap("toggle climate", climate_callback))
 
     # Terminate setup for PyQT5 interface
     sys.exit(app.exec_())
@@ -300,7 +324,6 @@ class Ui_MainWindow(object):
         self.log.setReadOnly(True)
 
         self.date_label = QLabel("Date (" + initial_date.strftime('%m/%d/%Y') + "):")
-        self.curr_month = initial_date.month.real
 
         self.gridlayout.addWidget(self.vtkWidget, 0, 0, 4, 4)
         self.gridlayout.addWidget(self.date_label, 4, 0, 1, 1)
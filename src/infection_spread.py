@@ -1,12 +1,28 @@
 import vtk
 import sys
-from PyQt5.QtWidgets import QApplication, QWidget, QMainWindow, QSlider, QGridLayout, QLabel, QPushButton, QTextEdit, QCheckBox
-import PyQt5.QtCore as QtCore
-from PyQt5.QtCore import Qt
-from vtk.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
+import tempfile
+from argparse import ArgumentParser
 from datetime import date, timedelta
-import csv
-import math
+
+from bundle import open_bundle
+from case_views import CaseViews
+from instrumentation import Profiler, add_profiler_arguments
+from locations import open_location_registry
+from metrics import add_metric_arguments, legend_text, legend_values, read_population_table
+from projection import PROJECTIONS, Projection, add_projection_arguments, set_map_surface
+from offscreen import add_export_arguments, export_dates, export_frames, export_frames_parallel, load_camera_settings
+from rollup import Rollup, add_granularity_arguments
+from time_series import CovidDataWatcher, load_covid_arrays, load_covid_data, save_covid_arrays
+
+# Qt is only needed for the interactive window, --export renders without it
+try:
+    from PyQt5.QtWidgets import QApplication, QWidget, QMainWindow, QSlider, QGridLayout, QLabel, QPushButton, QTextEdit, QCheckBox, QComboBox
+    import PyQt5.QtCore as QtCore
+    from PyQt5.QtCore import Qt
+    from vtk.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
+except ImportError:
+    QApplication = None
+    QMainWindow = object
 
 class Ui_MainWindow(object):
     def setupUi(self, MainWindow):
@@ -27,6 +43,11 @@ class Ui_MainWindow(object):
         self.recovered_check = QCheckBox()
         self.deaths_check = QCheckBox()
 
+        # Buttons
+        self.push_granularity = QPushButton()
+        self.metric_combo = QComboBox()
+        self.projection_combo = QComboBox()
+
         self.infections_check.setChecked(MainWindow.default_infections_checked)
         self.recovered_check.setChecked(MainWindow.default_recovered_checked)
         self.deaths_check.setChecked(MainWindow.default_deaths_checked)
@@ -36,6 +57,7 @@ class Ui_MainWindow(object):
         self.recovered_label = QLabel("Toggle Recovered:")
         self.deaths_label = QLabel("Toggle Deaths:")
         self.date_label = QLabel("Date (" + MainWindow.initial_date.strftime('%m/%d/%Y') + "):")
+        self.projection_label = QLabel("Projection:")
         # We are now going to position our widgets inside our
         # grid layout. The top left corner is (0,0)
         # Here we specify that our vtkWidget is anchored to the top
@@ -50,71 +72,39 @@ class Ui_MainWindow(object):
         self.gridlayout.addWidget(self.recovered_check, 5, 1, 1, 1)
         self.gridlayout.addWidget(self.deaths_label, 6, 0, 1, 1)
         self.gridlayout.addWidget(self.deaths_check, 6, 1, 1, 1)
+        self.gridlayout.addWidget(self.push_granularity, 4, 2, 1, 1)
+        self.gridlayout.addWidget(self.metric_combo, 4, 3, 1, 1)
+        self.gridlayout.addWidget(self.projection_label, 5, 2, 1, 1)
+        self.gridlayout.addWidget(self.projection_combo, 5, 3, 1, 1)
 
         self.gridlayout.addWidget(self.date_label, 7, 0, 1, 1)
         self.gridlayout.addWidget(self.slider, 7, 1, 1, 1)
         MainWindow.setCentralWidget(self.centralWidget)
 
-class InfectionSpread(QMainWindow):
-    def compute_max(self, date):
-        maximum = 0
-        for i in range(len(self.infections_data)):
-            if(int(self.infections_data[i][date+2]) > maximum):
-                maximum = int(self.infections_data[i][date+2])
-
-        for i in range(len(self.recovered_data)):
-            if(int(self.recovered_data[i][date+2]) > maximum):
-                maximum = int(self.recovered_data[i][date+2])
-
-        for i in range(len(self.deaths_data)):
-            if(int(self.deaths_data[i][date+2]) > maximum):
-                maximum = int(self.deaths_data[i][date+2])
-        
-        return maximum
-
-    def add_case_actors(self, data, actors, color, opacity):
-        for i in range(len(data)):
-
-            x = (self.sat_x / 360.0) * (180 + float(data[i][1]))
-            y = (self.sat_y / 180.0) * (90 + float(data[i][0]))
-            cases = int(data[i][self.date+2])
-
-            if(cases > 0 and (float(data[i][1]) != 0 or float(data[i][0]) != 0)):
-                radius = (math.log2(cases)/math.log2(self.max_cases)) * self.max_radius 
-                polygon_source = vtk.vtkRegularPolygonSource()
-                polygon_source.SetNumberOfSides(50)
-                polygon_source.SetRadius(radius)
-                polygon_source.SetCenter(x, y, 0)
-
-                cases_mapper = vtk.vtkPolyDataMapper()
-                cases_mapper.SetInputConnection(polygon_source.GetOutputPort())
+def build_export_scene(args):
+    scene = InfectionScene(args, {"infections": True, "recovered": True, "deaths": True})
+    return scene.ren, scene.set_date
 
-                cases_actor = vtk.vtkActor()
-                cases_actor.SetMapper(cases_mapper)
-                cases_actor.GetProperty().SetColor(color[0], color[1], color[2])
-                cases_actor.GetProperty().SetOpacity(opacity)
+class InfectionScene(object):
+    # The VTK side of the infection spread view, independent of Qt so that it
+    # can also be rendered offscreen
+    def compute_max(self, date):
+        return self.maxima.max_for_date(date)
 
-                self.ren.AddActor(cases_actor)
-                actors.append(cases_actor)
-    
-    def remove_case_actors(self, actors):
-        for i in range(len(actors)):
-            self.ren.RemoveActor(actors[i])
-        actors = []
+    def update_case_layer(self):
+        self.case_layer.update(self.date, self.max_cases, self.case_visible)
     
-    def remove_legend_actors(self):
-        for i in range(len(self.legend_circle_actors)):
-            self.ren.RemoveActor(self.legend_circle_actors[i])
-            self.ren.RemoveActor(self.legend_text_actors[i])
+    def update_legend_actors(self):
+        # TODO: Potentially change scale to use hardcoded values (e.g., 5, 10, 50, 100, 500, 1000....) and pick 4 evenly spaced values from this list (all parts of this list smaller than the max_cases)
+        for i, (cases, fraction) in enumerate(legend_values(self.max_cases, self.metric, len(self.legend_circle_sources))):
+            radius = fraction * self.max_radius
+            self.legend_circle_sources[i].SetRadius(radius)
+            self.legend_text_actors[i].SetInput(legend_text(cases, self.metric))
 
     def add_legend_actors(self):
-        # TODO: Potentially change scale to use hardcoded values (e.g., 5, 10, 50, 100, 500, 1000....) and pick 4 evenly spaced values from this list (all parts of this list smaller than the max_cases)
         for i in range(4):
-            cases = math.pow(2, (math.log2(self.max_cases) / (i+1)))
-            radius = (math.log2(cases)/math.log2(self.max_cases)) * self.max_radius
             legend_polygon_source = vtk.vtkRegularPolygonSource()
             legend_polygon_source.SetNumberOfSides(50)
-            legend_polygon_source.SetRadius(radius)
             legend_polygon_source.SetCenter(0, 0, 0)
 
             circle_mapper = vtk.vtkPolyDataMapper2D()
@@ -127,29 +117,33 @@ class InfectionSpread(QMainWindow):
             circle_actor.GetPositionCoordinate().SetValue(.05, .1 + .075 * i)
 
             text_actor = vtk.vtkTextActor()
-            text_actor.SetInput(str(int(cases)) + " cases")
 
             text_actor.GetPositionCoordinate().SetCoordinateSystemToNormalizedViewport()
             text_actor.GetPositionCoordinate().SetValue(.075, .1 + .075 * i)
             text_actor.GetTextProperty().SetFontSize(25)
 
             self.ren.AddActor(circle_actor)
+            self.legend_circle_sources.append(legend_polygon_source)
             self.legend_circle_actors.append(circle_actor)
             self.ren.AddActor(text_actor)
             self.legend_text_actors.append(text_actor)
 
-    
-    def __init__(self, parent = None):
-        QMainWindow.__init__(self, parent)
-        self.ui = Ui_MainWindow()
-        self.date = 0
-        
-        self.default_infections_checked = True
-        self.default_recovered_checked = True
-        self.default_deaths_checked = True
+        self.update_legend_actors()
 
-        self.initial_date = date(2020, 1, 22) + timedelta(self.date)
-        self.ui.setupUi(self)
+    def use_view(self, granularity, metric):
+        # Draw `metric` of the rollup at `granularity` through the same actor,
+        # which keeps its place in the draw order. The glyph layer of a
+        # granularity and the metrics and maxima shown before are reused
+        self.covid_data, self.maxima, self.case_layer = self.views.view(granularity, metric)
+        self.case_actor.SetMapper(self.case_layer.mapper)
+        self.granularity = granularity
+        self.metric = metric
+        self.max_cases = self.compute_max(self.date)
+        self.update_case_layer()
+
+    def __init__(self, args, case_visible):
+        self.date = 0
+        self.case_visible = case_visible
 
         self.max_radius = 40
 
@@ -157,55 +151,61 @@ class InfectionSpread(QMainWindow):
         self.recovered_color = (0, 1, 0)
         self.deaths_color = (0, 0, 0)
 
+        self.projection = Projection(getattr(args, "projection", "equirectangular"), getattr(args, "projection_center", None))
+
         self.infections_opacity = 0.9
         self.recovered_opacity = 0.75
         self.deaths_opacity = 0.5
-        
-        sat_path = sys.argv[1]
-        global_infections_path = sys.argv[2]
-        global_deaths_path = sys.argv[3]
-        global_recovered_path = sys.argv[4]
-
-        self.infections_data = []
-        self.deaths_data = []
-        self.recovered_data = []
 
+        self.legend_circle_sources = []
         self.legend_circle_actors = []
         self.legend_text_actors = []
 
-        # Read in data for global confirmed cases
-        with open(global_infections_path) as csvDataFile:
-            csv_reader = csv.reader(csvDataFile)
-            for row in csv_reader:
-                # We do not need country/province name, so we remove the first two columns
-                if(row[2] != 0 or row[3] != 0):
-                    self.infections_data.append(row[2:])
-        self.infections_data = self.infections_data[1:]
-
-        # Read in data for global deaths
-        with open(global_deaths_path) as csvDataFile:
-            csv_reader = csv.reader(csvDataFile)
-            for row in csv_reader:
-                if(row[2] != 0 or row[3] != 0):
-                    self.deaths_data.append(row[2:])
-        self.deaths_data = self.deaths_data[1:]
-
-        # Read in data for global recovered cases
-        with open(global_recovered_path) as csvDataFile:
-            csv_reader = csv.reader(csvDataFile)
-            for row in csv_reader:
-                if(row[2] != 0 or row[3] != 0):    
-                    self.recovered_data.append(row[2:])
-        self.recovered_data = self.recovered_data[1:]
-
-        self.numDates = len(self.infections_data[0]) - 3
-        self.max_cases = self.compute_max(self.date)
+        # Stage timings go to the trace file and the overlay when requested
+        self.profiler = Profiler(getattr(args, "trace", None), getattr(args, "stats_overlay", False))
+
+        # Read in data for global confirmed cases, recoveries and deaths,
+        # with --refresh the files are watched from before they are read. A
+        # bundle holds them already parsed, the arrays are mapped from it
+        self.watcher = None
+        bundle = open_bundle(getattr(args, "bundle", None))
+        with self.profiler.stage("load cases"):
+            if bundle:
+                covid_data = bundle.covid_data()
+            elif getattr(args, "shared_data", None):
+                covid_data = load_covid_arrays(args.shared_data)
+            else:
+                if getattr(args, "refresh", None):
+                    self.watcher = CovidDataWatcher({"infections": args.infections, "recovered": args.recovered, "deaths": args.deaths})
+                covid_data = load_covid_data(args.infections, args.recovered, args.deaths)
+
+            # The rows are summed per country, and per continent when the UN
+            # migration tables name them, once. The metrics of the counts are
+            # computed when first drawn, see set_view
+            registry = None
+            if bundle:
+                registry = bundle.location_registry()
+            elif getattr(args, "locations", None):
+                registry = open_location_registry(args.locations, getattr(args, "migration", None))
+            rollup = Rollup(covid_data, registry)
+            population = None
+            if getattr(args, "population", None):
+                population = read_population_table(args.population, registry)
+        self.granularity = getattr(args, "granularity", "province")
+        self.metric = getattr(args, "metric", "cumulative")
+
+        self.numDates = covid_data.num_dates - 1
         
         # Read in satellite image and determine size of the image
-        sat_reader = vtk.vtkJPEGReader()
-        sat_reader.SetFileName(sat_path)
-        sat_reader.Update()
-        sat_dimensions = sat_reader.GetOutput().GetDimensions()
+        with self.profiler.stage("load satellite"):
+            if bundle:
+                sat_image = bundle.satellite_image()
+            else:
+                sat_reader = vtk.vtkJPEGReader()
+                sat_reader.SetFileName(args.sat)
+                sat_reader.Update()
+                sat_image = sat_reader.GetOutput()
+        sat_dimensions = sat_image.GetDimensions()
         self.sat_x = sat_dimensions[0]
         self.sat_y = sat_dimensions[1]
         
@@ -218,42 +218,38 @@ class InfectionSpread(QMainWindow):
         
         # Create satellite image texture
         texture = vtk.vtkTexture()
-        texture.SetInputConnection(sat_reader.GetOutputPort())
+        texture.SetInputData(sat_image)
 
         # Map satellite texture to plane
         texturePlane = vtk.vtkTextureMapToPlane()
         texturePlane.SetInputConnection(plane.GetOutputPort())
 
         # Create mapper
-        sat_mapper = vtk.vtkPolyDataMapper()
-        sat_mapper.SetInputConnection(texturePlane.GetOutputPort())
+        self.sat_plane = texturePlane
+        self.sat_mapper = vtk.vtkPolyDataMapper()
+        set_map_surface(self.sat_mapper, self.projection, [0, self.sat_x, 0, self.sat_y], texturePlane.GetOutputPort())
 
         # Create actor
         sat_actor = vtk.vtkActor()
-        sat_actor.SetMapper(sat_mapper)
+        sat_actor.SetMapper(self.sat_mapper)
         sat_actor.SetTexture(texture)
         sat_actor.GetProperty().SetOpacity(0.6)
 
         # Initialize renderer
         self.ren = vtk.vtkRenderer()
 
+        # Add infections, recoveries and deaths circles for the initial date,
+        # the legend is scaled to them
+        self.case_styles = {"infections": (self.infections_color, self.infections_opacity),
+                            "recovered": (self.recovered_color, self.recovered_opacity),
+                            "deaths": (self.deaths_color, self.deaths_opacity)}
+        self.case_actor = vtk.vtkActor()
+        self.views = CaseViews(rollup, population, (self.case_styles, self.sat_x, self.sat_y, self.max_radius), self.projection)
+        self.use_view(self.granularity, self.metric)
+
         # Add legend actors
         self.add_legend_actors()
-
-        # Add infections actors for the initial date
-        self.infections_actors = []
-        if(self.ui.infections_check.isChecked()):
-            self.add_case_actors(self.infections_data, self.infections_actors, self.infections_color, self.infections_opacity)
-
-        # Add recoveries actors for the initial date
-        self.recovered_actors = []
-        if(self.ui.recovered_check.isChecked()):
-            self.add_case_actors(self.recovered_data, self.recovered_actors, self.recovered_color, self.recovered_opacity)
-
-        # Add death actors for the initial date
-        self.deaths_actors = []
-        if(self.ui.deaths_check.isChecked()):
-            self.add_case_actors(self.deaths_data, self.deaths_actors, self.deaths_color, self.deaths_opacity)
+        self.ren.AddActor(self.case_actor)
         
         self.ren.AddActor(sat_actor)
         self.ren.ResetCamera()
@@ -262,6 +258,83 @@ class InfectionSpread(QMainWindow):
 
         self.ren.ResetCameraClippingRange()
 
+        if args.camera:
+            load_camera_settings(self.ren.GetActiveCamera(), args.camera)
+
+        self.profiler.watch(self.ren)
+        for overlay_actor in self.profiler.actors():
+            self.ren.AddActor(overlay_actor)
+
+    def set_date(self, val):
+        self.date = val
+
+        # Recompute max cases
+        with self.profiler.stage("maxima"):
+            self.max_cases = self.compute_max(self.date)
+
+        # Update infections, recovered, and deaths circles and the legend in place
+        with self.profiler.stage("cases"):
+            self.update_case_layer()
+        with self.profiler.stage("legend"):
+            self.update_legend_actors()
+
+    def set_case_visible(self, name, visible):
+        self.case_visible[name] = visible
+        with self.profiler.stage("cases"):
+            self.update_case_layer()
+
+    def set_view(self, granularity, metric):
+        with self.profiler.stage("view"):
+            self.use_view(granularity, metric)
+        with self.profiler.stage("legend"):
+            self.update_legend_actors()
+
+    def set_granularity(self, granularity):
+        self.set_view(granularity, self.metric)
+
+    def set_metric(self, metric):
+        self.set_view(self.granularity, metric)
+
+    def next_granularity(self):
+        granularities = self.views.rollup.granularities
+        return granularities[(granularities.index(self.granularity) + 1) % len(granularities)]
+
+    def set_projection(self, name, center=None):
+        # Re-project the satellite map and the case glyphs in place
+        with self.profiler.stage("projection"):
+            self.projection.set_projection(name, center)
+            set_map_surface(self.sat_mapper, self.projection, [0, self.sat_x, 0, self.sat_y], self.sat_plane.GetOutputPort())
+            self.case_layer.set_projection(self.projection)
+            self.update_case_layer()
+
+    def refresh(self):
+        # Append the dates the JHU files gained, True when there were any
+        if self.watcher is None or not self.views.refresh(self.watcher):
+            return False
+        self.use_view(self.granularity, self.metric)
+        self.numDates = self.covid_data.num_dates - 1
+        self.set_date(min(self.date, self.numDates))
+        return True
+
+class InfectionSpread(QMainWindow):
+    def __init__(self, args, parent = None):
+        QMainWindow.__init__(self, parent)
+        self.ui = Ui_MainWindow()
+        self.date = 0
+        
+        self.default_infections_checked = True
+        self.default_recovered_checked = True
+        self.default_deaths_checked = True
+
+        self.initial_date = date(2020, 1, 22) + timedelta(self.date)
+        self.ui.setupUi(self)
+
+        self.scene = InfectionScene(args, {"infections": self.ui.infections_check.isChecked(),
+                                           "recovered": self.ui.recovered_check.isChecked(),
+                                           "deaths": self.ui.deaths_check.isChecked()})
+        self.ren = self.scene.ren
+        self.numDates = self.scene.numDates
+
         self.ui.vtkWidget.GetRenderWindow().AddRenderer(self.ren)
         self.iren = self.ui.vtkWidget.GetRenderWindow().GetInteractor()
  
@@ -269,79 +342,146 @@ class InfectionSpread(QMainWindow):
         def slider_setup(slider, val, bounds, interv):
             slider.setOrientation(QtCore.Qt.Horizontal)
             slider.setValue(float(val))
-            slider.setTracking(False)
+            slider.setTracking(True)
             slider.setTickInterval(interv)
             slider.setTickPosition(QSlider.TicksAbove)
             slider.setRange(bounds[0], bounds[1])
 
         slider_setup(self.ui.slider, self.date, [0, self.numDates], 1)
+        self.ui.push_granularity.setText("Cases per " + self.scene.granularity.capitalize())
+        self.ui.metric_combo.addItems(self.scene.views.metrics(self.scene.granularity))
+        self.ui.metric_combo.setCurrentText(self.scene.metric)
+        self.ui.projection_combo.addItems(list(PROJECTIONS))
+        self.ui.projection_combo.setCurrentText(self.scene.projection.name)
 
     def date_callback(self, val):
         self.date = val
         new_date = self.initial_date + timedelta(val)
         self.ui.date_label.setText("Date (" + new_date.strftime('%m/%d/%Y') + "):")
 
-        # Remove old infections, recovered, and deaths actors
-        self.remove_case_actors(self.infections_actors)
-        self.remove_case_actors(self.recovered_actors)
-        self.remove_case_actors(self.deaths_actors)
-        self.remove_legend_actors()
+        self.scene.set_date(val)
 
-        # Recompute max cases
-        self.max_cases = self.compute_max(self.date)
+        self.ui.vtkWidget.GetRenderWindow().Render()
 
-        # Add infections, recovered, and deaths actors
-        if(self.ui.infections_check.isChecked()):
-            self.add_case_actors(self.infections_data, self.infections_actors, self.infections_color, self.infections_opacity)
-        if(self.ui.recovered_check.isChecked()):
-            self.add_case_actors(self.recovered_data, self.recovered_actors, self.recovered_color, self.recovered_opacity)
-        if(self.ui.deaths_check.isChecked()):
-            self.add_case_actors(self.deaths_data, self.deaths_actors, self.deaths_color, self.deaths_opacity)
-        self.add_legend_actors()
+    def refresh_callback(self):
+        # A slider left on the last date follows the new last date
+        following = self.ui.slider.value() == self.ui.slider.maximum()
+        if self.scene.refresh():
+            self.numDates = self.scene.numDates
+            self.ui.slider.setRange(0, self.numDates)
+            if following:
+                self.ui.slider.setValue(self.numDates)
+            self.ui.vtkWidget.GetRenderWindow().Render()
+
+    def granularity_callback(self):
+        self.scene.set_granularity(self.scene.next_granularity())
+        self.ui.push_granularity.setText("Cases per " + self.scene.granularity.capitalize())
+
+        self.ui.vtkWidget.GetRenderWindow().Render()
+
+    def metric_callback(self, metric):
+        self.scene.set_metric(metric)
+
+        self.ui.vtkWidget.GetRenderWindow().Render()
+
+    def projection_callback(self, name):
+        self.scene.set_projection(name)
 
         self.ui.vtkWidget.GetRenderWindow().Render()
 
     def infections_callback(self):
-        if(self.ui.infections_check.isChecked()):
-            self.add_case_actors(self.infections_data, self.infections_actors, self.infections_color, self.infections_opacity)
-        else:
-            self.remove_case_actors(self.infections_actors)
+        self.scene.set_case_visible("infections", self.ui.infections_check.isChecked())
 
         self.ui.vtkWidget.GetRenderWindow().Render()
 
     def recovered_callback(self):
-        if(self.ui.recovered_check.isChecked()):
-            self.add_case_actors(self.recovered_data, self.recovered_actors, self.recovered_color, self.recovered_opacity)
-        else:
-            self.remove_case_actors(self.recovered_actors)
+        self.scene.set_case_visible("recovered", self.ui.recovered_check.isChecked())
 
         self.ui.vtkWidget.GetRenderWindow().Render()
 
     def deaths_callback(self):
-        if(self.ui.deaths_check.isChecked()):
-            self.add_case_actors(self.deaths_data, self.deaths_actors, self.deaths_color, self.deaths_opacity)
-        else:
-            self.remove_case_actors(self.deaths_actors)
+        self.scene.set_case_visible("deaths", self.ui.deaths_check.isChecked())
 
         self.ui.vtkWidget.GetRenderWindow().Render()
     
 if __name__=="__main__":
 
-
-    if len(sys.argv) != 5:
-      raise ValueError('Please provide path to satellite image and global cases, recoveries and deaths data files')
-
+    parser = ArgumentParser("Animate the spread of COVID-19 infections")
+    parser.add_argument("sat", nargs = "?", help = "Path to the satellite image")
+    parser.add_argument("infections", nargs = "?", help = "Global confirmed cases time series")
+    parser.add_argument("deaths", nargs = "?", help = "Global deaths time series")
+    parser.add_argument("recovered", nargs = "?", help = "Global recoveries time series")
+    parser.add_argument("--bundle", type = str, help = "Dataset bundle written by bundle.py build, replaces the four inputs and holds the locations and continents")
+    parser.add_argument("--camera", type = str, help = "Optional camera settings file")
+    parser.add_argument("--refresh", type = float, help = "Check the time series files every this many seconds and append new dates")
+    parser.add_argument("--locations", type = str, help = "countries.csv or a saved location registry, places the country circles")
+    parser.add_argument("--migration", type = str, help = "UN migration directory naming the continent of every country")
+    add_export_arguments(parser)
+    add_profiler_arguments(parser)
+    add_projection_arguments(parser)
+    add_granularity_arguments(parser)
+    add_metric_arguments(parser)
+
+    args = parser.parse_args()
+    bundle = open_bundle(args.bundle)
+    if not bundle and None in (args.sat, args.infections, args.deaths, args.recovered):
+        parser.error("the four inputs are required without --bundle")
+    if bundle and args.refresh:
+        parser.error("--refresh watches the time series files, it cannot be used with --bundle")
+    if args.granularity == "continent" and not (bundle or (args.locations and args.migration)):
+        parser.error("--granularity continent needs --locations and --migration, or --bundle")
+    if args.population and not (bundle or args.locations):
+        parser.error("--population is joined on the locations, it needs --locations or --bundle")
+    if args.metric == "per-capita" and not args.population:
+        parser.error("--metric per-capita needs --population")
+    if args.trace and args.export and args.workers > 1:
+        parser.error("--trace times a single process, export with --workers 1")
+
+    # Render the requested dates offscreen and exit without opening a window,
+    # workers map the bundle themselves
+    if args.export and args.workers > 1 and bundle:
+        dates = export_dates(bundle.covid_data().num_dates, args.start, args.end, args.stride)
+        export_frames_parallel(build_export_scene, args, dates)
+        sys.exit()
+    if args.export and args.workers > 1:
+        data = load_covid_data(args.infections, args.recovered, args.deaths)
+        dates = export_dates(data.num_dates, args.start, args.end, args.stride)
+        with tempfile.TemporaryDirectory() as shared_data:
+            save_covid_arrays(data, shared_data)
+            args.shared_data = shared_data
+            export_frames_parallel(build_export_scene, args, dates)
+        sys.exit()
+    if args.export:
+        scene = InfectionScene(args, {"infections": True, "recovered": True, "deaths": True})
+        export_frames(scene.ren, scene.set_date, export_dates(scene.numDates + 1, args.start, args.end, args.stride), args,
+                      profiler=scene.profiler)
+        scene.profiler.close()
+        sys.exit()
+
+    if QApplication is None:
+        raise ImportError("PyQt5 is required for the interactive window, use --export to render offscreen")
 
     app = QApplication(sys.argv)
-    window = InfectionSpread()
+    window = InfectionSpread(args)
     window.ui.vtkWidget.GetRenderWindow().SetSize(1024, 768)
     window.show()
     window.setWindowState(Qt.WindowMaximized)
     window.iren.Initialize() 
 
-    window.ui.slider.valueChanged.connect(window.date_callback)
-    window.ui.infections_check.stateChanged.connect(window.infections_callback)
-    window.ui.recovered_check.stateChanged.connect(window.recovered_callback)
-    window.ui.deaths_check.stateChanged.connect(window.deaths_callback)
+    # Every callback is timed as an event of the trace and the overlay
+    profiler = window.scene.profiler
+    window.ui.slider.valueChanged.connect(profiler.wrap("date", window.date_callback))
+    window.ui.infections_check.stateChanged.connect(profiler.wrap("toggle infections", window.infections_callback))
+    window.ui.recovered_check.stateChanged.connect(profiler.wrap("toggle recovered", window.recovered_callback))
+    window.ui.deaths_check.stateChanged.connect(profiler.wrap("toggle deaths", window.deaths_callback))
+    window.ui.push_granularity.clicked.connect(profiler.wrap("granularity", window.granularity_callback))
+    window.ui.metric_combo.currentTextChanged.connect(profiler.wrap("metric", window.metric_callback))
+    window.ui.projection_combo.currentTextChanged.connect(profiler.wrap("projection", window.projection_callback))
+
+    # Append the dates the time series gain while the window is open
+    refresh_timer = QtCore.QTimer()
+    if args.refresh:
+        refresh_timer.timeout.connect(profiler.wrap("refresh", window.refresh_callback))
+        refresh_timer.start(int(args.refresh * 1000))
 
     sys.exit(app.exec_())
\ No newline at end of file
@@ -0,0 +1,159 @@
+import csv
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import vtk
+
+
+class Profiler(object):
+    # Times the stages of an interaction, e.g. a date change: the scene
+    # updates wrapped in `stage` and the renders it causes, timed by the
+    # observers `watch` puts on the renderer. Every event becomes one trace
+    # record (JSON lines, or CSV with one row per stage when the path ends
+    # in .csv) and optionally an on-screen overlay. A disabled profiler
+    # only yields
+    def __init__(self, trace_path=None, overlay=False, enabled=None):
+        self.enabled = bool(trace_path or overlay) if enabled is None else enabled
+        self.trace_path = trace_path
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.current = None
+        self.render_start = None
+        self.render_ends = deque(maxlen=30)
+        self.last = None
+        self.overlay = None
+        self.trace_file = None
+        self.csv_writer = None
+        if trace_path:
+            self.trace_file = open(trace_path, "w", newline="")
+            if os.path.splitext(trace_path)[1].lower() == ".csv":
+                self.csv_writer = csv.writer(self.trace_file)
+                self.csv_writer.writerow(["time", "event", "stage", "ms"])
+        if overlay:
+            self.overlay = vtk.vtkTextActor()
+            self.overlay.GetPositionCoordinate().SetCoordinateSystemToNormalizedViewport()
+            self.overlay.GetPositionCoordinate().SetValue(.01, .98)
+            self.overlay.GetTextProperty().SetFontSize(14)
+            self.overlay.GetTextProperty().SetFontFamilyToCourier()
+            self.overlay.GetTextProperty().SetVerticalJustificationToTop()
+
+    @contextmanager
+    def event(self, name):
+        # Nested events count as stages of the outer one
+        if not self.enabled or self.current is not None:
+            yield
+            return
+        self.current = OrderedDict()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stages = self.current
+            self.current = None
+            stages["total"] = 1000 * (time.perf_counter() - start)
+            self.record(name, stages)
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, 1000 * (time.perf_counter() - start))
+
+    def add(self, name, ms):
+        # Outside of an event a stage is recorded on its own
+        if self.current is not None:
+            self.current[name] = self.current.get(name, 0.0) + ms
+        else:
+            self.record(name, OrderedDict([("total", ms)]))
+
+    def timed(self, name, function):
+        # `function` timed as its own event, safe to run on another thread
+        if not self.enabled:
+            return function
+
+        def timed_function(*args):
+            start = time.perf_counter()
+            result = function(*args)
+            self.record(name, OrderedDict([("total", 1000 * (time.perf_counter() - start))]))
+            return result
+        return timed_function
+
+    def record(self, name, stages):
+        with self.lock:
+            if threading.current_thread() is threading.main_thread():
+                self.last = (name, stages)
+            if self.trace_file is None:
+                return
+            now = round(time.perf_counter() - self.start, 6)
+            if self.csv_writer:
+                for stage, ms in stages.items():
+                    self.csv_writer.writerow([now, name, stage, round(ms, 3)])
+            else:
+                self.trace_file.write(json.dumps({"time": now, "event": name,
+                                                  "ms": {stage: round(ms, 3) for stage, ms in stages.items()}}) + "\n")
+            self.trace_file.flush()
+
+    def wrap(self, name, function):
+        # `function` run as an event, e.g. a Qt callback
+        def event_function(*args):
+            with self.event(name):
+                return function(*args)
+        return event_function
+
+    def actors(self):
+        return [self.overlay] if self.overlay is not None else []
+
+    def watch(self, renderer):
+        # Time every render of the renderer as the "render" stage. The start
+        # observer runs before the level of detail observers, so their
+        # level switches count as render time
+        if not self.enabled:
+            return
+        renderer.AddObserver("StartEvent", self.render_started, 10.0)
+        renderer.AddObserver("EndEvent", self.render_ended, -10.0)
+
+    def render_started(self, obj, event):
+        self.render_start = time.perf_counter()
+        self.update_overlay()
+
+    def render_ended(self, obj, event):
+        end = time.perf_counter()
+        self.render_ends.append(end)
+        if self.render_start is not None:
+            self.add("render", 1000 * (end - self.render_start))
+            self.render_start = None
+
+    def fps(self):
+        if len(self.render_ends) < 2 or self.render_ends[-1] == self.render_ends[0]:
+            return 0.0
+        return (len(self.render_ends) - 1) / (self.render_ends[-1] - self.render_ends[0])
+
+    def update_overlay(self):
+        # The overlay shows the last finished event, drawn by the next render
+        if self.overlay is None:
+            return
+        lines = ["{:5.1f} fps".format(self.fps())]
+        if self.last is not None:
+            name, stages = self.last
+            lines.append(name)
+            lines += ["{:12} {:7.2f} ms".format(stage, ms) for stage, ms in stages.items()]
+        self.overlay.SetInput("\n".join(lines))
+
+    def close(self):
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
+
+
+def add_profiler_arguments(parser):
+    parser.add_argument("--trace", type = str, help = "Write the time of every stage of every update to this JSON lines or .csv file")
+    parser.add_argument("--stats-overlay", action = "store_true", help = "Show the frame rate and the stage times of the last update")
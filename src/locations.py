@@ -0,0 +1,238 @@
+import csv
+import json
+import os
+import re
+import unicodedata
+from argparse import ArgumentParser
+
+import numpy as np
+
+from migration_ingest import read_flow_records, read_origin_continents
+from raster_store import source_stamp
+from time_series import load_time_series
+
+# Spellings of the JHU series and the UN migration tables that countries.csv
+# does not list, by normalized name. Every name of countries.csv and its ISO
+# codes are keys already
+ALIASES = {
+    # UN migration tables
+    "united kingdom": "GBR",
+    "china (including hong kong special administrative region)": "CHN",
+    "china, hong kong special administrative region": "HKG",
+    "china, macao special administrative region": "MAC",
+    "china, taiwan province of china": "TWN",
+    # JHU time series
+    "us": "USA",
+    "uk": "GBR",
+    "korea, south": "KOR",
+    "korea, north": "PRK",
+    "czechia": "CZE",
+    "congo (kinshasa)": "COD",
+    "congo (brazzaville)": "COG",
+    "west bank and gaza": "PSE",
+    "north macedonia": "MKD",
+    "eswatini": "SWZ",
+    "moldova": "MDA",
+    "laos": "LAO",
+    "iran": "IRN",
+    "syria": "SYR",
+    "tanzania": "TZA",
+    "micronesia": "FSM",
+    "cape verde": "CPV",
+    "east timor": "TLS",
+    "macau": "MAC",
+    "vatican city": "VAT",
+    "bahamas, the": "BHS",
+    "gambia, the": "GMB",
+    "kyrgyz republic": "KGZ",
+    "slovak republic": "SVK",
+}
+
+
+def normalize(name):
+    # Case, accents, JHU's trailing "*" and the spacing of words and commas
+    # do not matter
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"\s*,\s*", ", ", " ".join(name.replace("*", "").split())).lower()
+
+
+class LocationRegistry(object):
+    # Integer id of every country of countries.csv, one per alpha-3 code
+    # whatever the number of rows spelling it. Names, aliases and the ISO
+    # alpha-2, alpha-3 and numeric codes all resolve to the id, and the
+    # per-id arrays hold the display name and coordinates. Datasets look up
+    # each distinct name once with `ids` and join on the integer arrays.
+    # `listed` are the keys spelled as in countries.csv. `continents` is
+    # empty for the locations no UN migration table names
+    def __init__(self, names, alpha2, alpha3, numeric, lat, long, keys, listed, continents=None):
+        self.names = np.asarray(names, dtype=str)
+        self.alpha2 = np.asarray(alpha2, dtype=str)
+        self.alpha3 = np.asarray(alpha3, dtype=str)
+        self.numeric = np.asarray(numeric, dtype=np.int32)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.long = np.asarray(long, dtype=np.float64)
+        self.keys = keys
+        self.listed = set(listed)
+        self.continents = np.asarray(continents if continents is not None else [""] * len(self.names), dtype=object)
+        self.codes = {}
+        for index in range(len(self.names)):
+            for code in (self.alpha2[index], self.alpha3[index], str(self.numeric[index])):
+                if code:
+                    self.codes[code] = index
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return self.lookup(name) >= 0
+
+    @property
+    def has_continents(self):
+        return bool(np.any(self.continents != ""))
+
+    def set_continents(self, continents):
+        # Fill the continents from a {name: continent} mapping, e.g. the
+        # origins of the UN migration tables
+        for name, continent in continents.items():
+            index = self.lookup(name)
+            if index >= 0 and not self.continents[index]:
+                self.continents[index] = continent
+
+    def lookup(self, name):
+        # Id of a name, alias or ISO code, -1 when unknown
+        index = self.keys.get(normalize(name))
+        if index is None:
+            index = self.codes.get(name.strip().upper(), -1)
+        return index
+
+    def ids(self, names):
+        unique, inverse = np.unique(np.asarray(names, dtype=str), return_inverse=True)
+        return np.array([self.lookup(name) for name in unique], dtype=np.int32)[inverse].reshape(np.shape(names))
+
+    def is_listed(self, names):
+        # Whether each name is spelled as in countries.csv rather than an alias
+        unique, inverse = np.unique(np.asarray(names, dtype=str), return_inverse=True)
+        return np.array([normalize(name) in self.listed for name in unique], dtype=bool)[inverse].reshape(np.shape(names))
+
+    def to_json(self):
+        return {"names": self.names.tolist(), "alpha2": self.alpha2.tolist(), "alpha3": self.alpha3.tolist(),
+                "numeric": self.numeric.tolist(), "lat": self.lat.tolist(), "long": self.long.tolist(),
+                "keys": self.keys, "listed": sorted(self.listed), "continents": self.continents.tolist()}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["names"], data["alpha2"], data["alpha3"], data["numeric"], data["lat"], data["long"],
+                   data["keys"], data["listed"], data.get("continents"))
+
+
+def read_country_rows(path):
+    # (name, alpha-2, alpha-3, numeric, lat, long) rows. A name holding an
+    # unquoted comma ("Taiwan, Province of China") spills into extra columns
+    rows = []
+    with open(path, encoding="utf-8", newline="") as csv_file:
+        for row in csv.reader(csv_file):
+            if len(row) > 6:
+                row = [", ".join(part.strip() for part in row[:len(row) - 5])] + row[len(row) - 5:]
+            try:
+                rows.append((row[0].strip(), row[1].strip(), row[2].strip(), int(row[3]), float(row[4]), float(row[5])))
+            except (ValueError, IndexError):
+                continue
+    return rows
+
+
+def build_location_registry(path):
+    # The first row of an alpha-3 code gives its display name and coordinates
+    names, alpha2, alpha3, numeric, lat, long = [], [], [], [], [], []
+    keys = {}
+    by_code = {}
+    for name, code2, code3, number, row_lat, row_long in read_country_rows(path):
+        if code3 not in by_code:
+            by_code[code3] = len(names)
+            names.append(name)
+            alpha2.append(code2)
+            alpha3.append(code3)
+            numeric.append(number)
+            lat.append(row_lat)
+            long.append(row_long)
+        keys.setdefault(normalize(name), by_code[code3])
+    listed = set(keys)
+    for alias, code in ALIASES.items():
+        if code in by_code:
+            keys.setdefault(alias, by_code[code])
+
+    return LocationRegistry(names, alpha2, alpha3, numeric, lat, long, keys, listed)
+
+
+def save_location_registry(registry, path, source=None):
+    data = registry.to_json()
+    if source:
+        data["stamp"] = source_stamp(source)
+    with open(path + ".tmp", "w") as registry_file:
+        json.dump(data, registry_file)
+    os.replace(path + ".tmp", path)
+
+
+def registry_is_current(data):
+    # A saved registry is stale once the countries table it was built from
+    # changed. One without a stamp, or whose table is gone, is kept
+    stamp = data.get("stamp")
+    if not stamp or not os.path.exists(stamp["source"]):
+        return True
+    return source_stamp(stamp["source"]) == stamp
+
+
+def open_location_registry(path, migration=None, log=print):
+    # Registry of a countries table, or one saved by `locations.py build`.
+    # A saved registry is built again when its countries table changed,
+    # keeping its continents. The continents come from the UN migration
+    # directory when one is given
+    if os.path.splitext(path)[1].lower() == ".json":
+        with open(path) as registry_file:
+            data = json.load(registry_file)
+        registry = LocationRegistry.from_json(data)
+        if not registry_is_current(data):
+            source = data["stamp"]["source"]
+            log("Rebuilding {} from {}".format(path, source))
+            saved = registry
+            registry = build_location_registry(source)
+            registry.set_continents({name: continent for name, continent in zip(saved.alpha3, saved.continents) if continent})
+            save_location_registry(registry, path, source)
+    else:
+        registry = build_location_registry(path)
+    if migration and not registry.has_continents:
+        registry.set_continents(read_origin_continents(migration))
+    return registry
+
+
+def main():
+    parser = ArgumentParser("Build the location registry of countries.csv and check names against it")
+    commands = parser.add_subparsers(dest = "command", required = True)
+    build = commands.add_parser("build", help = "Save the registry of a countries table as JSON")
+    build.add_argument("countries")
+    build.add_argument("registry")
+    build.add_argument("--migration", type = str, help = "UN migration directory giving the continent of every location")
+    check = commands.add_parser("check", help = "List the names of JHU series or UN migration tables without a location")
+    check.add_argument("countries", help = "countries.csv or a saved registry")
+    check.add_argument("paths", nargs = "+", help = "JHU time series files or migration directories")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        registry = open_location_registry(args.countries, args.migration)
+        save_location_registry(registry, args.registry, args.countries)
+        print("Wrote {} locations and {} names to {}".format(len(registry), len(registry.keys), args.registry))
+        return
+
+    registry = open_location_registry(args.countries)
+    for path in args.paths:
+        if os.path.isdir(path):
+            records = read_flow_records(path)
+            names = [record[0] for record in records] + [record[1] for record in records]
+        else:
+            names = load_time_series(path).countries
+        unknown = sorted(set(name for name in names if name not in registry))
+        print("{}: {} names, {} without a location{}".format(path, len(set(names)), len(unknown),
+                                                            ": " + ", ".join(unknown) if unknown else ""))
+
+
+if __name__ == '__main__':
+    main()
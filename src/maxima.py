@@ -0,0 +1,74 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def rolling_max(values, window):
+    # Maximum over the trailing `window` dates, the first dates use whatever
+    # history is available
+    padded = np.concatenate([np.full(window - 1, values[0], dtype=values.dtype), values])
+    return sliding_window_view(padded, window).max(axis=1)
+
+
+def column_max(counts):
+    # Maximum of every date column, zero for a series without rows, e.g. a
+    # JHU file holding only its header
+    if len(counts) == 0:
+        return np.zeros(counts.shape[1], dtype=counts.dtype)
+    return counts.max(axis=0)
+
+
+class MaximaIndex(object):
+    # Per-date maxima of the JHU series, computed once so that moving the
+    # time slider only needs a lookup. The maxima keep the type of the
+    # counts, ints for the series and floats for derived metrics
+    def __init__(self, covid_data, windows=()):
+        self.series_max = {}
+        for name, series in covid_data.series():
+            self.series_max[name] = column_max(series.counts)
+
+        num_dates = covid_data.num_dates
+        self.date_max = np.max([values[:num_dates] for values in self.series_max.values()], axis=0)
+        self.global_max = self.date_max.max().item()
+
+        self.rolling = {}
+        for window in windows:
+            self.add_window(window)
+
+    @property
+    def num_dates(self):
+        return len(self.date_max)
+
+    def extend(self, covid_data):
+        # Add the dates the series gained since the index was built, only
+        # the new columns and the tail of the rolling windows are computed
+        for name, series in covid_data.series():
+            known = len(self.series_max[name])
+            if series.num_dates > known:
+                self.series_max[name] = np.concatenate([self.series_max[name], column_max(series.counts[:, known:])])
+
+        start = self.num_dates
+        num_dates = covid_data.num_dates
+        if num_dates <= start:
+            return
+        new = np.max([values[start:num_dates] for values in self.series_max.values()], axis=0)
+        self.date_max = np.concatenate([self.date_max, new])
+        self.global_max = max(self.global_max, new.max().item())
+        for window, values in self.rolling.items():
+            tail = rolling_max(self.date_max[max(start - window + 1, 0):], window)
+            self.rolling[window] = np.concatenate([values, tail[-(num_dates - start):]])
+
+    def add_window(self, window):
+        if window not in self.rolling:
+            self.rolling[window] = rolling_max(self.date_max, window)
+        return self.rolling[window]
+
+    def max_for_date(self, date, window=None):
+        if window:
+            return self.add_window(window)[date].item()
+        return self.date_max[date].item()
+
+    def series_max_for_date(self, name, date):
+        return self.series_max[name][date].item()
+
+    def series_global_max(self, name):
+        return self.series_max[name].max().item()
@@ -0,0 +1,208 @@
+import csv
+import math
+
+import numpy as np
+
+from locations import normalize
+from time_series import CovidData, TimeSeries
+
+
+def count_text(value):
+    return str(int(value))
+
+
+def rate_text(value):
+    return "{:.3g}".format(value)
+
+
+# Legend label, circle radius scale and legend number format of every
+# metric. "log" radii grow with the logarithm of the value like the
+# cumulative circles always did, "linear" radii with the value
+METRICS = {
+    "cumulative": ("cases", "log", count_text),
+    "daily": ("new cases", "log", count_text),
+    "daily-7": ("new cases, 7 day mean", "log", count_text),
+    "daily-14": ("new cases, 14 day mean", "log", count_text),
+    "growth": ("% growth per day", "linear", rate_text),
+    "doubling": ("days to double", "log", rate_text),
+    "per-capita": ("cases per million", "log", rate_text),
+}
+
+# Dates over which the growth rate and the doubling time are measured
+GROWTH_WINDOW = 7
+
+
+def daily(counts):
+    # New cases of every date, the first date counts everything before it.
+    # Downward corrections of the cumulative series count as none
+    return np.maximum(np.diff(counts, axis=1, prepend=0), 0)
+
+
+def rolling_mean(values, window):
+    # Mean over the trailing `window` dates, the first dates use whatever
+    # history is available
+    total = np.cumsum(values, axis=1, dtype=np.float64)
+    earlier = np.zeros_like(total)
+    earlier[:, window:] = total[:, :-window]
+    return (total - earlier) / np.minimum(np.arange(1, values.shape[1] + 1), window)
+
+
+def growth_ratio(counts, window):
+    # Ratio of every count to the count `window` dates earlier and the
+    # number of dates between them, the first dates compare to the first
+    # one. The ratio is 1 where the earlier count is 0
+    dates = np.arange(counts.shape[1])
+    earlier = np.maximum(dates - window, 0)
+    ratio = np.ones(counts.shape)
+    np.divide(counts, counts[:, earlier], out=ratio, where=counts[:, earlier] > 0)
+    return ratio, dates - earlier
+
+
+def growth_rate(counts, window=GROWTH_WINDOW):
+    # Mean growth per date over the trailing window, in percent
+    ratio, span = growth_ratio(counts, window)
+    return 100 * (ratio ** (1.0 / np.maximum(span, 1)) - 1)
+
+
+def doubling_time(counts, window=GROWTH_WINDOW):
+    # Dates the counts take to double at the growth of the trailing window,
+    # 0 where they do not grow
+    ratio, span = growth_ratio(counts, window)
+    growing = ratio > 1
+    days = np.zeros(counts.shape)
+    np.divide(span * math.log(2), np.log(ratio, where=growing, out=np.ones(counts.shape)), out=days, where=growing)
+    return days
+
+
+def country_key(registry, country):
+    # Registry id of the country of a province, its normalized name when
+    # unknown and "" for none
+    index = registry.lookup(country) if country else -1
+    return index if index >= 0 else normalize(country)
+
+
+class PopulationTable(object):
+    # Population of the registry locations, by id, and of provinces by
+    # (normalized name, country key). A JHU row of a province takes the
+    # population of the province within its country, else of a province row
+    # without a country, else of the registry location of that name, like
+    # Bermuda or Hong Kong which JHU lists under another country. A country
+    # or continent row of the rollup takes the one of its country or the sum
+    # over its continent
+    def __init__(self, registry, population, provinces):
+        self.registry = registry
+        self.population = np.asarray(population, dtype=np.float64)
+        self.provinces = provinces
+        self.continents = {}
+        for continent, value in zip(registry.continents, self.population):
+            if continent:
+                self.continents[continent] = self.continents.get(continent, 0.0) + value
+
+    def lookup(self, province, country):
+        if province:
+            name = normalize(province)
+            for key in ((name, country_key(self.registry, country)), (name, "")):
+                if key in self.provinces:
+                    return self.provinces[key]
+            index = self.registry.lookup(province)
+            return self.population[index] if index >= 0 else 0.0
+        index = self.registry.lookup(country)
+        if index >= 0:
+            return self.population[index]
+        return self.continents.get(country, self.provinces.get((normalize(country), ""), 0.0))
+
+    def rows(self, series):
+        return np.array([self.lookup(province, country) for province, country in zip(series.provinces, series.countries)])
+
+
+def read_population_table(path, registry):
+    # (name, population[, country]) rows. Without a country the name is a
+    # country name, alias or ISO code of the registry, or else the name of a
+    # province. With one the row is a province of that country, so a province
+    # named like a registry location (Bermuda, United Kingdom) neither
+    # replaces the location nor is taken for it. Rows that do not parse, like
+    # a header, are skipped
+    population = np.zeros(len(registry))
+    provinces = {}
+    with open(path, encoding="utf-8", newline="") as csv_file:
+        for row in csv.reader(csv_file):
+            try:
+                name, value = row[0], float(row[1])
+            except (ValueError, IndexError):
+                continue
+            country = row[2].strip() if len(row) > 2 else ""
+            index = registry.lookup(name) if not country else -1
+            if index >= 0:
+                population[index] = value
+            else:
+                provinces[normalize(name), country_key(registry, country)] = value
+    return PopulationTable(registry, population, provinces)
+
+
+class MetricEngine(object):
+    # The metrics of a CovidData, each computed for every row and date at
+    # once the first time it is asked for and kept. A metric is a CovidData
+    # of the same rows whose counts are the metric values, so the maxima
+    # index and the glyph layers draw it like the cumulative counts
+    def __init__(self, covid_data, population=None):
+        self.covid_data = covid_data
+        self.population = population
+        self.cache = {}
+
+    @property
+    def metrics(self):
+        return tuple(metric for metric in METRICS if metric != "per-capita" or self.population is not None)
+
+    def get(self, metric):
+        if metric == "cumulative":
+            return self.covid_data
+        if metric not in self.metrics:
+            raise ValueError("No {} metric, per-capita rates need a population table".format(metric))
+        if metric not in self.cache:
+            self.cache[metric] = CovidData(*[TimeSeries(series.provinces, series.countries, series.lat, series.long,
+                                                        self.compute(metric, name, series), series.dates)
+                                             for name, series in self.covid_data.series()])
+        return self.cache[metric]
+
+    def compute(self, metric, name, series):
+        if metric == "daily":
+            return daily(series.counts)
+        if metric in ("daily-7", "daily-14"):
+            return rolling_mean(self.get("daily").get(name).counts, int(metric.split("-")[1]))
+        if metric == "growth":
+            return growth_rate(series.counts)
+        if metric == "doubling":
+            return doubling_time(series.counts)
+        population = self.population.rows(series)[:, np.newaxis]
+        per_capita = np.zeros(series.counts.shape)
+        np.divide(series.counts * 1e6, population, out=per_capita, where=population > 0)
+        return per_capita
+
+    def clear(self):
+        # Forget the metrics after the series gained dates
+        self.cache = {}
+
+
+def legend_values(max_value, metric, count=4):
+    # (value, fraction of the largest radius) of the legend circles
+    scale = METRICS[metric][1]
+    values = []
+    for i in range(count):
+        if scale == "log" and max_value > 1:
+            value = math.pow(2, math.log2(max_value) / (i + 1))
+            values.append((value, math.log2(value) / math.log2(max_value)))
+        elif scale == "linear" and max_value > 0:
+            values.append((max_value / (i + 1), 1.0 / (i + 1)))
+        else:
+            values.append((0, 0.0))
+    return values
+
+
+def legend_text(value, metric):
+    label, scale, text = METRICS[metric]
+    return text(value) + " " + label
+
+
+def add_metric_arguments(parser):
+    parser.add_argument("--metric", type = str, default = "cumulative", choices = list(METRICS), help = "Case value the circles show")
+    parser.add_argument("--population", type = str, help = "CSV of (country, province or ISO code, population[, country of the province]) rows for the per-capita metric, e.g. written by zonal_stats.py")
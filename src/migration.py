@@ -3,122 +3,100 @@
 # This simple example shows how to do basic rendering and pipeline
 # creation.
 import datetime
-import math
-import os
 from datetime import timedelta
 
-from PyQt5.QtWidgets import QApplication, QWidget, QMainWindow, QSlider, QGridLayout, QLabel, QPushButton, QTextEdit
-import PyQt5.QtCore as QtCore
-from PyQt5.QtCore import Qt
+import numpy as np
 import vtk
-from vtk.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 from argparse import ArgumentParser
 import sys
-import csv
+
+from bundle import open_bundle
+from instrumentation import Profiler, add_profiler_arguments
+from locations import open_location_registry
+from migration_flows import MigrationLevels
+from migration_index import LEVELS
+from migration_ingest import load_flow_table
+from projection import Projection, add_projection_arguments
+from offscreen import add_export_arguments, export_frames, load_camera_settings
+
+# Qt is only needed for the interactive window, --export renders without it
+try:
+    from PyQt5.QtWidgets import QApplication, QWidget, QMainWindow, QSlider, QGridLayout, QLabel, QPushButton, QTextEdit
+    import PyQt5.QtCore as QtCore
+    from PyQt5.QtCore import Qt
+    from vtk.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
+except ImportError:
+    QApplication = None
 
 frame_counter = 0
 
 def main():
     # Initialize argument and constant variables
     parser = ArgumentParser("Create isosurfacing of object")
-    parser.add_argument("migration")
-    parser.add_argument("covid")
-    parser.add_argument("sat")
+    parser.add_argument("migration", nargs = "?")
+    parser.add_argument("covid", nargs = "?")
+    parser.add_argument("sat", nargs = "?")
+    parser.add_argument("--bundle", type = str, help = "Dataset bundle written by bundle.py build, replaces the three inputs")
     parser.add_argument("--camera", type = str, help = "Optional camera settings file")
+    parser.add_argument("--migration-threshold", type = float, default = 0.05, help = "Hide migration flows below this fraction of the largest flow")
+    parser.add_argument("--migration-top", type = int, help = "Only draw this many of the largest migration flows, instead of a threshold")
+    parser.add_argument("--migration-level", type = str, default = "auto", choices = ("auto",) + LEVELS, help = "Draw migration flows per country, summed per origin region, or pick by zoom")
+    parser.add_argument("--migration-overview", type = str, default = "subregion", choices = LEVELS[1:], help = "Origin regions of the zoomed out migration flows")
+    add_export_arguments(parser, dates=False)
+    add_profiler_arguments(parser)
+    add_projection_arguments(parser)
 
     args = parser.parse_args()
-
-    sat_reader = vtk.vtkJPEGReader()
-    sat_reader.SetFileName(args.sat)
-    sat_reader.Update()
-    sat_dimensions = sat_reader.GetOutput().GetDimensions()
+    profiler = Profiler(args.trace, args.stats_overlay)
+    bundle = open_bundle(args.bundle)
+    if not bundle and None in (args.migration, args.covid, args.sat):
+        parser.error("the three inputs are required without --bundle")
+
+    if bundle:
+        sat_image = bundle.satellite_image()
+    else:
+        sat_reader = vtk.vtkJPEGReader()
+        sat_reader.SetFileName(args.sat)
+        sat_reader.Update()
+        sat_image = sat_reader.GetOutput()
+    sat_dimensions = sat_image.GetDimensions()
     sat_x = sat_dimensions[0]
     sat_y = sat_dimensions[1]
 
+    # The image is drawn as it is, or as a texture on the projected map surface
+    projection = Projection(args.projection, args.projection_center)
     sat_mapper = vtk.vtkDataSetMapper()
-    sat_mapper.SetInputConnection(sat_reader.GetOutputPort())
-
     sat_actor = vtk.vtkActor()
     sat_actor.SetMapper(sat_mapper)
+    if projection.is_identity:
+        sat_mapper.SetInputData(sat_image)
+    else:
+        sat_mapper.SetInputData(projection.surface([0, sat_x, 0, sat_y]))
+        texture = vtk.vtkTexture()
+        texture.SetInputData(sat_image)
+        sat_actor.SetTexture(texture)
     sat_actor.GetProperty().SetOpacity(0.7)
 
     ren = vtk.vtkRenderer()
-    max_weight = [0]
-
-    def create_long_lat(file):
-        table = {}
-        with open(file) as csvDataFile:
-            csv_reader = csv.reader(csvDataFile)
-            for row in csv_reader:
-                try:
-                    table[row[0]] = [float(row[4]), float(row[5])]
-                except ValueError:
-                    continue
-        return table
-
-
-    def add_migration_info(loc_src, loc_dst, weight):
-        x1 = (sat_x / 360.0) * (180 + float(loc_src[1]))
-        y1 = (sat_y / 180.0) * (90 + float(loc_src[0]))
-
-        x2 = (sat_x / 360.0) * (180 + float(loc_dst[1]))
-        y2 = (sat_y / 180.0) * (90 + float(loc_dst[0]))
-
-        if weight > max_weight[0]:
-            max_weight[0] = weight
-
-        return {"x1": x1, "x2": x2, "y1": y1, "y2": y2, "weight": weight}
-
-    def process_migration_actors(actors):
-        arrow_actors = []
-        for actor in actors:
-            x1 = actor.get("x1")
-            y1 = actor.get("y1")
-            x2 = actor.get("x2")
-            y2 = actor.get("y2")
-            weight = actor.get("weight")
-
-            if weight < 0.05 * max_weight[0]:
-                continue
-
-            line_source = vtk.vtkLineSource()
-            line_source.SetPoint1(x1, y1, 0)
-            line_source.SetPoint2(x2, y2, 0)
-
-            line_mapper = vtk.vtkPolyDataMapper()
-            line_mapper.SetInputConnection(line_source.GetOutputPort())
-
-            line_actor = vtk.vtkActor()
-            line_actor.SetMapper(line_mapper)
-            line_actor.GetProperty().SetColor(1, 1, 1)
-            line_actor.GetProperty().SetOpacity(math.sqrt(0.99 * (weight / max_weight[0])))
-
-            ren.AddActor(line_actor)
-            arrow_actors.append(line_actor)
-
-        return arrow_actors
 
     # Read in data for global confirmed cases
-    location_map = create_long_lat(args.covid)
-    actors = []
-    for filename in os.listdir(args.migration):
-        if filename.endswith(".csv"):
-            with open(args.migration + "\\" + filename) as csvDataFile:
-                country = filename.split(".")[0]
-                if country not in location_map:
-                    continue
-                loc_dst = location_map[country]
-                csv_reader = csv.reader(csvDataFile)
-                for row in csv_reader:
-                    if row[2] not in location_map:
-                        continue
-                    loc_src = location_map[row[2]]
-                    try:
-                        actors.append(add_migration_info(loc_src, loc_dst, int(row[9])))
-                    except ValueError:
-                        continue
-
-    arrow_actors = process_migration_actors(actors)
+    with profiler.stage("load migration flows"):
+        if bundle:
+            migration_table = bundle.flow_table()
+        else:
+            migration_table = load_flow_table(args.migration, open_location_registry(args.covid))
+
+    # Country flows are drawn zoomed in and flows summed per origin region zoomed out
+    migration_layer = MigrationLevels(migration_table, args.migration_level, args.migration_overview,
+                                      sat_x, sat_y, lambda weight: np.sqrt(0.99 * weight),
+                                      args.migration_threshold, args.migration_top, projection=projection)
+    for migration_actor in migration_layer.actors():
+        ren.AddActor(migration_actor)
+    migration_layer.watch(ren)
+    profiler.watch(ren)
+    for overlay_actor in profiler.actors():
+        ren.AddActor(overlay_actor)
+
     # Initialize renderer and place actors
     ren.AddActor(sat_actor)
     ren.ResetCamera()
@@ -134,19 +112,16 @@ def main():
     ren.ResetCameraClippingRange()
 
     if args.camera:
-        reader = open(args.camera, "r")
-        line = reader.readline().split(",")
-        cam1.SetPosition(float(line[0]), float(line[1]), float(line[2]))
-        line = reader.readline().split(",")
-        cam1.SetFocalPoint(float(line[0]), float(line[1]), float(line[2]))
-        line = reader.readline().split(",")
-        cam1.SetViewUp(float(line[0]), float(line[1]), float(line[2]))
-        line = reader.readline().split(",")
-        cam1.SetClippingRange(float(line[0]), float(line[1]))
-        line = reader.readline().split(",")
-        cam1.SetViewAngle(float(line[0]))
-        line = reader.readline().split(",")
-        cam1.SetParallelScale(float(line[0]))
+        load_camera_settings(cam1, args.camera)
+
+    # The migration view is static, so an export is a single frame
+    if args.export:
+        export_frames(ren, lambda index: None, [0], args, profiler=profiler)
+        profiler.close()
+        return
+
+    if QApplication is None:
+        raise ImportError("PyQt5 is required for the interactive window, use --export to render offscreen")
 
     # Initialize PyQT5 UI and link to renderer
     app = QApplication([])
@@ -171,10 +146,20 @@ def main():
         slider.setTickPosition(QSlider.TicksAbove)
         slider.setRange(bounds[0], bounds[1])
 
+    slider_setup(ui.threshold_slider, round(args.migration_threshold * 1000), [0, 1000], 50)
+    ui.threshold_slider.setTracking(True)
+    ui.threshold_label.setText(threshold_text(args.migration_threshold))
+
     window.show()
     window.setWindowState(Qt.WindowMaximized)
     iren.Initialize()
 
+    def threshold_callback(val):
+        with profiler.stage("migration"):
+            migration_layer.set_threshold(val / 1000.0)
+        ui.threshold_label.setText(threshold_text(val / 1000.0))
+        ui.vtkWidget.GetRenderWindow().Render()
+
     # Handle screenshot button event
     def screenshot_callback():
         save_frame(ren.GetActiveCamera(), ui.vtkWidget.GetRenderWindow(), ui.log)
@@ -187,14 +172,18 @@ def main():
     def quit_callback():
         sys.exit()
 
-    # Register callbacks to UI
+    # Register callbacks to UI, the scene updates are timed as one event per callback
     ui.push_screenshot.clicked.connect(screenshot_callback)
     ui.push_camera.clicked.connect(camera_callback)
     ui.push_quit.clicked.connect(quit_callback)
+    ui.threshold_slider.valueChanged.connect(profiler.wrap("migration threshold", threshold_callback))
 
     # Terminate setup for PyQT5 interface
     sys.exit(app.exec_())
 
+def threshold_text(fraction):
+    return "Migration Threshold ({:.1f}%):".format(fraction * 100)
+
 class Ui_MainWindow(object):
     def setupUi(self, MainWindow):
         MainWindow.setObjectName('The Main Window')
@@ -203,6 +192,8 @@ class Ui_MainWindow(object):
         self.centralWidget = QWidget(MainWindow)
         self.gridlayout = QGridLayout(self.centralWidget)
         self.vtkWidget = QVTKRenderWindowInteractor(self.centralWidget)
+        self.threshold_slider = QSlider()
+        self.threshold_label = QLabel(threshold_text(0.05))
 
         self.push_screenshot = QPushButton()
         self.push_screenshot.setText('Save Screenshot')
@@ -220,6 +211,8 @@ class Ui_MainWindow(object):
         self.log.setReadOnly(True)
 
         self.gridlayout.addWidget(self.vtkWidget, 0, 0, 4, 4)
+        self.gridlayout.addWidget(self.threshold_label, 4, 0, 1, 1)
+        self.gridlayout.addWidget(self.threshold_slider, 4, 1, 1, 3)
         self.gridlayout.addWidget(self.push_screenshot, 0, 4, 1, 1)
         self.gridlayout.addWidget(self.push_camera, 0, 5, 1, 1)
         self.gridlayout.addWidget(self.camera_info, 2, 4, 1, 2)
@@ -0,0 +1,174 @@
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from projection import Projection
+from raster_pyramid import screen_pixel_size
+
+# Country flows are drawn once the view is lower than this fraction of the map
+DETAIL_SCALE = 0.5
+
+
+class MigrationFlowLayer(object):
+    # Every origin->destination flow as one line cell of a single polydata,
+    # drawn by one actor. Each cell carries its weight and an RGBA color
+    # whose alpha comes from `opacity(weight / max weight)`.
+    # Flows are sorted by increasing weight, so a weight cutoff or a top-K
+    # selection is always a suffix of the cells: it is found with a binary
+    # search and shown by pointing the cell array at a slice of the
+    # connectivity, nothing is rebuilt. The heaviest flows are drawn last.
+    # Flows whose `on_map` entry is False (an end on the far side of the
+    # map) are kept but transparent
+    def __init__(self, lines, weights, opacity, threshold=0.05, top=None, line_width=1, on_map=None):
+        weights = np.asarray(weights, dtype=np.float64)
+        self.order = np.argsort(weights, kind="stable")
+        self.weights = weights[self.order]
+        self.num_flows = len(self.weights)
+        self.max_weight = self.weights[-1] if self.num_flows else 0.0
+        self.visible = self.num_flows
+
+        # Lines are stored as (x1, y1, x2, y2), both ends get their own point
+        self.vtk_points = vtk.vtkPoints()
+        self.vtk_points.SetData(numpy_support.numpy_to_vtk(np.zeros((2 * self.num_flows, 3)), deep=1))
+        self.points = numpy_support.vtk_to_numpy(self.vtk_points.GetData())
+
+        self.offsets = np.arange(0, 2 * self.num_flows + 1, 2, dtype=np.int64)
+        self.connectivity = np.arange(2 * self.num_flows, dtype=np.int64)
+        self.cells = vtk.vtkCellArray()
+
+        self.alpha = np.full(self.num_flows, 255, dtype=np.uint8)
+        if self.max_weight > 0:
+            self.alpha[:] = np.round(255 * np.clip(opacity(self.weights / self.max_weight), 0, 1))
+        self.colors = np.full((self.num_flows, 4), 255, dtype=np.uint8)
+
+        self.polydata = vtk.vtkPolyData()
+        self.polydata.SetPoints(self.vtk_points)
+        self.polydata.SetLines(self.cells)
+        self.set_lines(lines, on_map)
+
+        self.mapper = vtk.vtkPolyDataMapper()
+        self.mapper.SetInputData(self.polydata)
+        self.mapper.SetScalarModeToUseCellFieldData()
+        self.mapper.SelectColorArray("colors")
+        self.mapper.SetColorModeToDirectScalars()
+
+        self.actor = vtk.vtkActor()
+        self.actor.SetMapper(self.mapper)
+        self.actor.GetProperty().SetLineWidth(line_width)
+
+        if top is not None:
+            self.set_top(top)
+        else:
+            self.set_threshold(threshold)
+
+    def set_lines(self, lines, on_map=None):
+        # Move the flows in place, e.g. to another projection
+        lines = np.asarray(lines, dtype=np.float64).reshape(-1, 4)[self.order]
+        self.points[0::2, :2] = lines[:, :2]
+        self.points[1::2, :2] = lines[:, 2:]
+        self.colors[:, 3] = self.alpha if on_map is None else np.where(np.asarray(on_map)[self.order], self.alpha, 0)
+        self.vtk_points.Modified()
+        self.polydata.Modified()
+
+    def count_above(self, weight):
+        return self.num_flows - int(np.searchsorted(self.weights, weight, side="left"))
+
+    def set_threshold(self, fraction):
+        # Keep the flows weighing at least `fraction` of the largest flow
+        self.show_heaviest(self.count_above(fraction * self.max_weight))
+
+    def set_top(self, count):
+        self.show_heaviest(count)
+
+    def show_heaviest(self, count):
+        count = min(max(int(count), 0), self.num_flows)
+        start = self.num_flows - count
+        self.visible = count
+
+        # Views of the sorted arrays, the cell data has to match the cells
+        self.cells.SetData(numpy_support.numpy_to_vtkIdTypeArray(self.offsets[:count + 1], deep=0),
+                           numpy_support.numpy_to_vtkIdTypeArray(self.connectivity[2 * start:], deep=0))
+
+        weight_array = numpy_support.numpy_to_vtk(self.weights[start:], deep=0)
+        weight_array.SetName("weight")
+        colors_array = numpy_support.numpy_to_vtk(self.colors[start:], deep=0)
+        colors_array.SetName("colors")
+        self.polydata.GetCellData().AddArray(weight_array)
+        self.polydata.GetCellData().AddArray(colors_array)
+        self.polydata.Modified()
+
+    def set_visible(self, visible):
+        self.actor.SetVisibility(visible)
+
+
+def flow_lines(flows, sat_x, sat_y, projection=None, key=None):
+    # Map the (origin lat, origin long, destination lat, destination long,
+    # weight) arrays of a flow table level onto the satellite image, with
+    # whether both ends are on the visible side of the map
+    projection = projection or Projection()
+    origin_lat, origin_long, destination_lat, destination_long, weight = flows
+    origin_x, origin_y, origin_visible = projection.project(origin_lat, origin_long, sat_x, sat_y,
+                                                            key and (key, "origin"))
+    destination_x, destination_y, destination_visible = projection.project(destination_lat, destination_long, sat_x, sat_y,
+                                                                           key and (key, "destination"))
+    lines = np.column_stack([origin_x, origin_y, destination_x, destination_y])
+    return lines, weight, origin_visible & destination_visible
+
+
+class MigrationLevels(object):
+    # Flow layers of several levels of a flow table, one of them visible. In
+    # "auto" mode the overview level (flows summed per origin region) is
+    # drawn when zoomed out and the country flows when zoomed in, checked
+    # before every render of the renderer it watches
+    def __init__(self, table, level, overview, sat_x, sat_y, opacity, threshold=0.05, top=None, line_width=1,
+                 projection=None):
+        self.auto = level == "auto"
+        levels = ["country", overview] if self.auto else [level]
+        self.flows = {name: table.flows(name) for name in levels}
+        self.sat_size = (sat_x, sat_y)
+        self.layers = {}
+        for name in levels:
+            lines, weights, on_map = flow_lines(self.flows[name], sat_x, sat_y, projection, ("flows", name))
+            self.layers[name] = MigrationFlowLayer(lines, weights, opacity, threshold, top, line_width, on_map)
+        self.overview = levels[-1]
+        self.level = self.overview
+        self.map_height = sat_y
+        self.visible = True
+        self.show()
+
+    def actors(self):
+        return [layer.actor for layer in self.layers.values()]
+
+    def show(self):
+        for name, layer in self.layers.items():
+            layer.set_visible(self.visible and name == self.level)
+
+    def set_visible(self, visible):
+        self.visible = visible
+        self.show()
+
+    def set_threshold(self, fraction):
+        for layer in self.layers.values():
+            layer.set_threshold(fraction)
+
+    def set_top(self, count):
+        for layer in self.layers.values():
+            layer.set_top(count)
+
+    def set_projection(self, projection):
+        for name, layer in self.layers.items():
+            lines, weights, on_map = flow_lines(self.flows[name], *self.sat_size, projection, ("flows", name))
+            layer.set_lines(lines, on_map)
+            layer.show_heaviest(layer.visible)
+
+    def update(self, renderer):
+        if not self.auto:
+            return
+        visible_height = screen_pixel_size(renderer) * renderer.GetSize()[1]
+        level = "country" if visible_height < DETAIL_SCALE * self.map_height else self.overview
+        if level != self.level:
+            self.level = level
+            self.show()
+
+    def watch(self, renderer):
+        renderer.AddObserver("StartEvent", lambda obj, event: self.update(obj))
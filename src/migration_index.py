@@ -0,0 +1,92 @@
+import numpy as np
+
+# Columns of the UN migration rows holding the region of the origin country
+GROUP_COLUMNS = {"continent": 4, "subregion": 6, "development": 8}
+LEVELS = ("country", "subregion", "continent", "development")
+
+
+def flow_record(destination, row):
+    # The parts of a UN row the flow table keeps: destination, origin,
+    # continent, subregion, development group and weight
+    return (destination, row[2], row[GROUP_COLUMNS["continent"]], row[GROUP_COLUMNS["subregion"]],
+            row[GROUP_COLUMNS["development"]], int(row[9]))
+
+
+class FlowTable(object):
+    # Country to country migration flows with every name stored once. The
+    # destination and origin columns index `countries`, `groups[level]`
+    # indexes `group_names[level]` for the region of the origin. Flows
+    # summed per (destination, origin region) are computed up front for
+    # every level
+    def __init__(self, countries, destination, origin, weight, lat, long, group_names, groups):
+        self.countries = countries
+        self.destination = destination
+        self.origin = origin
+        self.weight = weight
+        self.lat = lat
+        self.long = long
+        self.group_names = group_names
+        self.groups = groups
+
+        self.aggregates = {level: self.aggregate(level) for level in GROUP_COLUMNS}
+
+    @property
+    def num_flows(self):
+        return len(self.weight)
+
+    def aggregate(self, level):
+        # Sum the flows of every (destination, origin region) pair, the
+        # origin end sits at the weighted centroid of the origin countries
+        num_groups = len(self.group_names[level])
+        keys, inverse = np.unique(self.destination * num_groups + self.groups[level], return_inverse=True)
+        weight = np.bincount(inverse, weights=self.weight, minlength=len(keys))
+        count = np.bincount(inverse, minlength=len(keys))
+
+        centroid = []
+        for values in (self.lat[self.origin], self.long[self.origin]):
+            weighted = np.bincount(inverse, weights=self.weight * values, minlength=len(keys))
+            plain = np.bincount(inverse, weights=values, minlength=len(keys)) / count
+            centroid.append(np.where(weight > 0, weighted / np.where(weight > 0, weight, 1), plain))
+
+        return {"destination": keys // num_groups, "group": keys % num_groups, "weight": weight,
+                "lat": centroid[0], "long": centroid[1]}
+
+    def flows(self, level="country"):
+        # Origin and destination coordinates plus weight of every flow of a
+        # level, as (origin lat, origin long, destination lat, destination long, weight)
+        if level == "country":
+            return (self.lat[self.origin], self.long[self.origin],
+                    self.lat[self.destination], self.long[self.destination], self.weight)
+        aggregate = self.aggregates[level]
+        return (aggregate["lat"], aggregate["long"],
+                self.lat[aggregate["destination"]], self.long[aggregate["destination"]], aggregate["weight"])
+
+
+def build_flow_table(records, registry):
+    # Flow table of `flow_record` tuples joined on the location registry ids
+    # of their names, every distinct name is looked up once. Flows whose
+    # destination or origin has no location (the "Total" and "Unknown" rows)
+    # are dropped. When a table names the same origin twice, e.g. "China"
+    # and "China (including Hong Kong ...)", the countries.csv spelling wins
+    columns = list(zip(*records)) if records else [()] * 6
+    destination = registry.ids(columns[0])
+    origin = registry.ids(columns[1])
+    located = np.flatnonzero((destination >= 0) & (origin >= 0))
+
+    listed = registry.is_listed(columns[1])[located]
+    order = np.lexsort((located, ~listed, origin[located], destination[located]))
+    pairs = destination[located][order].astype(np.int64) * len(registry) + origin[located][order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = pairs[1:] != pairs[:-1]
+    keep = np.sort(located[order[first]])
+
+    used, codes = np.unique(np.concatenate([destination[keep], origin[keep]]), return_inverse=True)
+
+    group_names = {}
+    groups = {}
+    for level, column in (("continent", 2), ("subregion", 3), ("development", 4)):
+        group_names[level], groups[level] = np.unique(np.array(columns[column], dtype=str)[keep], return_inverse=True)
+
+    return FlowTable(registry.names[used], codes[:len(keep)], codes[len(keep):],
+                     np.array(columns[5], dtype=np.float64)[keep], registry.lat[used], registry.long[used],
+                     group_names, groups)
@@ -0,0 +1,103 @@
+import csv
+import multiprocessing
+import os
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+from migration_index import GROUP_COLUMNS, build_flow_table, flow_record
+
+
+def migration_files(directory):
+    # (destination country, path) of every UN table in the directory, the
+    # file name without extension is the destination
+    files = []
+    for entry in os.scandir(directory):
+        name, extension = os.path.splitext(entry.name)
+        if entry.is_file() and extension.lower() == ".csv":
+            files.append((name, entry.path))
+    return sorted(files)
+
+
+def read_flow_file(destination, path):
+    # The tables are Latin-1, rows without a count ("..") or with a header
+    # are skipped. The continent of every origin is kept from all rows, as
+    # rows without a count still name it
+    records = []
+    continents = {}
+    continent_column = GROUP_COLUMNS["continent"]
+    with open(path, encoding="latin-1", newline="") as csv_file:
+        for row in csv.reader(csv_file):
+            if len(row) > continent_column and row[continent_column]:
+                continents.setdefault(row[2], row[continent_column])
+            try:
+                records.append(flow_record(destination, row))
+            except (ValueError, IndexError):
+                continue
+    return records, continents
+
+
+def read_migration_tables(directory, destinations=None, workers=None):
+    # Parse every table of the directory on a process pool into the flow
+    # records, in the order of the sorted file names whatever the parse
+    # order, and the continent of every origin. The tables do not all list
+    # the same origins. Parsing the rows is pure Python, so threads would
+    # take turns on the GIL. Workers are spawned rather than forked, as the
+    # viewers call this from their loading threads
+    files = [(name, path) for name, path in migration_files(directory)
+             if destinations is None or name in destinations]
+    if not files:
+        return [], {}
+    workers = workers or os.cpu_count() or 1
+    names, paths = zip(*files)
+    if workers == 1:
+        # A single worker parses in this process, spawning one only costs
+        # its start-up
+        return merge_flow_files(map(read_flow_file, names, paths))
+    chunksize = max(1, len(files) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return merge_flow_files(pool.map(read_flow_file, names, paths, chunksize=chunksize))
+
+
+def merge_flow_files(results):
+    records = []
+    continents = {}
+    for file_records, file_continents in results:
+        records.extend(file_records)
+        for origin, continent in file_continents.items():
+            continents.setdefault(origin, continent)
+    return records, continents
+
+
+def read_flow_records(directory, destinations=None, workers=None):
+    return read_migration_tables(directory, destinations, workers)[0]
+
+
+def read_origin_continents(directory, workers=None):
+    return read_migration_tables(directory, workers=workers)[1]
+
+
+def load_flow_table(directory, registry, workers=None):
+    # Flow table of the UN migration directory joined on a LocationRegistry,
+    # destinations without a location are not read at all. The continents
+    # the registry lacks are filled from the same parse, so a viewer that
+    # needs both reads the tables once
+    records, continents = read_migration_tables(directory, registry, workers)
+    registry.set_continents(continents)
+    return build_flow_table(records, registry)
+
+
+def main():
+    parser = ArgumentParser("Read a directory of UN migration tables")
+    parser.add_argument("migration")
+    parser.add_argument("--workers", type = int, help = "Number of reader processes, defaults to the number of CPUs")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    records = read_flow_records(args.migration, workers=args.workers)
+    elapsed = time.perf_counter() - start
+    print("Read {} flows from {} files in {:.3f}s".format(len(records), len(migration_files(args.migration)), elapsed))
+
+
+if __name__ == '__main__':
+    main()
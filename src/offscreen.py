@@ -0,0 +1,187 @@
+import multiprocessing
+import os
+import subprocess
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from instrumentation import Profiler
+
+
+def add_export_arguments(parser, dates=True):
+    # Command line options shared by every script that can render without a window
+    parser.add_argument("--export", type = str, help = "Render offscreen into this directory instead of opening a window")
+    parser.add_argument("--video", type = str, help = "Also encode the exported frames into this video file (needs ffmpeg)")
+    parser.add_argument("--size", type = int, nargs = 2, default = [1280, 720], metavar = ("WIDTH", "HEIGHT"), help = "Size of the exported frames")
+    parser.add_argument("--prefix", type = str, default = "frame", help = "File name prefix of the exported frames")
+    if dates:
+        parser.add_argument("--start", type = int, default = 0, help = "First date index to export")
+        parser.add_argument("--end", type = int, help = "Last date index to export (inclusive)")
+        parser.add_argument("--stride", type = int, default = 1, help = "Number of days between exported frames")
+        parser.add_argument("--fps", type = int, default = 10, help = "Frame rate of the exported video")
+        parser.add_argument("--workers", type = int, default = 1, help = "Number of processes rendering frames in parallel")
+
+
+def load_camera_settings(camera, path):
+    # Camera files are written by save_frame: position, focal point, view up,
+    # clipping range, view angle and parallel scale, one per line
+    with open(path, "r") as reader:
+        line = reader.readline().split(",")
+        camera.SetPosition(float(line[0]), float(line[1]), float(line[2]))
+        line = reader.readline().split(",")
+        camera.SetFocalPoint(float(line[0]), float(line[1]), float(line[2]))
+        line = reader.readline().split(",")
+        camera.SetViewUp(float(line[0]), float(line[1]), float(line[2]))
+        line = reader.readline().split(",")
+        camera.SetClippingRange(float(line[0]), float(line[1]))
+        line = reader.readline().split(",")
+        camera.SetViewAngle(float(line[0]))
+        line = reader.readline().split(",")
+        camera.SetParallelScale(float(line[0]))
+
+
+def export_dates(num_dates, start=0, end=None, stride=1):
+    if end is None or end >= num_dates:
+        end = num_dates - 1
+    return list(range(max(start, 0), end + 1, max(stride, 1)))
+
+
+def frame_path(directory, prefix, index):
+    return os.path.join(directory, prefix + "-" + str(index).zfill(5) + ".png")
+
+
+def create_render_window(ren, width, height):
+    window = vtk.vtkRenderWindow()
+    window.SetOffScreenRendering(1)
+    window.AddRenderer(ren)
+    window.SetSize(width, height)
+    window.SetAlphaBitPlanes(True)
+    window.SetMultiSamples(0)
+    return window
+
+
+class FrameWriter(object):
+    # Grabs the render window after every Render() and writes it as a
+    # numbered PNG, optionally streaming the same frames into ffmpeg
+    def __init__(self, window, directory, prefix, video=None, fps=10):
+        self.window = window
+        self.directory = directory
+        self.prefix = prefix
+        os.makedirs(directory, exist_ok=True)
+
+        self.image = vtk.vtkWindowToImageFilter()
+        self.image.SetInput(window)
+        self.image.ReadFrontBufferOff()
+        # The frame was just rendered by the caller, grab it as it is
+        self.image.ShouldRerenderOff()
+
+        self.png_writer = vtk.vtkPNGWriter()
+        self.png_writer.SetInputConnection(self.image.GetOutputPort())
+
+        self.video = None
+        if video:
+            width, height = window.GetSize()
+            self.video = open_video(video, width, height, fps)
+
+    def write(self, index):
+        self.image.Modified()
+        self.png_writer.SetFileName(frame_path(self.directory, self.prefix, index))
+        self.png_writer.Write()
+        if self.video:
+            self.video.stdin.write(image_to_rgb(self.image.GetOutput()).tobytes())
+
+    def close(self):
+        if self.video:
+            close_video(self.video)
+            self.video = None
+
+
+def image_to_rgb(image):
+    # VTK images start at the bottom row, video frames at the top one
+    width, height, _ = image.GetDimensions()
+    scalars = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+    pixels = scalars.reshape(height, width, -1)[::-1, :, :3]
+    return np.ascontiguousarray(pixels)
+
+
+def open_video(path, width, height, fps):
+    command = ["ffmpeg", "-y", "-loglevel", "error",
+               "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", str(width) + "x" + str(height), "-r", str(fps), "-i", "-",
+               "-pix_fmt", "yuv420p", "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", path]
+    return subprocess.Popen(command, stdin=subprocess.PIPE)
+
+
+def close_video(process):
+    process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError("ffmpeg failed to encode the video")
+
+
+def export_frames(ren, set_date, dates, args, log=print, profiler=None):
+    # Render every requested date into its own numbered frame without any
+    # window system, `set_date` updates the scene for a date index
+    profiler = profiler or Profiler(enabled=False)
+    window = create_render_window(ren, args.size[0], args.size[1])
+    writer = FrameWriter(window, args.export, args.prefix, getattr(args, "video", None), getattr(args, "fps", 10))
+    try:
+        for index in dates:
+            with profiler.event("export"):
+                set_date(index)
+                window.Render()
+                with profiler.stage("write"):
+                    writer.write(index)
+            log("Exported {}".format(frame_path(args.export, args.prefix, index)))
+    finally:
+        writer.close()
+
+
+# State of a rendering process in a parallel export, set up once per worker
+worker_state = {}
+
+
+def init_export_worker(build_scene, args):
+    ren, set_date = build_scene(args)
+    window = create_render_window(ren, args.size[0], args.size[1])
+    worker_state["set_date"] = set_date
+    worker_state["window"] = window
+    worker_state["writer"] = FrameWriter(window, args.export, args.prefix)
+
+
+def render_export_frame(index):
+    worker_state["set_date"](index)
+    worker_state["window"].Render()
+    worker_state["writer"].write(index)
+    return index
+
+
+def assemble_video(directory, prefix, dates, path, fps):
+    # Frames of a parallel export finish in any order, so the video is only
+    # encoded once all of them are on disk
+    reader = vtk.vtkPNGReader()
+    video = None
+    for index in dates:
+        reader.SetFileName(frame_path(directory, prefix, index))
+        reader.Update()
+        image = reader.GetOutput()
+        if video is None:
+            width, height, _ = image.GetDimensions()
+            video = open_video(path, width, height, fps)
+        video.stdin.write(image_to_rgb(image).tobytes())
+    if video:
+        close_video(video)
+
+
+def export_frames_parallel(build_scene, args, dates, log=print):
+    # Split the dates over a pool of processes, each with its own offscreen
+    # window. `build_scene(args)` must be a module level function returning
+    # the renderer and the function that sets a date index
+    os.makedirs(args.export, exist_ok=True)
+    context = multiprocessing.get_context("spawn")
+    chunksize = max(1, len(dates) // (args.workers * 4))
+    with context.Pool(args.workers, initializer=init_export_worker, initargs=(build_scene, args)) as pool:
+        for index in pool.imap_unordered(render_export_frame, dates, chunksize):
+            log("Exported {}".format(frame_path(args.export, args.prefix, index)))
+
+    if getattr(args, "video", None):
+        assemble_video(args.export, args.prefix, dates, args.video, args.fps)
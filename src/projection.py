@@ -0,0 +1,135 @@
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+# Projections map lat/long arrays in degrees onto the satellite image
+# rectangle [0, sat_x] x [0, sat_y] in one call, and tell which points lie on
+# the visible side of the map. Equirectangular is the layout of the image
+# itself, the others warp it to fit the same rectangle
+
+
+def equirectangular(lat, long, sat_x, sat_y, center=(0.0, 0.0)):
+    x = (sat_x / 360.0) * (180 + long)
+    y = (sat_y / 180.0) * (90 + lat)
+    return x, y, np.ones(np.shape(x), dtype=bool)
+
+
+# Parallel length and distance from the equator of the Robinson projection,
+# tabulated every 5 degrees of latitude
+ROBINSON_LATITUDES = np.arange(0, 91, 5)
+ROBINSON_LENGTH = np.array([1.0000, 0.9986, 0.9954, 0.9900, 0.9822, 0.9730, 0.9600, 0.9427, 0.9216, 0.8962,
+                            0.8679, 0.8350, 0.7986, 0.7597, 0.7186, 0.6732, 0.6213, 0.5722, 0.5322])
+ROBINSON_DISTANCE = np.array([0.0000, 0.0620, 0.1240, 0.1860, 0.2480, 0.3100, 0.3720, 0.4340, 0.4958, 0.5571,
+                              0.6176, 0.6769, 0.7346, 0.7903, 0.8435, 0.8936, 0.9394, 0.9761, 1.0000])
+
+
+def robinson(lat, long, sat_x, sat_y, center=(0.0, 0.0)):
+    # Interpolated linearly in the table and scaled so the equator and the
+    # central meridian span the image
+    lat = np.asarray(lat, dtype=np.float64)
+    long = np.asarray(long, dtype=np.float64)
+    length = np.interp(np.abs(lat), ROBINSON_LATITUDES, ROBINSON_LENGTH)
+    distance = np.interp(np.abs(lat), ROBINSON_LATITUDES, ROBINSON_DISTANCE)
+    x = (sat_x / 2.0) * (1 + length * long / 180.0)
+    y = (sat_y / 2.0) * (1 + np.sign(lat) * distance)
+    return x, y, np.ones(np.shape(x), dtype=bool)
+
+
+def orthographic(lat, long, sat_x, sat_y, center=(0.0, 0.0)):
+    # The globe seen from above `center` (lat, long) as a disc of the image
+    # height in the middle of the image, the far side is not visible
+    lat = np.radians(lat)
+    delta = np.radians(np.asarray(long, dtype=np.float64) - center[1])
+    center_lat = np.radians(center[0])
+    x = np.cos(lat) * np.sin(delta)
+    y = np.cos(center_lat) * np.sin(lat) - np.sin(center_lat) * np.cos(lat) * np.cos(delta)
+    visible = np.sin(center_lat) * np.sin(lat) + np.cos(center_lat) * np.cos(lat) * np.cos(delta) >= 0
+    return sat_x / 2.0 + (sat_y / 2.0) * x, (sat_y / 2.0) * (1 + y), visible
+
+
+PROJECTIONS = {"equirectangular": equirectangular, "robinson": robinson, "orthographic": orthographic}
+
+
+class Projection(object):
+    # The projection the viewers draw with. Projected positions are cached
+    # per dataset key, satellite size and projection, so switching back to
+    # a projection or rebuilding a layer over the same arrays costs nothing.
+    # An entry is only reused while the caller passes the very same arrays
+    def __init__(self, name="equirectangular", center=(0.0, 0.0)):
+        self.entries = {}
+        self.center = (0.0, 0.0)
+        self.set_projection(name, center)
+
+    @property
+    def is_identity(self):
+        # The satellite image needs no warping
+        return self.name == "equirectangular"
+
+    def set_projection(self, name, center=None):
+        if name not in PROJECTIONS:
+            raise ValueError("Unknown projection {}, expected one of {}".format(name, ", ".join(sorted(PROJECTIONS))))
+        self.name = name
+        if center is not None:
+            self.center = (float(center[0]), float(center[1]))
+
+    def project(self, lat, long, sat_x, sat_y, key=None):
+        if key is None:
+            return PROJECTIONS[self.name](lat, long, sat_x, sat_y, self.center)
+        entry_key = (key, sat_x, sat_y, self.name, self.center)
+        entry = self.entries.get(entry_key)
+        if entry is None or entry[0] is not lat or entry[1] is not long:
+            entry = (lat, long, PROJECTIONS[self.name](lat, long, sat_x, sat_y, self.center))
+            self.entries[entry_key] = entry
+        return entry[2]
+
+    def surface(self, bounds, resolution=(360, 180)):
+        # Textured plane over `bounds` (x min, x max, y min, y max), the
+        # whole globe, with its points projected. Cells with a corner on the
+        # far side are left out
+        plane = vtk.vtkPlaneSource()
+        plane.SetOrigin(bounds[0], bounds[2], 0)
+        plane.SetPoint1(bounds[1], bounds[2], 0)
+        plane.SetPoint2(bounds[0], bounds[3], 0)
+        plane.SetResolution(*resolution)
+        plane.Update()
+        grid = plane.GetOutput()
+
+        width = bounds[1] - bounds[0]
+        height = bounds[3] - bounds[2]
+        points = numpy_support.vtk_to_numpy(grid.GetPoints().GetData())
+        long = (points[:, 0] - bounds[0]) * (360.0 / width) - 180
+        lat = (points[:, 1] - bounds[2]) * (180.0 / height) - 90
+        x, y, visible = PROJECTIONS[self.name](lat, long, width, height, self.center)
+        projected = np.column_stack([bounds[0] + x, bounds[2] + y, points[:, 2]])
+
+        polys = grid.GetPolys()
+        offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray())
+        connectivity = numpy_support.vtk_to_numpy(polys.GetConnectivityArray())
+        keep = np.minimum.reduceat(visible[connectivity].astype(np.uint8), offsets[:-1]).astype(bool)
+        sizes = np.diff(offsets)[keep]
+        kept = np.repeat(keep, np.diff(offsets))
+        cells = vtk.vtkCellArray()
+        cells.SetData(numpy_support.numpy_to_vtkIdTypeArray(np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64), deep=1),
+                      numpy_support.numpy_to_vtkIdTypeArray(connectivity[kept].astype(np.int64), deep=1))
+
+        vtk_points = vtk.vtkPoints()
+        vtk_points.SetData(numpy_support.numpy_to_vtk(projected, deep=1))
+        surface = vtk.vtkPolyData()
+        surface.SetPoints(vtk_points)
+        surface.SetPolys(cells)
+        surface.GetPointData().ShallowCopy(grid.GetPointData())
+        return surface
+
+
+def set_map_surface(mapper, projection, bounds, plane_port):
+    # Feed a mapper of the satellite image or a raster either the flat
+    # plane of `plane_port` or its projected surface
+    if projection is None or projection.is_identity:
+        mapper.SetInputConnection(plane_port)
+    else:
+        mapper.SetInputData(projection.surface(bounds))
+
+
+def add_projection_arguments(parser):
+    parser.add_argument("--projection", type = str, default = "equirectangular", choices = sorted(PROJECTIONS), help = "Map projection of the satellite image and the data drawn over it")
+    parser.add_argument("--projection-center", type = float, nargs = 2, default = [0.0, 0.0], metavar = ("LAT", "LONG"), help = "Point of the globe facing the viewer in the orthographic projection")
@@ -0,0 +1,68 @@
+import vtk
+
+from projection import set_map_surface
+from raster_pyramid import screen_pixel_size
+
+
+class RasterLayer(object):
+    # Draws a raster as a texture colored by a lookup table on a single plane
+    # spanning `bounds` (x min, x max, y min, y max), normally the extent of
+    # the satellite image. The texture follows the pyramid level that matches
+    # the zoom, checked before every render of the renderer it watches.
+    # With a projection other than equirectangular the plane is warped
+    def __init__(self, pyramid, lut, bounds, opacity, projection=None):
+        self.pyramid = None
+        self.current = None
+        self.bounds = bounds
+        self.width = bounds[1] - bounds[0]
+
+        self.colors = vtk.vtkImageMapToColors()
+        self.colors.SetOutputFormatToRGBA()
+        self.colors.SetLookupTable(lut)
+
+        self.texture = vtk.vtkTexture()
+        self.texture.SetInputConnection(self.colors.GetOutputPort())
+        self.texture.InterpolateOn()
+
+        self.plane = vtk.vtkPlaneSource()
+        self.plane.SetOrigin(bounds[0], bounds[2], 0)
+        self.plane.SetPoint1(bounds[1], bounds[2], 0)
+        self.plane.SetPoint2(bounds[0], bounds[3], 0)
+
+        self.mapper = vtk.vtkPolyDataMapper()
+        self.set_projection(projection)
+
+        self.actor = vtk.vtkActor()
+        self.actor.SetMapper(self.mapper)
+        self.actor.SetTexture(self.texture)
+        self.actor.GetProperty().SetOpacity(opacity)
+
+        self.set_pyramid(pyramid)
+
+    def set_projection(self, projection):
+        set_map_surface(self.mapper, projection, self.bounds, self.plane.GetOutputPort())
+
+    def set_lookup_table(self, lut):
+        self.colors.SetLookupTable(lut)
+
+    def set_pyramid(self, pyramid):
+        # A new month keeps the level of the previous one until the next render
+        if pyramid is not self.pyramid:
+            self.pyramid = pyramid
+            self.colors.SetInputData(pyramid.level(self.current or 0))
+
+    def update(self, renderer):
+        if not self.actor.GetVisibility():
+            return
+        cell_size = self.width / max(self.pyramid.levels[0].GetDimensions()[0] - 1, 1)
+        index = self.pyramid.level_for_pixel(screen_pixel_size(renderer) / cell_size)
+        if index != self.current:
+            self.current = index
+            self.colors.SetInputData(self.pyramid.level(index))
+
+
+def watch_raster_layers(renderer, layers):
+    def update_levels(obj, event):
+        for layer in layers:
+            layer.update(obj)
+    renderer.AddObserver("StartEvent", update_levels)
@@ -0,0 +1,89 @@
+import math
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from raster_store import NODATA_THRESHOLD, image_values
+
+
+def valid_mask(values):
+    # Stored rasters mark missing cells with code 0, GeoTIFFs with -3.4e38
+    if np.issubdtype(values.dtype, np.integer):
+        return values != 0
+    return (values > NODATA_THRESHOLD) & np.isfinite(values)
+
+
+def block_mean(values, valid):
+    # Average every 2x2 block over its valid cells only, so coasts do not
+    # bleed into the nodata value. Odd edges are padded with invalid cells
+    height, width = values.shape
+    if height % 2 or width % 2:
+        values = np.pad(values, ((0, height % 2), (0, width % 2)), mode="edge")
+        valid = np.pad(valid, ((0, height % 2), (0, width % 2)))
+    shape = (values.shape[0] // 2, 2, values.shape[1] // 2, 2)
+    weights = valid.reshape(shape).sum(axis=(1, 3), dtype=np.int32)
+    sums = np.where(valid, values, 0).reshape(shape).sum(axis=(1, 3), dtype=np.float32)
+    return sums / np.maximum(weights, 1), weights > 0
+
+
+def screen_pixel_size(renderer):
+    # Size of a screen pixel in world units, measured at the focal point
+    # which the viewers keep on the raster plane
+    camera = renderer.GetActiveCamera()
+    if camera.GetParallelProjection():
+        visible_height = 2 * camera.GetParallelScale()
+    else:
+        visible_height = 2 * camera.GetDistance() * math.tan(math.radians(camera.GetViewAngle()) / 2)
+    return visible_height / max(renderer.GetSize()[1], 1)
+
+
+class RasterPyramid(object):
+    # Full resolution raster plus 2x downsampled levels, built on first use.
+    # Every level covers the same extent, its spacing grows instead
+    def __init__(self, image, valid=None, min_size=64):
+        self.levels = [image]
+        self.values = image_values(image)
+        self.valid = valid_mask(self.values) if valid is None else valid
+        invalid = self.values[~self.valid]
+        self.fill = invalid[0] if len(invalid) else 0
+
+        width, height, _ = image.GetDimensions()
+        self.num_levels = 1
+        while min(width, height) > 2 * min_size:
+            width, height = (width + 1) // 2, (height + 1) // 2
+            self.num_levels += 1
+
+    def level(self, index):
+        index = min(max(index, 0), self.num_levels - 1)
+        while len(self.levels) <= index:
+            self.values, self.valid = block_mean(self.values, self.valid)
+            self.levels.append(self.level_image())
+        return self.levels[index]
+
+    def level_image(self):
+        base = self.levels[0]
+        values = self.values
+        dtype = image_values(base).dtype
+        if np.issubdtype(dtype, np.integer):
+            values = np.rint(values)
+        values = values.astype(dtype)
+        values[~self.valid] = self.fill
+
+        width, height, _ = base.GetDimensions()
+        spacing = base.GetSpacing()
+        image = vtk.vtkImageData()
+        image.SetDimensions(values.shape[1], values.shape[0], 1)
+        image.SetSpacing(spacing[0] * (width - 1) / max(values.shape[1] - 1, 1),
+                         spacing[1] * (height - 1) / max(values.shape[0] - 1, 1),
+                         spacing[2])
+        image.SetOrigin(base.GetOrigin())
+        image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(values.ravel(), deep=1))
+        return image
+
+    def level_for_pixel(self, cells):
+        # Coarsest level whose cells are still no larger than a screen pixel,
+        # `cells` is the pixel size in full resolution cells
+        if cells <= 1:
+            return 0
+        return min(int(math.log2(cells)), self.num_levels - 1)
@@ -0,0 +1,203 @@
+import json
+import os
+from argparse import ArgumentParser
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from climate_cache import climate_file_name, climate_layer_name
+
+# Rasters are stored as 16 bit codes, code 0 marks the cells without data
+# (the GeoTIFFs use -3.4e38 for them)
+CODE_MAX = 65535
+NODATA_THRESHOLD = -1e30
+META_FILE = "rasters.json"
+
+
+def source_stamp(path):
+    status = os.stat(path)
+    return {"source": os.path.abspath(path), "mtime": status.st_mtime_ns, "size": status.st_size}
+
+
+def read_tiff(path):
+    reader = vtk.vtkTIFFReader()
+    reader.SetFileName(path)
+    reader.Update()
+    return reader
+
+
+def image_values(image):
+    width, height, _ = image.GetDimensions()
+    return numpy_support.vtk_to_numpy(image.GetPointData().GetScalars()).reshape(height, width)
+
+
+def quantize(values, valid, low, high):
+    # Spread the valid values linearly over codes 1..CODE_MAX, a code maps
+    # back to offset + scale * code
+    scale = (high - low) / (CODE_MAX - 1) if high > low else 1.0
+    codes = np.zeros(values.shape, dtype=np.uint16)
+    codes[valid] = np.rint((values[valid] - low) / scale).astype(np.uint16) + 1
+    return codes, low - scale, scale
+
+
+def layer_image(meta, codes):
+    # Image of a stored layer around its codes, without a copy
+    image = vtk.vtkImageData()
+    image.SetDimensions(meta["dimensions"])
+    image.SetSpacing(meta["spacing"])
+    image.SetOrigin(meta["origin"])
+    image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(codes.ravel(), deep=0))
+    return image
+
+
+def layer_code_values(meta):
+    return meta["offset"] + meta["scale"] * np.arange(CODE_MAX + 1, dtype=np.float64)
+
+
+class RasterStore(object):
+    # Directory of preprocessed rasters: one .npy of codes per layer plus a
+    # JSON header with the geometry, quantization and source file of each
+    # layer. Layers are memory mapped and handed to VTK without a copy
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.meta = {}
+        meta_path = os.path.join(directory, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as meta_file:
+                self.meta = json.load(meta_file)
+
+    def layer_path(self, name):
+        return os.path.join(self.directory, name + ".npy")
+
+    def is_current(self, name, path):
+        meta = self.meta.get(name)
+        if meta is None or not os.path.exists(self.layer_path(name)):
+            return False
+        stamp = source_stamp(path)
+        return all(meta[key] == stamp[key] for key in stamp)
+
+    def write_meta(self):
+        meta_path = os.path.join(self.directory, META_FILE)
+        with open(meta_path + ".tmp", "w") as meta_file:
+            json.dump(self.meta, meta_file, indent=1)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def add_layer(self, name, path, image, codes, offset, scale, scalar_range):
+        np.save(self.layer_path(name), codes)
+        meta = source_stamp(path)
+        meta.update({"dimensions": list(image.GetDimensions()),
+                     "spacing": list(image.GetSpacing()),
+                     "origin": list(image.GetOrigin()),
+                     "offset": offset,
+                     "scale": scale,
+                     "scalar_range": list(scalar_range)})
+        self.meta[name] = meta
+
+    def add_density(self, path, name="density"):
+        # Same log scale as the viewers apply to the SEDAC density
+        reader = read_tiff(path)
+        density_log = vtk.vtkImageLogarithmicScale()
+        density_log.SetInputConnection(reader.GetOutputPort())
+        density_log.SetConstant(0.435)
+        density_log.Update()
+        image = density_log.GetOutput()
+
+        raw = image_values(reader.GetOutput())
+        values = image_values(image)
+        valid = (raw > NODATA_THRESHOLD) & np.isfinite(values)
+        low, high = (values[valid].min(), values[valid].max()) if valid.any() else (0.0, 0.0)
+        codes, offset, scale = quantize(values, valid, float(low), float(high))
+        self.add_layer(name, path, image, codes, offset, scale, image.GetScalarRange())
+        self.write_meta()
+
+    def add_climate(self, path):
+        # All months of a variable share one quantization, so a mapper keeps
+        # the same code range when the month changes
+        months = {}
+        for month in range(1, 13):
+            image = read_tiff(climate_file_name(path, month)).GetOutput()
+            values = image_values(image)
+            months[month] = (image, values, (values > NODATA_THRESHOLD) & np.isfinite(values))
+
+        low = min(float(values[valid].min()) for image, values, valid in months.values() if valid.any())
+        high = max(float(values[valid].max()) for image, values, valid in months.values() if valid.any())
+        for month, (image, values, valid) in months.items():
+            codes, offset, scale = quantize(values, valid, low, high)
+            self.add_layer(climate_layer_name(path, month), climate_file_name(path, month),
+                           image, codes, offset, scale, image.GetScalarRange())
+        self.write_meta()
+
+    def climate_is_current(self, path):
+        return all(self.is_current(climate_layer_name(path, month), climate_file_name(path, month))
+                   for month in range(1, 13))
+
+    def codes(self, name):
+        return np.load(self.layer_path(name), mmap_mode="r")
+
+    def image(self, name):
+        return layer_image(self.meta[name], self.codes(name))
+
+    def code_values(self, name):
+        return layer_code_values(self.meta[name])
+
+    def scalar_range(self, name):
+        return self.meta[name]["scalar_range"]
+
+
+def open_raster_store(directory, density=None, climate=(), log=print):
+    # Preprocess whichever sources are missing from the store or changed
+    # since they were stored, later launches only map the arrays
+    store = RasterStore(directory)
+    if density and not store.is_current("density", density):
+        log("Caching {}".format(density))
+        store.add_density(density)
+    for path in climate:
+        if not store.climate_is_current(path):
+            log("Caching {}".format(path))
+            store.add_climate(path)
+    return store
+
+
+def coded_lookup_table(lut, value_range, code_values):
+    # One table entry per code holding the color the value table gives the
+    # decoded value, code 0 gets the bottom entry like the -3.4e38 cells did
+    table = numpy_support.vtk_to_numpy(lut.GetTable())
+    count = len(table)
+    low, high = value_range
+    index = np.floor((code_values - low) * (count / (high - low))) if high > low else np.zeros(len(code_values))
+    index = np.clip(index, 0, count - 1).astype(np.int64)
+    index[0] = 0
+
+    coded_lut = vtk.vtkLookupTable()
+    coded_lut.SetTable(numpy_support.numpy_to_vtk(table[index], deep=1, array_type=vtk.VTK_UNSIGNED_CHAR))
+    return coded_lut
+
+
+def raster_lookup_table(lut, value_range, store=None, layer=None):
+    # Every raster layer gets its own copy of the table set to its range,
+    # stored rasters a table indexed by code. The original table is left as
+    # it was, the scalar bars showing it set its range themselves
+    if store is not None:
+        coded_lut = coded_lookup_table(lut, value_range, store.code_values(layer))
+        coded_lut.SetTableRange(0, CODE_MAX + 1)
+        return coded_lut
+    layer_lut = vtk.vtkLookupTable()
+    layer_lut.DeepCopy(lut)
+    layer_lut.SetTableRange(value_range)
+    return layer_lut
+
+
+def main():
+    parser = ArgumentParser("Preprocess the density and climate rasters into a raster cache")
+    parser.add_argument("cache")
+    parser.add_argument("--density", type = str, help = "Population density GeoTIFF")
+    parser.add_argument("--climate", type = str, nargs = "*", default = [], help = "Climate paths without the \"-XX.tif\" month suffix")
+
+    args = parser.parse_args()
+    open_raster_store(args.cache, args.density, args.climate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import numpy as np
+
+from time_series import CovidData, TimeSeries
+
+# Granularities of the case circles, from the JHU rows as they are to whole
+# continents
+GRANULARITIES = ("province", "country", "continent")
+
+
+def mean_coordinates(lat, long, groups, weights, num_groups):
+    # Mean position of the weighted rows of every group, averaged on the
+    # sphere so groups across the date line stay together. NaN for groups
+    # without weight
+    lat = np.radians(lat)
+    long = np.radians(long)
+    xyz = [np.bincount(groups, weights * value, num_groups)
+           for value in (np.cos(lat) * np.cos(long), np.cos(lat) * np.sin(long), np.sin(lat))]
+    total = np.bincount(groups, weights, num_groups)
+    with np.errstate(invalid="ignore"):
+        xyz = [value / total for value in xyz]
+    return np.degrees(np.arctan2(xyz[2], np.hypot(xyz[0], xyz[1]))), np.degrees(np.arctan2(xyz[1], xyz[0]))
+
+
+class RowGroups(object):
+    # Rows of a JHU series grouped by key. The rows are sorted by group once,
+    # so summing the counts of any block of dates is a single reduceat
+    def __init__(self, keys):
+        self.names, self.inverse = np.unique(np.asarray(keys, dtype=str), return_inverse=True)
+        self.order = np.argsort(self.inverse, kind="stable")
+        self.starts = np.searchsorted(self.inverse[self.order], np.arange(len(self.names)))
+
+    def __len__(self):
+        return len(self.names)
+
+    def sum(self, counts):
+        if not counts.size:
+            return np.zeros((len(self), counts.shape[1]), dtype=np.int64)
+        return np.add.reduceat(counts[self.order], self.starts, axis=0, dtype=np.int64)
+
+
+class Rollup(object):
+    # The JHU series summed per country and per continent. The groups and
+    # their sums are computed once, each granularity is a CovidData the case
+    # layers draw like the rows themselves, so switching granularity or
+    # date never aggregates again. Countries are joined through the location
+    # registry, names it does not know stay countries of their own, and so
+    # do countries without a continent at the continent granularity
+    def __init__(self, covid_data, registry=None):
+        self.source = covid_data
+        self.registry = registry
+        self.groups = {}
+        self.data = {"province": covid_data}
+
+        levels = ["country"]
+        if registry is not None and registry.has_continents:
+            levels.append("continent")
+            self.centroids = self.continent_centroids()
+        for granularity in levels:
+            self.data[granularity] = CovidData(*[self.roll_up(granularity, name, series)
+                                                 for name, series in covid_data.series()])
+
+    @property
+    def granularities(self):
+        return tuple(granularity for granularity in GRANULARITIES if granularity in self.data)
+
+    def covid_data(self, granularity):
+        if granularity not in self.data:
+            raise ValueError("No {} granularity, the continents come from the UN migration tables".format(granularity))
+        return self.data[granularity]
+
+    def continent_centroids(self):
+        # Center of the locations of every continent
+        names, groups = np.unique(self.registry.continents.astype(str), return_inverse=True)
+        lat, long = mean_coordinates(self.registry.lat, self.registry.long, groups,
+                                     np.ones(len(groups)), len(names))
+        return {name: (lat[index], long[index]) for index, name in enumerate(names) if name}
+
+    def row_keys(self, series):
+        # Country and continent of every row, with the registry id of the country
+        countries = np.asarray(series.countries, dtype=str)
+        if self.registry is None:
+            return countries, countries, np.full(len(countries), -1)
+        ids = self.registry.ids(countries)
+        known = ids >= 0
+        country = np.where(known, self.registry.names[ids], countries)
+        continent = np.where(known, self.registry.continents[ids].astype(str), "")
+        return country, np.where(continent != "", continent, country), ids
+
+    def roll_up(self, granularity, name, series):
+        country, continent, ids = self.row_keys(series)
+        groups = RowGroups(country if granularity == "country" else continent)
+        self.groups[granularity, name] = groups
+        num_groups = len(groups)
+
+        # A country sits at its own JHU row when it has one, else at its
+        # registry coordinates, else at the mean of its rows
+        located = ((series.lat != 0) | (series.long != 0)).astype(np.float64)
+        own_row = located * (np.asarray(series.provinces, dtype=str) == "")
+        lat, long = mean_coordinates(series.lat, series.long, groups.inverse, own_row, num_groups)
+        mean_lat, mean_long = mean_coordinates(series.lat, series.long, groups.inverse, located, num_groups)
+        group_ids = ids[groups.order][groups.starts] if num_groups else ids[:0]
+        if self.registry is not None:
+            known = group_ids >= 0
+            mean_lat = np.where(known, self.registry.lat[group_ids], mean_lat)
+            mean_long = np.where(known, self.registry.long[group_ids], mean_long)
+        lat = np.nan_to_num(np.where(np.isnan(lat), mean_lat, lat))
+        long = np.nan_to_num(np.where(np.isnan(long), mean_long, long))
+
+        if granularity == "continent":
+            for index, group in enumerate(groups.names):
+                if group in self.centroids:
+                    lat[index], long[index] = self.centroids[group]
+
+        return TimeSeries([""] * num_groups, groups.names.tolist(), lat, long, groups.sum(series.counts), list(series.dates))
+
+    def extend(self):
+        # Sum the dates the source series gained since the rollup was built
+        for granularity in self.granularities[1:]:
+            for name, series in self.data[granularity].series():
+                source = self.source.get(name)
+                known = series.num_dates
+                if source.num_dates > known:
+                    series.append_dates(source.dates[known:], self.groups[granularity, name].sum(source.counts[:, known:]))
+
+
+def add_granularity_arguments(parser):
+    parser.add_argument("--granularity", type = str, default = "province", choices = GRANULARITIES, help = "Draw a case circle per JHU row, per country or per continent")
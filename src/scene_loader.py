@@ -0,0 +1,49 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SceneLoader(object):
+    # Runs the load step of every scene stage on a thread pool. `poll`,
+    # called on the thread that owns the renderer (e.g. from a Qt timer),
+    # attaches the stages that finished, in the order they finish. A stage
+    # is (name, load, attach): `load()` only reads and decodes data,
+    # `attach(result)` builds and adds the actors
+    def __init__(self, stages, log=print, attached=None, workers=None):
+        self.log = log
+        self.attached = attached
+        self.total = len(stages)
+        self.start = time.perf_counter()
+        self.executor = ThreadPoolExecutor(max_workers=workers or max(self.total, 1))
+        self.pending = []
+        for name, load, attach in stages:
+            self.log("Loading {}".format(name))
+            self.pending.append((name, self.executor.submit(load), attach))
+
+    @property
+    def done(self):
+        return not self.pending
+
+    def poll(self):
+        for stage in [stage for stage in self.pending if stage[1].done()]:
+            name, future, attach = stage
+            self.pending.remove(stage)
+            try:
+                attach(future.result())
+            except Exception as error:
+                self.log("Could not load {}: {}".format(name, error))
+                continue
+            self.log("Loaded {} after {:.1f}s ({}/{})".format(name, time.perf_counter() - self.start,
+                                                             self.total - len(self.pending), self.total))
+            if self.attached:
+                self.attached(name)
+        if self.done:
+            self.executor.shutdown(wait=False)
+        return self.done
+
+    def wait(self):
+        # Attach every stage without an event loop, e.g. for exports. Unlike
+        # `poll` a failed stage raises its error
+        for name, future, attach in self.pending:
+            attach(future.result())
+        self.pending = []
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,185 @@
+import csv
+import datetime
+import json
+import os
+
+import numpy as np
+
+# Order in which the JHU series are stored and drawn
+SERIES = ("infections", "recovered", "deaths")
+
+
+class TimeSeries(object):
+    # One JHU time series file: a (locations x dates) matrix of cumulative
+    # counts plus the coordinates and names of every location row
+    def __init__(self, provinces, countries, lat, long, counts, dates):
+        self.provinces = provinces
+        self.countries = countries
+        self.lat = lat
+        self.long = long
+        self.counts = counts
+        self.dates = dates
+
+    @property
+    def num_locations(self):
+        return self.counts.shape[0]
+
+    @property
+    def num_dates(self):
+        return self.counts.shape[1]
+
+    def column(self, date):
+        return self.counts[:, date]
+
+    def append_dates(self, dates, counts):
+        # Add the columns of new dates, `counts` has one row per location
+        if dates:
+            self.counts = np.concatenate([self.counts, counts.astype(self.counts.dtype)], axis=1)
+            self.dates = self.dates + dates
+
+
+class CovidData(object):
+    # The confirmed, recovered and deaths series, indexed by the same date
+    # index that the time sliders use
+    def __init__(self, infections, recovered, deaths):
+        self.infections = infections
+        self.recovered = recovered
+        self.deaths = deaths
+
+    @property
+    def num_dates(self):
+        return min(self.get(name).num_dates for name in SERIES)
+
+    def get(self, name):
+        return getattr(self, name)
+
+    def series(self):
+        return [(name, self.get(name)) for name in SERIES]
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, "%m/%d/%y").date()
+
+
+def parse_float(value):
+    # A handful of JHU rows have no coordinates, treat them like (0, 0) so
+    # they are skipped when drawing
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
+
+
+def parse_counts(rows):
+    # Missing cells show up as empty strings in some revisions of the data
+    cells = [[value if value else "0" for value in row] for row in rows]
+    return np.array(cells, dtype=np.int32)
+
+
+def load_time_series(path):
+    with open(path) as csvDataFile:
+        csv_reader = csv.reader(csvDataFile)
+        header = next(csv_reader)
+        rows = [row for row in csv_reader if row]
+
+    dates = [parse_date(value) for value in header[4:]]
+    provinces = [row[0] for row in rows]
+    countries = [row[1] for row in rows]
+    lat = np.array([parse_float(row[2]) for row in rows], dtype=np.float64)
+    long = np.array([parse_float(row[3]) for row in rows], dtype=np.float64)
+    counts = parse_counts([row[4:4 + len(dates)] for row in rows])
+
+    return TimeSeries(provinces, countries, lat, long, counts, dates)
+
+
+def read_new_dates(path, series):
+    # Dates a JHU file gained since `series` was read and their counts. Only
+    # the new columns are parsed. None when the rows or the known dates
+    # changed, the series then has to be read again
+    with open(path) as csvDataFile:
+        csv_reader = csv.reader(csvDataFile)
+        header = next(csv_reader)
+        rows = [row for row in csv_reader if row]
+
+    known = series.num_dates
+    if len(header) - 4 < known or [parse_date(value) for value in header[4:4 + known]] != list(series.dates):
+        return None
+    if [row[0] for row in rows] != list(series.provinces) or [row[1] for row in rows] != list(series.countries):
+        return None
+    dates = [parse_date(value) for value in header[4 + known:]]
+    counts = parse_counts([row[4 + known:4 + known + len(dates)] for row in rows]).reshape(len(rows), len(dates))
+    return dates, counts
+
+
+def file_stamp(path):
+    status = os.stat(path)
+    return status.st_mtime_ns, status.st_size
+
+
+class CovidDataWatcher(object):
+    # Polls the three JHU files and appends the dates they gained to the
+    # series in place. Create it before reading the files so that a change
+    # during the read is seen. A file is only read once its size and time
+    # stayed the same for one poll, so a download in progress is skipped
+    def __init__(self, paths):
+        self.paths = paths
+        self.stamps = {name: file_stamp(path) for name, path in paths.items()}
+        self.seen = dict(self.stamps)
+
+    def poll(self, covid_data):
+        # True when a series had to be read again because its rows changed
+        reloaded = False
+        for name, path in self.paths.items():
+            try:
+                stamp = file_stamp(path)
+            except OSError:
+                continue
+            settled = stamp == self.seen[name]
+            self.seen[name] = stamp
+            if stamp == self.stamps[name] or not settled:
+                continue
+            self.stamps[name] = stamp
+
+            series = covid_data.get(name)
+            update = read_new_dates(path, series)
+            if update is None:
+                setattr(covid_data, name, load_time_series(path))
+                reloaded = True
+            else:
+                series.append_dates(*update)
+        return reloaded
+
+
+def load_covid_data(infections_path, recovered_path, deaths_path):
+    return CovidData(load_time_series(infections_path),
+                     load_time_series(recovered_path),
+                     load_time_series(deaths_path))
+
+
+def save_covid_arrays(covid_data, directory):
+    # Store the parsed series as .npy files so that other processes can map
+    # them instead of parsing the CSVs again
+    names = {}
+    for name, series in covid_data.series():
+        np.save(os.path.join(directory, name + "-counts.npy"), series.counts)
+        np.save(os.path.join(directory, name + "-lat.npy"), series.lat)
+        np.save(os.path.join(directory, name + "-long.npy"), series.long)
+        names[name] = {"provinces": series.provinces,
+                       "countries": series.countries,
+                       "dates": [value.isoformat() for value in series.dates]}
+    with open(os.path.join(directory, "series.json"), "w") as names_file:
+        json.dump(names, names_file)
+
+
+def load_covid_arrays(directory, mmap_mode="r"):
+    with open(os.path.join(directory, "series.json")) as names_file:
+        names = json.load(names_file)
+    series = []
+    for name in SERIES:
+        series.append(TimeSeries(names[name]["provinces"],
+                                 names[name]["countries"],
+                                 np.load(os.path.join(directory, name + "-lat.npy"), mmap_mode=mmap_mode),
+                                 np.load(os.path.join(directory, name + "-long.npy"), mmap_mode=mmap_mode),
+                                 np.load(os.path.join(directory, name + "-counts.npy"), mmap_mode=mmap_mode),
+                                 [datetime.date.fromisoformat(value) for value in names[name]["dates"]]))
+    return CovidData(*series)
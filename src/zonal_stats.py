@@ -0,0 +1,221 @@
+import csv
+import hashlib
+import json
+import os
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+
+from climate_cache import climate_file_name
+from locations import open_location_registry
+from raster_pyramid import valid_mask
+from raster_store import image_values, read_tiff, source_stamp
+
+EARTH_RADIUS = 6371.0
+# Rows of raster cells summed at once
+BLOCK_ROWS = 256
+
+
+# Zones: the rasters carry no borders, so the cells are assigned from a
+# zone raster of the same extent, e.g. the GPW national identifier grid,
+# whose cells hold the ISO 3166 numeric code of their country. Cells whose
+# code names no location, nodata or 0, belong to no zone
+
+
+def zone_indices(path, codes):
+    # Index in `codes` of the zone of every cell of the zone raster, -1 for
+    # cells of no zone
+    values = image_values(read_tiff(path).GetOutput())
+    cell_codes = np.where(valid_mask(values), np.rint(values), 0).astype(np.int64)
+    codes = np.asarray(codes, dtype=np.int64)
+    if not len(codes):
+        return np.full(cell_codes.shape, -1, dtype=np.int32)
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    positions = np.minimum(np.searchsorted(sorted_codes, cell_codes), len(codes) - 1)
+    matched = (sorted_codes[positions] == cell_codes) & (cell_codes > 0)
+    return np.where(matched, order[positions], -1).astype(np.int32)
+
+
+def row_areas(rows, height, width):
+    # Area in km² of a cell of each raster row
+    edges = np.radians(-90 + 180 * np.arange(height + 1) / height)
+    bands = 2 * np.pi * EARTH_RADIUS ** 2 * np.diff(np.sin(edges))
+    return bands[rows] / width
+
+
+def zonal_sums(values, zones, num_zones):
+    # Area of the valid cells of every zone and the sum of their values
+    # times their area, accumulated over blocks of rows. The zone raster is
+    # scaled to the value raster, cells of no zone are left out
+    height, width = values.shape
+    zone_height, zone_width = zones.shape
+    columns = np.arange(width) * zone_width // width
+    area = np.zeros(num_zones)
+    total = np.zeros(num_zones)
+    for start in range(0, height, BLOCK_ROWS):
+        block = values[start:start + BLOCK_ROWS]
+        rows = np.arange(start, start + len(block))
+        cell_zones = zones[(rows * zone_height // height)[:, np.newaxis], columns]
+        valid = valid_mask(block) & (cell_zones >= 0)
+        cell_zones = cell_zones[valid]
+        cell_area = np.broadcast_to(row_areas(rows, height, width)[:, np.newaxis], block.shape)[valid]
+        area += np.bincount(cell_zones, cell_area, num_zones)
+        total += np.bincount(cell_zones, block[valid] * cell_area, num_zones)
+    return area, total
+
+
+def zonal_mean(area, total):
+    # NaN for zones without a valid cell
+    mean = np.full(len(area), np.nan)
+    np.divide(total, area, out=mean, where=area > 0)
+    return mean
+
+
+class ZonalStats(object):
+    # Raster statistics of a set of zones: the land area of each zone in
+    # km², the area weighted mean density, the population it adds up to, and
+    # the mean maximum and minimum temperature of every month (zones x 12).
+    # Zones without a valid cell get NaN means and no population.
+    # `countries` holds the country of each zone that is a province, "" for
+    # the others
+    def __init__(self, names, area, density, population, tmax, tmin, countries=None):
+        self.names = names
+        self.countries = countries if countries is not None else [""] * len(names)
+        self.area = area
+        self.density = density
+        self.population = population
+        self.tmax = tmax
+        self.tmin = tmin
+
+    def rows(self):
+        for index, name in enumerate(self.names):
+            yield ([name, self.population[index], self.countries[index], self.area[index], self.density[index]] +
+                   list(self.tmax[index]) + list(self.tmin[index]))
+
+
+def compute_zonal_stats(names, codes, zones, density, climate_max, climate_min, countries=None, log=print):
+    # Statistics of the zones named `names`, whose cells hold `codes` in the
+    # zone GeoTIFF, over the density GeoTIFF and the twelve months of both
+    # climate paths
+    log("Assigning the cells of {} to {} zones".format(zones, len(names)))
+    cell_zones = zone_indices(zones, codes)
+
+    log("Summing {}".format(density))
+    area, total = zonal_sums(image_values(read_tiff(density).GetOutput()), cell_zones, len(names))
+    climate = {}
+    for variable, path in (("max", climate_max), ("min", climate_min)):
+        log("Summing {}".format(path))
+        months = []
+        for month in range(1, 13):
+            month_area, month_total = zonal_sums(image_values(read_tiff(climate_file_name(path, month)).GetOutput()),
+                                                 cell_zones, len(names))
+            months.append(zonal_mean(month_area, month_total))
+        climate[variable] = np.column_stack(months)
+
+    return ZonalStats(list(names), area, zonal_mean(area, total), total, climate["max"], climate["min"], countries)
+
+
+def zonal_sources(zones, density, climate_max, climate_min):
+    return [zones, density] + [climate_file_name(path, month) for path in (climate_max, climate_min)
+                               for month in range(1, 13)]
+
+
+def zonal_stats_path(directory, names, codes, zones):
+    # One file per set of zones, named after their names, codes and zone
+    # raster
+    digest = hashlib.sha1(json.dumps([list(names), np.asarray(codes).tolist(),
+                                      os.path.abspath(zones)]).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(directory, "zonal-" + digest + ".npz")
+
+
+def open_zonal_stats(directory, names, codes, zones, density, climate_max, climate_min, countries=None, log=print):
+    # Statistics of the zones cached in `directory`, computed again only
+    # when a raster changed since they were stored
+    os.makedirs(directory, exist_ok=True)
+    path = zonal_stats_path(directory, names, codes, zones)
+    stamps = [source_stamp(source) for source in zonal_sources(zones, density, climate_max, climate_min)]
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            if json.loads(str(cached["stamps"])) == stamps:
+                return ZonalStats(list(names), cached["area"], cached["density"], cached["population"],
+                                  cached["tmax"], cached["tmin"], countries)
+
+    stats = compute_zonal_stats(names, codes, zones, density, climate_max, climate_min, countries, log)
+    with open(path + ".tmp", "wb") as stats_file:
+        np.savez(stats_file, stamps=json.dumps(stamps), area=stats.area, density=stats.density,
+                 population=stats.population, tmax=stats.tmax, tmin=stats.tmin)
+    os.replace(path + ".tmp", path)
+    return stats
+
+
+def read_province_table(path):
+    # (code, province, country) rows naming the province zones of a zone
+    # raster, a row whose code is not a number, e.g. a header, is skipped
+    codes, names, countries = [], [], []
+    with open(path, newline="", encoding="utf-8-sig") as csv_file:
+        for row in csv.reader(csv_file):
+            if len(row) < 3:
+                continue
+            try:
+                code = int(row[0])
+            except ValueError:
+                continue
+            codes.append(code)
+            names.append(row[1].strip())
+            countries.append(row[2].strip())
+    return codes, names, countries
+
+
+def zonal_header():
+    months = [str(month).zfill(2) for month in range(1, 13)]
+    return (["name", "population", "country", "area_km2", "density"] +
+            ["tmax-" + month for month in months] + ["tmin-" + month for month in months])
+
+
+def write_zonal_stats(stats_list, output):
+    # The first three columns are a population table, see
+    # read_population_table: a province row names its country so it is not
+    # taken for a location of the same name
+    writer = csv.writer(output)
+    writer.writerow(zonal_header())
+    for stats in stats_list:
+        for row in stats.rows():
+            writer.writerow([value if isinstance(value, str) else ("" if np.isnan(value) else round(float(value), 3))
+                             for value in row])
+
+
+def main():
+    parser = ArgumentParser("Population, density and climate of every location from the rasters")
+    parser.add_argument("cache", help = "Directory the statistics are cached in")
+    parser.add_argument("zones", help = "GeoTIFF of the ISO 3166 numeric country code of every cell, e.g. the GPW "
+                                        "national identifier grid, with the extent of the density raster")
+    parser.add_argument("density", help = "Population density GeoTIFF")
+    parser.add_argument("climate_max", help = "Maximum temperature path without the \"-XX.tif\" month suffix")
+    parser.add_argument("climate_min", help = "Minimum temperature path without the \"-XX.tif\" month suffix")
+    parser.add_argument("locations", help = "countries.csv or a saved location registry")
+    parser.add_argument("--provinces", type = str, nargs = 2, metavar = ("ZONES", "TABLE"),
+                        help = "GeoTIFF of the province code of every cell and a CSV of (code, province, country) "
+                               "rows, whose statistics are added after the countries")
+    parser.add_argument("--output", type = str, help = "Write the statistics to this CSV file instead of the standard output")
+    args = parser.parse_args()
+
+    registry = open_location_registry(args.locations)
+    stats_list = [open_zonal_stats(args.cache, registry.names.tolist(), registry.numeric, args.zones,
+                                   args.density, args.climate_max, args.climate_min)]
+    if args.provinces:
+        zones, table = args.provinces
+        codes, names, countries = read_province_table(table)
+        stats_list.append(open_zonal_stats(args.cache, names, codes, zones, args.density,
+                                           args.climate_max, args.climate_min, countries))
+
+    if args.output:
+        with open(args.output, "w", newline="") as output:
+            write_zonal_stats(stats_list, output)
+    else:
+        write_zonal_stats(stats_list, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()